@@ -0,0 +1,344 @@
+'''
+Benchmark harness for the sort, search, add and delete paths. It
+generates synthetic catalogues of any size with sorted, reversed,
+random or heavily duplicated values in one attribute, runs the core
+functions of main.py against them in a scratch directory, and saves
+the timings and tracemalloc peaks as JSON so two versions can be
+compared.
+
+    python benchmark.py run --sizes 1000,100000 --output results.json
+    python benchmark.py run --backend numpy --output numpy.json
+    python benchmark.py compare old.json new.json
+'''
+import argparse
+import contextlib
+import csv
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import date, datetime, timezone
+import main
+import sort_engine
+import book_keys
+import normalize
+from ingest import load_book_store
+from views import asc, desc
+
+# distributions of the benchmarked attribute:
+random_order = 'random'
+sorted_order = 'sorted'
+reversed_order = 'reversed'
+duplicates = 'duplicates'
+DISTRIBUTIONS = [random_order, sorted_order, reversed_order, duplicates]
+# distinct values of the benchmarked attribute in the duplicates distribution:
+DUPLICATE_VALUES = 8
+# the legacy quicksort is quadratic on sorted input, so it is only timed up to this size:
+LOMUTO_MAX_ROWS = 5000
+DEFAULT_SIZES = [1000, 10000]
+DEFAULT_SEARCHES = 1000
+DEFAULT_MUTATIONS = 100
+WORDS = ['Shadow', 'River', 'Garden', 'Winter', 'Empire', 'Secret', 'Night', 'Stone', 'Glass', 'House',
+         'Silent', 'Crown', 'Ocean', 'Fire', 'Dream', 'Iron', 'Lost', 'Golden', 'Storm', 'City']
+FIRST_NAMES = ['Ada', 'Ben', 'Chloe', 'Dan', 'Eve', 'Frank', 'Grace', 'Hugo', 'Iris', 'Jack']
+LAST_NAMES = ['Adams', 'Brown', 'Clarke', 'Dunn', 'Evans', 'Fox', 'Gray', 'Hill', 'Irving', 'Jones']
+# first 12 digits of the first generated ISBN:
+ISBN_BASE = 978000000000
+FIRST_DATE = date(1900, 1, 1).toordinal()
+LAST_DATE = date(2024, 12, 31).toordinal()
+
+
+def random_value(attribute, rng, row_number):
+    '''
+    @param attribute: book attribute (e.g. author/title/etc)
+    @param rng: random.Random
+    @param row_number: int, keeps generated ISBNs unique
+    @return value: typed value, int for isbn/length/date and str for title/author
+    '''
+    if attribute == book_keys.isbn:
+        # a valid ISBN-13, so generated books pass add_book's check digit test. Every row
+        # number below 10 ** 9 gets its own, so catalogues and the books added to them never collide
+        body = str(ISBN_BASE + row_number)
+        return int(body + str(normalize.isbn13_check_digit(body)))
+    if attribute == book_keys.title:
+        return ' '.join(rng.choice(WORDS) for i in range(rng.randint(1, 4)))
+    if attribute == book_keys.author:
+        return rng.choice(FIRST_NAMES) + ' ' + rng.choice(LAST_NAMES) + ' ' + str(rng.randrange(1000))
+    if attribute == book_keys.length:
+        return rng.randint(1, 1500)
+    return rng.randint(FIRST_DATE, LAST_DATE)
+
+
+def format_value(attribute, value):
+    if attribute == book_keys.date_of_publication:
+        return date.fromordinal(value).isoformat()
+    return str(value)
+
+
+def generate_catalogue(rows, distribution=random_order, attribute=book_keys.isbn, seed=0, first_row=0):
+    '''
+    Generates a synthetic catalogue. Every attribute is random except the
+    given one, which follows the distribution
+
+    @param rows: int number of books
+    @param distribution: str one of DISTRIBUTIONS
+    @param attribute: book attribute the distribution applies to
+    @param seed: int seed, the same arguments always give the same catalogue
+    @param first_row: int row number of the first book, so books generated past
+    another catalogue's rows get ISBNs it does not hold
+    @return books: generator of lists of five str
+    '''
+    rng = random.Random(seed)
+    row_numbers = range(first_row, first_row + rows)
+    # ISBNs are unique per row number but grow with it, so they are shuffled into random order
+    isbns = [random_value(book_keys.isbn, rng, row_number) for row_number in row_numbers]
+    rng.shuffle(isbns)
+    if distribution == duplicates:
+        pool_rows = range(first_row, first_row + DUPLICATE_VALUES)
+        pool = [random_value(attribute, rng, row_number) for row_number in pool_rows]
+        column = [rng.choice(pool) for row_number in row_numbers]
+    else:
+        if attribute == book_keys.isbn:
+            column = list(isbns)
+        else:
+            column = [random_value(attribute, rng, row_number) for row_number in row_numbers]
+        if distribution in (sorted_order, reversed_order):
+            column.sort(reverse=distribution == reversed_order)
+    for row_number, isbn_value, value in zip(row_numbers, isbns, column):
+        book = [format_value(other, isbn_value if other == book_keys.isbn else random_value(other, rng, row_number))
+                for other in book_keys.attributes]
+        book[attribute] = format_value(attribute, value)
+        yield book
+
+
+def write_catalogue(books, output_file):
+    with open(output_file, mode='w', newline='') as file:
+        writer = csv.writer(file)
+        for book in books:
+            writer.writerow(book)
+
+
+def measure(fn, *args, trace_memory=True, operations=1):
+    '''
+    Runs fn(*args) once with main.py's console output discarded
+
+    @param fn: function to time
+    @param trace_memory: bool, also record the peak of traced allocations
+    @param operations: int number of operations fn performs, for the per-operation time
+    @return result, measurement: fn's return value and a dict of the figures
+    '''
+    if trace_memory:
+        tracemalloc.start()
+    try:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            start = time.perf_counter()
+            result = fn(*args)
+            seconds = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1] if trace_memory else None
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+    return result, {'seconds': seconds, 'operations': operations,
+                    'seconds_per_operation': seconds / operations if operations else None,
+                    'peak_bytes': peak}
+
+
+def load_catalogue(filename):
+    # every copy is kept, so the duplicates distribution of ISBNs still has its repeated keys to sort
+    return load_book_store(filename, duplicates=normalize.allow)
+
+
+def run_searches(terms, attribute):
+    for term in terms:
+        main.search_for_book(term, attribute)
+
+
+def run_adds(books):
+    for book in books:
+        main.add_book(main.book_data, book, flush=False)
+    main.flush_sorted_views()
+
+
+def run_deletes(isbns):
+    for isbn in isbns:
+        main.delete_book(isbn, main.book_data, flush=False)
+    main.flush_sorted_views()
+
+
+def benchmark_catalogue(rows, distribution, attribute, strategies, searches, mutations, trace_memory, seed):
+    '''
+    Runs every benchmark against one generated catalogue, in the current directory
+
+    @return results: list of dicts, one per benchmark
+    '''
+    case = {'rows': rows, 'distribution': distribution, 'attribute': book_keys.attribute_names[attribute]}
+    results = []
+
+    def record(name, fn, *args, operations=1, **extra):
+        value, measurement = measure(fn, *args, trace_memory=trace_memory, operations=operations)
+        results.append(dict(case, benchmark=name, **extra, **measurement))
+        return value
+
+    write_catalogue(generate_catalogue(rows, distribution, attribute, seed), 'catalogue.csv')
+    main.book_data, errors = record('load', load_catalogue, 'catalogue.csv')
+    main.sorted_views = {}
+    main.index_state = main.not_sorted
+    main.build_isbn_index(main.book_data)
+
+    for strategy in strategies:
+        if strategy == sort_engine.lomuto and rows > LOMUTO_MAX_ROWS:
+            continue
+        if strategy == sort_engine.radix and attribute not in book_keys.FIXED_WIDTH_ATTRIBUTES:
+            continue
+        for order in (asc, desc):
+            record('sort_books', main.sort_books, attribute, order, strategy, strategy=strategy, order=order)
+
+    record('sort_all_books', main.sort_all_books)
+
+    rng = random.Random(seed + 1)
+    books = list(main.book_data)
+    terms = [rng.choice(books)[attribute] for i in range(searches // 2)]
+    terms += [format_value(attribute, random_value(attribute, rng, rows + i)) for i in range(searches - len(terms))]
+    rng.shuffle(terms)
+    record('search_for_book', run_searches, terms, attribute, operations=len(terms), source='memory')
+    # without the in-memory views, searches go to the sorted file and its sidecar
+    views, isbn_index = main.sorted_views, main.isbn_index
+    main.sorted_views, main.isbn_index = {}, None
+    record('search_for_book', run_searches, terms, attribute, operations=len(terms), source='file')
+    main.sorted_views, main.isbn_index = views, isbn_index
+
+    # numbered past the catalogue and the missing search terms, so no new ISBN is taken
+    new_books = list(generate_catalogue(mutations, random_order, book_keys.isbn, seed + 2, rows + searches))
+    record('add_book', run_adds, new_books, operations=len(new_books))
+    isbns = [book[book_keys.isbn] for book in rng.sample(books, min(mutations, len(books)))]
+    record('delete_book', run_deletes, isbns, operations=len(isbns))
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(sizes, distributions, attributes, strategies, searches=DEFAULT_SEARCHES,
+                   mutations=DEFAULT_MUTATIONS, trace_memory=True, seed=0, progress=print):
+    '''
+    Runs the benchmarks for every combination of size, distribution and
+    attribute, each in its own scratch directory
+
+    @return report: dict with the run's 'meta' data and a list of 'results'
+    '''
+    report = {
+        'meta': {
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'started': datetime.now(timezone.utc).isoformat(),
+            'trace_memory': trace_memory,
+            'seed': seed,
+            'backend': main.backend,
+        },
+        'results': [],
+    }
+    original_directory = os.getcwd()
+    for rows in sizes:
+        for distribution in distributions:
+            for attribute in attributes:
+                progress(f"{rows} rows, {distribution} {book_keys.attribute_names[attribute]} ...")
+                with tempfile.TemporaryDirectory(prefix='book_benchmark_') as work_dir:
+                    # main.py reads and writes data/ relative to the working directory
+                    os.chdir(work_dir)
+                    os.mkdir('data')
+                    try:
+                        report['results'] += benchmark_catalogue(rows, distribution, attribute, strategies,
+                                                                 searches, mutations, trace_memory, seed)
+                    finally:
+                        os.chdir(original_directory)
+    return report
+
+
+def result_key(result):
+    return tuple(str(result.get(field)) for field in
+                 ('benchmark', 'rows', 'distribution', 'attribute', 'strategy', 'order', 'source'))
+
+
+def compare_reports(old_report, new_report):
+    '''
+    @return rows: list of (key, old seconds, new seconds, ratio) for benchmarks found in both
+    '''
+    old_results = {result_key(result): result for result in old_report['results']}
+    rows = []
+    for result in new_report['results']:
+        old = old_results.get(result_key(result))
+        if old is not None:
+            ratio = result['seconds'] / old['seconds'] if old['seconds'] else None
+            rows.append((result_key(result), old['seconds'], result['seconds'], ratio))
+    return rows
+
+
+def parse_list(text, allowed=None):
+    values = [value.strip() for value in text.split(',') if value.strip()]
+    if allowed is not None:
+        for value in values:
+            if value not in allowed:
+                raise argparse.ArgumentTypeError(f"unknown value {value!r}, expected one of {', '.join(allowed)}")
+    return values
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Benchmark sorting, searching, adding and deleting books.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    run = commands.add_parser('run', help="run the benchmarks and save the results as JSON")
+    run.add_argument('--sizes', type=lambda text: [int(size) for size in parse_list(text)], default=DEFAULT_SIZES,
+                     help="comma-separated catalogue sizes, 1000 up to 10000000")
+    run.add_argument('--distributions', type=lambda text: parse_list(text, DISTRIBUTIONS), default=DISTRIBUTIONS)
+    run.add_argument('--attributes', type=lambda text: parse_list(text, book_keys.attribute_names),
+                     default=book_keys.attribute_names)
+    strategies = [sort_engine.lomuto, sort_engine.introsort, sort_engine.timsort, sort_engine.radix, sort_engine.auto]
+    run.add_argument('--strategies', type=lambda text: parse_list(text, strategies), default=strategies)
+    run.add_argument('--searches', type=int, default=DEFAULT_SEARCHES)
+    run.add_argument('--mutations', type=int, default=DEFAULT_MUTATIONS)
+    run.add_argument('--no-memory', action='store_true', help="skip tracemalloc, which slows the timed code down")
+    run.add_argument('--seed', type=int, default=0)
+    run.add_argument('--backend', choices=(main.python_backend, main.vectorized_backend), default=main.python_backend,
+                     help="engine to benchmark; the numpy backend ignores --strategies")
+    run.add_argument('--output', default='benchmark_results.json')
+    compare = commands.add_parser('compare', help="compare two saved result files")
+    compare.add_argument('old')
+    compare.add_argument('new')
+    return parser
+
+
+def run(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.command == 'compare':
+        with open(args.old) as old_file, open(args.new) as new_file:
+            rows = compare_reports(json.load(old_file), json.load(new_file))
+        for key, old_seconds, new_seconds, ratio in rows:
+            label = ' '.join(field for field in key if field != 'None')
+            print(f"{label:<70} {old_seconds:10.4f}s {new_seconds:10.4f}s {ratio:6.2f}x" if ratio is not None
+                  else f"{label:<70} {old_seconds:10.4f}s {new_seconds:10.4f}s")
+        return 0
+    output_file = os.path.abspath(args.output)
+    main.set_backend(args.backend)
+    attributes = [book_keys.attribute_names.index(name) for name in args.attributes]
+    report = run_benchmarks(args.sizes, args.distributions, attributes, args.strategies, args.searches,
+                            args.mutations, not args.no_memory, args.seed,
+                            progress=lambda message: print(message, file=sys.stderr))
+    with open(output_file, 'w') as file:
+        json.dump(report, file, indent=2)
+    print(f"Saved {len(report['results'])} results to {output_file}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(run())
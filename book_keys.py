@@ -0,0 +1,148 @@
+'''
+Key extraction for book columns. Each column is converted into a list
+of typed keys once, before sorting or searching, so the hot loops
+compare ints and strings directly instead of re-parsing CSV text
+'''
+from datetime import date
+
+# inner list index of each book attribute:
+isbn = 0
+title = 1
+author = 2
+length = 3
+date_of_publication = 4
+attributes = [isbn, title, author, length, date_of_publication]
+# names used in the sorted file names and on the command line, by attribute index:
+attribute_names = ['isbn', 'title', 'author', 'length', 'date_of_publication']
+# columns whose keys are bounded-width ints, and so can be radix sorted:
+FIXED_WIDTH_ATTRIBUTES = (isbn, date_of_publication)
+# collations for the text columns (title/author):
+binary = 'binary'
+casefold = 'casefold'
+
+
+def isbn_key(value):
+    '''
+    Packs an ISBN string into an int. 13 digit ISBNs keep their string order
+
+    @param value: str ISBN from the CSV
+    @return key: int
+    '''
+    return int(value)
+
+
+def length_key(value):
+    '''
+    @param value: str page length from the CSV
+    @return key: int
+    '''
+    return int(value)
+
+
+def date_key(value):
+    '''
+    Converts a YYYY-MM-DD date to its proleptic Gregorian day ordinal
+
+    @param value: str date from the CSV
+    @return key: int
+    '''
+    return date.fromisoformat(value).toordinal()
+
+
+def text_key(value, collation=binary):
+    '''
+    Returns the key used to order titles and authors. The binary collation
+    compares the raw text, which is what the sorted CSV files have always used.
+    The casefold collation ignores case, breaking ties on the raw text
+
+    @param value: str title or author
+    @param collation: str binary/casefold
+    @return key: str, or tuple of str for casefold
+    '''
+    if collation == casefold:
+        return (value.casefold(), value)
+    return value
+
+
+def get_key_function(attribute, collation=binary):
+    '''
+    Utility function to return the key function for a book attribute
+
+    @param attribute: book attribute (e.g. author/title/etc)
+    @param collation: str collation used for title/author
+    @return key: function taking the column value and returning its typed key
+    @raise ValueError: raises an exception for an unknown attribute
+    '''
+    if attribute == isbn:
+        return isbn_key
+    if attribute == length:
+        return length_key
+    if attribute == date_of_publication:
+        return date_key
+    if attribute in (title, author):
+        if collation == binary:
+            return str
+        return lambda value: text_key(value, collation)
+    raise ValueError(f"Unknown book attribute: {attribute}")
+
+
+def extract_column_keys(column, attribute, collation=binary):
+    '''
+    Converts a list of values of one attribute into a list of typed keys
+
+    @param column: list of str values, column[i] belonging to book i
+    @param attribute: book attribute (e.g. author/title/etc)
+    @param collation: str collation used for title/author
+    @return keys: list of keys, keys[i] belonging to column[i]
+    @raise ValueError: raises an exception naming the first value that cannot be converted
+    '''
+    key = get_key_function(attribute, collation)
+    try:
+        return [key(value) for value in column]
+    except ValueError:
+        for row_number, value in enumerate(column):
+            try:
+                key(value)
+            except ValueError:
+                raise ValueError(f"Invalid value {value!r} in row {row_number + 1} of the book data.")
+        raise
+
+
+def extract_keys(data, attribute, collation=binary):
+    '''
+    Converts one column of the book data into a list of typed keys.
+    A BookStore already holds typed columns, so its keys are read out directly
+
+    @param data: list of lists containing book data, or a BookStore
+    @param attribute: book attribute (e.g. author/title/etc)
+    @param collation: str collation used for title/author
+    @return keys: list of keys, keys[i] belonging to data[i] (to row id i for a BookStore)
+    @raise ValueError: raises an exception naming the first value that cannot be converted
+    '''
+    if hasattr(data, 'column_keys'):
+        return data.column_keys(attribute, collation)
+    return extract_column_keys([book[attribute] for book in data], attribute, collation)
+
+
+def row_ids(data):
+    '''
+    Utility function to return the indexes of the books in data that
+    should be sorted. Deleted rows of a BookStore are skipped
+
+    @param data: list of lists containing book data, or a BookStore
+    @return row_ids: list or range of int indexes
+    '''
+    if hasattr(data, 'live_row_ids'):
+        return data.live_row_ids()
+    return range(len(data))
+
+
+def apply_permutation(data, permutation):
+    '''
+    Returns the rows of data in the order given by permutation
+
+    @param data: list of lists containing book data, or a BookStore
+    @param permutation: list of indexes into data
+    @return ordered: list of the same inner lists, reordered
+    '''
+    return [data[i] for i in permutation]
@@ -0,0 +1,215 @@
+'''
+Column-oriented storage for the book data. Instead of one Python list
+of five strings per book, each attribute is held in its own packed
+array and titles/authors are interned in string pools, so a book costs
+a few dozen bytes and the sort and search engines read typed keys
+straight out of the columns
+'''
+from array import array
+from datetime import date
+import book_keys
+from book_keys import isbn, title, author, length, date_of_publication
+
+# largest page length that fits in an array('H'):
+MAX_LENGTH = 65535
+
+
+class StringPool:
+    '''
+    Interns strings so each distinct title/author is stored once and
+    referenced from the columns by an integer id
+    '''
+
+    def __init__(self):
+        self.strings = []
+        self.ids = {}
+
+    def __len__(self):
+        return len(self.strings)
+
+    def intern(self, value):
+        '''
+        @param value: str to store
+        @return string_id: int id of value in the pool
+        '''
+        string_id = self.ids.get(value)
+        if string_id is None:
+            string_id = len(self.strings)
+            self.strings.append(value)
+            self.ids[value] = string_id
+        return string_id
+
+
+class BookStore:
+    '''
+    Columnar book store. Books are addressed by row id, the position the
+    book was appended at. Deleting a book only marks its row as deleted, so
+    the row ids held by the indexes and sorted views stay valid;
+    compact() drops deleted rows and renumbers the rest
+    '''
+
+    def __init__(self):
+        self.isbns = array('Q')
+        self.lengths = array('H')
+        self.dates = array('i')
+        self.title_ids = array('I')
+        self.author_ids = array('I')
+        self.titles = StringPool()
+        self.authors = StringPool()
+        self.deleted = bytearray()
+        self.deleted_count = 0
+        # arrays an optional backend derives from the columns, e.g. numpy_backend, which checks they are current
+        self.backend_cache = {}
+
+    @classmethod
+    def from_rows(cls, rows):
+        '''
+        @param rows: iterable of lists of five str (isbn, title, author, length, date)
+        @return store: BookStore holding the rows in order
+        '''
+        store = cls()
+        for row in rows:
+            store.append(row)
+        return store
+
+    def __len__(self):
+        return len(self.deleted) - self.deleted_count
+
+    def __iter__(self):
+        for row_id in self.live_row_ids():
+            yield self.row(row_id)
+
+    def __getitem__(self, row_id):
+        return self.row(row_id)
+
+    def append(self, book):
+        '''
+        Validates and appends a book
+
+        @param book: list of five str (isbn, title, author, length, date)
+        @return row_id: int row id of the new book
+        @raise ValueError: raises an exception if a value cannot be stored
+        '''
+        if not book[isbn].isdigit() or str(int(book[isbn])) != book[isbn]:
+            raise ValueError(f"ISBN {book[isbn]!r} must be digits only, without leading zeros.")
+        length_value = book_keys.length_key(book[length])
+        if not 0 <= length_value <= MAX_LENGTH:
+            raise ValueError(f"Page length {book[length]!r} must be between 0 and {MAX_LENGTH}.")
+        date_value = book_keys.date_key(book[date_of_publication])
+        return self.append_record((book_keys.isbn_key(book[isbn]), book[title], book[author], length_value, date_value))
+
+    def append_record(self, record):
+        '''
+        Appends a book that has already been parsed and validated, e.g. by ingest
+
+        @param record: tuple (isbn int, title str, author str, length int, date ordinal int)
+        @return row_id: int row id of the new book
+        '''
+        isbn_value, title_value, author_value, length_value, date_value = record
+        self.isbns.append(isbn_value)
+        self.lengths.append(length_value)
+        self.dates.append(date_value)
+        self.title_ids.append(self.titles.intern(title_value))
+        self.author_ids.append(self.authors.intern(author_value))
+        self.deleted.append(0)
+        return len(self.deleted) - 1
+
+    def delete(self, row_id):
+        '''
+        Marks a row as deleted
+
+        @param row_id: int row id of the book
+        @raise KeyError: raises an exception if the row is already deleted
+        '''
+        if self.deleted[row_id]:
+            raise KeyError(f"Row {row_id} has already been deleted.")
+        self.deleted[row_id] = 1
+        self.deleted_count += 1
+
+    def is_live(self, row_id):
+        return not self.deleted[row_id]
+
+    def live_row_ids(self):
+        '''
+        @return row_ids: list of int row ids of books that have not been deleted, in order
+        '''
+        if not self.deleted_count:
+            return list(range(len(self.deleted)))
+        return [row_id for row_id, is_deleted in enumerate(self.deleted) if not is_deleted]
+
+    def row(self, row_id):
+        '''
+        Rebuilds a book as the list of five strings used throughout main.py
+
+        @param row_id: int row id of the book
+        @return book: list of five str (isbn, title, author, length, date)
+        '''
+        return [
+            str(self.isbns[row_id]),
+            self.titles.strings[self.title_ids[row_id]],
+            self.authors.strings[self.author_ids[row_id]],
+            str(self.lengths[row_id]),
+            date.fromordinal(self.dates[row_id]).isoformat(),
+        ]
+
+    def key(self, row_id, attribute):
+        '''
+        @param row_id: int row id of the book
+        @param attribute: book attribute (e.g. author/title/etc)
+        @return key: the typed sort key book_keys would derive for that value
+        '''
+        if attribute == isbn:
+            return self.isbns[row_id]
+        if attribute == length:
+            return self.lengths[row_id]
+        if attribute == date_of_publication:
+            return self.dates[row_id]
+        if attribute == title:
+            return self.titles.strings[self.title_ids[row_id]]
+        return self.authors.strings[self.author_ids[row_id]]
+
+    def column_keys(self, attribute, collation=book_keys.binary):
+        '''
+        Returns the typed keys of one attribute for every row id, deleted
+        rows included, without parsing any text
+
+        @param attribute: book attribute (e.g. author/title/etc)
+        @param collation: str collation used for title/author
+        @return keys: list of keys, keys[row_id] belonging to that row
+        '''
+        if attribute == isbn:
+            return self.isbns.tolist()
+        if attribute == length:
+            return self.lengths.tolist()
+        if attribute == date_of_publication:
+            return self.dates.tolist()
+        if attribute == title:
+            pool, ids = self.titles.strings, self.title_ids
+        elif attribute == author:
+            pool, ids = self.authors.strings, self.author_ids
+        else:
+            raise ValueError(f"Unknown book attribute: {attribute}")
+        if collation != book_keys.binary:
+            pool = [book_keys.text_key(value, collation) for value in pool]
+        return [pool[string_id] for string_id in ids]
+
+    def compact(self):
+        '''
+        Drops deleted rows, renumbering the remaining rows from 0 in order.
+        Any row ids held elsewhere are invalid afterwards
+        '''
+        if not self.deleted_count:
+            return
+        live = self.live_row_ids()
+        for name in ('isbns', 'lengths', 'dates', 'title_ids', 'author_ids'):
+            column = getattr(self, name)
+            setattr(self, name, array(column.typecode, [column[row_id] for row_id in live]))
+        self.deleted = bytearray(len(live))
+        self.deleted_count = 0
+
+    def nbytes(self):
+        '''
+        @return nbytes: int approximate bytes used by the columns (string pools excluded)
+        '''
+        columns = (self.isbns, self.lengths, self.dates, self.title_ids, self.author_ids)
+        return sum(column.itemsize * len(column) for column in columns) + len(self.deleted)
@@ -0,0 +1,314 @@
+'''
+Headless command-line interface over the same functions the GUI uses,
+for cron jobs and pipelines. It never imports tkinter.
+
+    python cli.py [--backend python|numpy] sort [--workers N]
+    python cli.py sort --shards N [--workers N]
+    python cli.py sort --by author,date_of_publication,title[:asc|:desc]
+    python cli.py sort --external [--memory-budget BYTES] [--fan-in N]
+    python cli.py search TERM [--attribute NAME]
+    python cli.py find WORDS [--attribute title|author] [--limit N]
+    python cli.py top ATTRIBUTE K [--asc]
+    python cli.py quantile ATTRIBUTE FRACTION...
+    python cli.py group ATTRIBUTE [--value NAME] [--aggregates count,min,max,mean,median]
+    python cli.py add ISBN TITLE AUTHOR LENGTH DATE [--save]
+    python cli.py delete ISBN [--save]
+    python cli.py batch FILE [--save]
+
+A batch file is a CSV with one operation per line:
+
+    add,<isbn>,<title>,<author>,<length>,<date>
+    delete,<isbn>
+    search,<term>                 (searches by ISBN)
+    search,<attribute>,<term>
+
+Adds and deletes are applied in file order, then the changed sorted
+files are flushed once (after a full sort if no sorted views were
+loaded), then searches are answered against the result. Exit status is 1 if any operation failed
+'''
+import argparse
+import csv
+import sys
+import main
+import book_keys
+import external_sort
+import instrumentation
+import queries
+import shards
+
+
+def parse_attribute(name):
+    '''
+    @param name: str attribute name, e.g. 'author'
+    @return attribute: int attribute index
+    @raise argparse.ArgumentTypeError: raises an exception for unknown names
+    '''
+    if name not in book_keys.attribute_names:
+        raise argparse.ArgumentTypeError(
+            f"unknown attribute {name!r}, expected one of {', '.join(book_keys.attribute_names)}")
+    return book_keys.attribute_names.index(name)
+
+
+def parse_sort_spec(text):
+    '''
+    @param text: str comma separated attribute names, each optionally followed
+    by :asc or :desc, e.g. 'author,date_of_publication:desc,title'
+    @return sort_spec: list of (attribute, order) pairs
+    @raise argparse.ArgumentTypeError: raises an exception for unknown names or orders
+    '''
+    sort_spec = []
+    for part in text.split(','):
+        name, _, order = part.strip().partition(':')
+        order = order or main.asc
+        if order not in (main.asc, main.desc):
+            raise argparse.ArgumentTypeError(f"unknown order {order!r}, expected asc or desc")
+        sort_spec.append((parse_attribute(name), order))
+    return sort_spec
+
+
+def load_books(source, use_snapshot=True):
+    '''
+    Loads the catalogue into main's store together with the changes
+    logged since the last checkpoint, from its snapshot if it has one
+
+    @param source: file path of the catalogue CSV
+    @param use_snapshot: bool, False to always parse the CSV
+    '''
+    errors = main.open_catalogue(source, use_snapshot)
+    for line_number, message in errors:
+        print(f"Skipped line {line_number} of {source}: {message}", file=sys.stderr)
+
+
+def read_batch(filename):
+    '''
+    Reads a batch file into (line number, operation, arguments) tuples
+
+    @param filename: file path of the batch CSV
+    @return operations: list of tuples
+    '''
+    with open(filename, 'r', newline='') as batchfile:
+        return [(line_number, row[0].strip().lower(), row[1:])
+                for line_number, row in enumerate(csv.reader(batchfile), start=1) if row]
+
+
+def run_batch(operations, save_to=None):
+    '''
+    Applies adds and deletes in order with a single flush at the end,
+    then answers the searches. Views loaded from the snapshot were kept
+    sorted by each add and delete, so only the changed files are
+    rewritten; without them the books are sorted once
+
+    @param operations: list of (line number, operation, arguments) tuples
+    @param save_to: file path of the catalogue to fold the logged changes into, or None
+    @return failures: int number of operations that failed
+    '''
+    failures = 0
+    searches = []
+    mutated = False
+    for line_number, operation, arguments in operations:
+        try:
+            if operation == 'add':
+                if len(arguments) != 5:
+                    raise ValueError("add needs isbn, title, author, length and date")
+                main.add_book(main.book_data, arguments, flush=False)
+                mutated = True
+            elif operation == 'delete':
+                if len(arguments) != 1:
+                    raise ValueError("delete needs an isbn")
+                main.delete_book(arguments[0], main.book_data, flush=False)
+                mutated = True
+            elif operation == 'search':
+                if len(arguments) == 1:
+                    searches.append((line_number, book_keys.isbn, arguments[0]))
+                elif len(arguments) == 2:
+                    searches.append((line_number, parse_attribute(arguments[0]), arguments[1]))
+                else:
+                    raise ValueError("search needs a term, optionally preceded by an attribute")
+            else:
+                raise ValueError(f"unknown operation {operation!r}")
+        except Exception as e:
+            failures += 1
+            print(f"line {line_number}: {operation} failed: {e}", file=sys.stderr)
+    if mutated:
+        if main.sorted_views:
+            main.flush_sorted_views()
+            main.save_snapshot()
+        else:
+            main.sort_all_books()
+        if save_to is not None:
+            main.checkpoint_catalogue(save_to)
+    # each attribute's terms are looked up together, then printed in file order
+    results = {}
+    for attribute in {attribute for line_number, attribute, term in searches}:
+        terms = [term for line_number, term_attribute, term in searches if term_attribute == attribute]
+        try:
+            results[attribute] = iter(list(main.search_for_books(terms, attribute)))
+        except Exception as e:
+            print(f"search by {book_keys.attribute_names[attribute]} failed: {e}", file=sys.stderr)
+            results[attribute] = iter([(term, main.missing, None) for term in terms])
+    writer = csv.writer(sys.stdout)
+    for line_number, attribute, term in searches:
+        term, status, book = next(results[attribute])
+        if book is None:
+            failures += 1
+            writer.writerow([status, term])
+        else:
+            writer.writerow([status] + book)
+    return failures
+
+
+def run_query(args):
+    '''
+    Prints the result of a top, quantile or group command as CSV
+
+    @param args: argparse.Namespace from build_parser
+    @return status: int exit status
+    '''
+    writer = csv.writer(sys.stdout)
+    try:
+        if args.command == 'top':
+            order = main.asc if args.asc else main.desc
+            writer.writerows(queries.top_k(main.book_data, args.attribute, args.k, order))
+        elif args.command == 'quantile':
+            values = queries.quantiles(main.book_data, args.attribute, args.fractions)
+            writer.writerows(zip(args.fractions, values))
+        else:
+            wanted = args.aggregates
+            if wanted is None:
+                wanted = [aggregate for aggregate in queries.aggregates
+                          if args.value == book_keys.length or aggregate not in queries.NUMERIC_AGGREGATES]
+            groups = queries.group_by(main.book_data, args.attribute, args.value, wanted)
+            writer.writerow([book_keys.attribute_names[args.attribute]] + wanted)
+            for name, results in groups.items():
+                writer.writerow([name] + [results[aggregate] for aggregate in wanted])
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 1
+    return 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Sort, search, add and delete books without the GUI.")
+    parser.add_argument('--source', default='library_data.csv', help="catalogue CSV (default: library_data.csv)")
+    parser.add_argument('--metrics', action='store_true', help="print timing, sort and I/O counters to stderr at the end")
+    parser.add_argument('--metrics-interval', type=float, default=None, metavar='SECONDS',
+                        help="also log the counters every SECONDS while running")
+    parser.add_argument('--profile', default=None, metavar='FILE', help="run under cProfile and dump the stats to FILE")
+    parser.add_argument('--no-snapshot', action='store_true', help="parse --source even if a saved snapshot matches it")
+    parser.add_argument('--backend', choices=(main.python_backend, main.vectorized_backend), default=main.python_backend,
+                        help="sort and search engine; numpy falls back to python if NumPy is missing")
+    commands = parser.add_subparsers(dest='command', required=True)
+    sort = commands.add_parser('sort', help="write all ten sorted files")
+    sort.add_argument('--workers', type=int, default=None, help="worker processes for the in-memory sort")
+    sort.add_argument('--shards', type=int, default=None, metavar='N',
+                      help="split the books into N shards by ISBN hash and sort each in its own worker process")
+    sort.add_argument('--by', type=parse_sort_spec, default=None, metavar='SPEC',
+                      help="write one file sorted by several attributes, e.g. author,date_of_publication,title:desc")
+    sort.add_argument('--external', action='store_true', help="sort out of core, for catalogues larger than memory")
+    sort.add_argument('--memory-budget', type=int, default=external_sort.DEFAULT_MEMORY_BUDGET)
+    sort.add_argument('--fan-in', type=int, default=external_sort.DEFAULT_FAN_IN)
+    search = commands.add_parser('search', help="look a book up in the catalogue")
+    search.add_argument('term')
+    search.add_argument('--attribute', type=parse_attribute, default=book_keys.isbn)
+    find = commands.add_parser('find', help="ranked, typo-tolerant search of titles and authors")
+    find.add_argument('query')
+    find.add_argument('--attribute', type=parse_attribute, default=None, help="title or author (default: both)")
+    find.add_argument('--limit', type=int, default=main.DEFAULT_TEXT_LIMIT)
+    top = commands.add_parser('top', help="the first K books by an attribute, longest/newest first by default")
+    top.add_argument('attribute', type=parse_attribute)
+    top.add_argument('k', type=int)
+    top.add_argument('--asc', action='store_true', help="smallest/oldest first")
+    quantile = commands.add_parser('quantile', help="values at fractions of the way through the sorted books")
+    quantile.add_argument('attribute', type=parse_attribute)
+    quantile.add_argument('fractions', type=float, nargs='+', metavar='FRACTION')
+    group = commands.add_parser('group', help="aggregate an attribute per author, title, etc")
+    group.add_argument('attribute', type=parse_attribute)
+    group.add_argument('--value', type=parse_attribute, default=book_keys.length, help="attribute to aggregate (default: length)")
+    group.add_argument('--aggregates', type=lambda text: text.split(','), default=None,
+                       help=f"comma separated, from {','.join(queries.aggregates)}")
+    add = commands.add_parser('add', help="add one book")
+    add.add_argument('book', nargs=5, metavar=('ISBN', 'TITLE', 'AUTHOR', 'LENGTH', 'DATE'))
+    delete = commands.add_parser('delete', help="delete one book by ISBN")
+    delete.add_argument('isbn')
+    batch = commands.add_parser('batch', help="apply a file of adds, deletes and searches")
+    batch.add_argument('file')
+    for command in (add, delete, batch):
+        command.add_argument('--save', action='store_true', help="fold the logged changes back into --source")
+    return parser
+
+
+def run(argv=None):
+    '''
+    @param argv: list of command-line arguments, defaults to sys.argv[1:]
+    @return status: int exit status
+    '''
+    args = build_parser().parse_args(argv)
+    main.set_backend(args.backend)
+    log = lambda line: print(line, file=sys.stderr)
+    if args.metrics or args.metrics_interval:
+        instrumentation.enable()
+    if args.metrics_interval:
+        instrumentation.start_periodic_log(args.metrics_interval, log)
+    try:
+        if args.profile is not None:
+            return instrumentation.profile(run_command, args, output_file=args.profile, log=log)
+        return run_command(args)
+    finally:
+        instrumentation.stop_periodic_log()
+        if instrumentation.enabled:
+            log(instrumentation.format_snapshot())
+
+
+def run_command(args):
+    '''
+    @param args: argparse.Namespace from build_parser
+    @return status: int exit status
+    '''
+    if args.command == 'sort':
+        if args.external:
+            for attribute in book_keys.attributes:
+                for order in (main.asc, main.desc):
+                    main.sort_books_external(attribute, order, args.source, args.memory_budget, args.fan_in)
+        elif args.shards is not None:
+            load_books(args.source, not args.no_snapshot)
+            catalogue = shards.ShardedCatalogue.from_store(main.book_data, args.shards, main.wal)
+            catalogue.rebuild(workers=args.workers)
+            catalogue.write_views(main.write_data_to_csv)
+        elif args.by is not None:
+            load_books(args.source, not args.no_snapshot)
+            main.sort_books_by(args.by)
+        else:
+            load_books(args.source, not args.no_snapshot)
+            main.sort_all_books(workers=args.workers)
+        return 0
+    load_books(args.source, not args.no_snapshot)
+    if args.command == 'search':
+        # answered from the loaded store, so adds and deletes still only in the log are seen
+        result, err_msg = main.search_for_book(args.term, args.attribute)
+        if result is None:
+            print(err_msg, file=sys.stderr)
+            return 1
+        csv.writer(sys.stdout).writerow(result)
+        return 0
+    if args.command == 'find':
+        attributes = (book_keys.title, book_keys.author) if args.attribute is None else (args.attribute,)
+        if not set(attributes) <= {book_keys.title, book_keys.author}:
+            print("find only searches title and author", file=sys.stderr)
+            return 1
+        writer = csv.writer(sys.stdout)
+        for score, book in main.search_books_by_text(args.query, attributes, args.limit):
+            writer.writerow([f'{score:.3f}'] + book)
+        return 0
+    if args.command in ('top', 'quantile', 'group'):
+        return run_query(args)
+    if args.command == 'add':
+        operations = [(1, 'add', args.book)]
+    elif args.command == 'delete':
+        operations = [(1, 'delete', [args.isbn])]
+    else:
+        operations = read_batch(args.file)
+    return 1 if run_batch(operations, args.source if args.save else None) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(run())
@@ -0,0 +1,211 @@
+'''
+External merge sort for catalogues larger than memory. The source CSV
+is read in runs that fit a memory budget, each run is sorted with the
+sort engine and spilled to a temporary file, and the runs are combined
+with a k-way heap merge, in several passes if there are more runs than
+the fan-in allows. Ties keep their order in the source file. Rows are
+written in the normalized form load_book_store stores and duplicate
+ISBNs follow the same policy, first found with a Bloom filter pass
+over the source, so the output matches what sort_all_books writes
+after loading the same file
+'''
+import csv
+import heapq
+import os
+import tempfile
+import sort_engine
+import book_keys
+import journal
+import instrumentation
+import normalize
+import view_index
+from book_keys import isbn
+from ingest import parse_row
+from views import desc
+
+DEFAULT_MEMORY_BUDGET = 256 * 1024 * 1024
+DEFAULT_FAN_IN = 16
+# rough per-book cost in memory beyond the text itself (list, five str objects, key and index):
+ROW_OVERHEAD_BYTES = 400
+
+
+def write_rows(rows, output_file):
+    '''
+    Writes rows to a CSV file in the same format as write_data_to_csv
+
+    @param rows: iterable of lists of str
+    @param output_file: file path to write to
+    '''
+    with open(output_file, mode='w', newline='') as file:
+        writer = csv.writer(file)
+        for row in rows:
+            writer.writerow(row)
+        if instrumentation.enabled:
+            instrumentation.count('io.bytes_written', file.tell())
+
+
+def read_rows(filename):
+    '''
+    @param filename: file path of a CSV run file
+    @return rows: generator of lists of str
+    '''
+    if instrumentation.enabled:
+        instrumentation.count('io.bytes_read', os.path.getsize(filename))
+    with open(filename, 'r', newline='') as file:
+        for row in csv.reader(file):
+            yield row
+
+
+def duplicate_candidates(source):
+    '''
+    Streams the ISBNs of the source through a Bloom filter. Every ISBN
+    that appears more than once is flagged, along with a few false
+    positives, so only the flagged ISBNs need to be held to find the
+    duplicates exactly while the runs are read
+
+    @param source: file path of the unsorted CSV
+    @return candidates: set of int ISBNs that may appear more than once
+    '''
+    size = os.path.getsize(source)
+    if instrumentation.enabled:
+        instrumentation.count('io.bytes_read', size)
+    seen = normalize.BloomFilter(size // normalize.ROW_BYTES_ESTIMATE)
+    candidates = set()
+    with open(source, 'r', newline='') as csvfile:
+        for row in csv.reader(csvfile):
+            if len(row) > isbn:
+                try:
+                    isbn_value = normalize.canonical_isbn(row[isbn].strip(), normalize.lenient)
+                except ValueError:
+                    continue
+                if seen.add(isbn_value):
+                    candidates.add(isbn_value)
+    return candidates
+
+
+def spill_runs(source, attribute, order, memory_budget, temp_dir, errors=None, duplicates=normalize.merge):
+    '''
+    Reads the source CSV in runs of at most memory_budget estimated bytes,
+    sorts each run and writes it to its own temporary file
+
+    @param source: file path of the unsorted CSV
+    @param attribute: book attribute (e.g. author/title/etc)
+    @param order: str value of either asc/desc
+    @param memory_budget: int bytes a run may use
+    @param temp_dir: directory for the run files
+    @param errors: list that (line number, message) tuples are appended to, or None
+    @param duplicates: str normalize.merge/reject/allow, as for ingest.load_book_store
+    @return run_files: list of file paths, in source order
+    @raise ValueError: raises an exception for a duplicate ISBN when duplicates is normalize.reject
+    '''
+    candidates = set() if duplicates == normalize.allow else duplicate_candidates(source)
+    # the flagged ISBNs already written, so their later copies are known to be duplicates
+    kept = set()
+    run_files = []
+    rows, keys, run_bytes = [], [], 0
+
+    def spill():
+        permutation = sort_engine.sort_permutation(
+            keys, reverse=(order == desc), fixed_width=attribute in book_keys.FIXED_WIDTH_ATTRIBUTES)
+        handle, run_file = tempfile.mkstemp(suffix='.csv', prefix='run_', dir=temp_dir)
+        os.close(handle)
+        write_rows((rows[i] for i in permutation), run_file)
+        run_files.append(run_file)
+
+    if instrumentation.enabled:
+        instrumentation.count('io.bytes_read', os.path.getsize(source))
+    with open(source, 'r', newline='') as csvfile:
+        reader = csv.reader(csvfile)
+        line_number = 1
+        for row in reader:
+            if row:
+                try:
+                    record = parse_row(row)
+                except ValueError as e:
+                    if errors is not None:
+                        errors.append((line_number, str(e)))
+                else:
+                    if record[isbn] in kept:
+                        if duplicates == normalize.reject:
+                            raise ValueError(f"Line {line_number}: duplicate ISBN {record[isbn]}.")
+                        if errors is not None:
+                            errors.append((line_number, f"duplicate ISBN {record[isbn]}, merged into the first copy"))
+                    else:
+                        if record[isbn] in candidates:
+                            kept.add(record[isbn])
+                        row = normalize.format_record(record)
+                        rows.append(row)
+                        # parse_row returns the same typed keys book_keys derives
+                        keys.append(record[attribute])
+                        run_bytes += sum(len(field) for field in row) + ROW_OVERHEAD_BYTES
+                        if run_bytes >= memory_budget:
+                            spill()
+                            rows, keys, run_bytes = [], [], 0
+            line_number = 1 + reader.line_num
+    if rows:
+        spill()
+    return run_files
+
+
+def merge_runs(run_files, attribute, order, output_file):
+    '''
+    k-way heap merge of sorted run files into output_file. When keys are
+    equal, rows from earlier runs come first, which keeps the sort stable
+
+    @param run_files: list of file paths of sorted runs, in source order
+    @param attribute: book attribute (e.g. author/title/etc)
+    @param order: str value of either asc/desc
+    @param output_file: file path to write to
+    '''
+    column_key = book_keys.get_key_function(attribute)
+    merged = heapq.merge(*(read_rows(run_file) for run_file in run_files),
+                         key=lambda row: column_key(row[attribute]), reverse=(order == desc))
+    write_rows(merged, output_file)
+
+
+def external_sort(source, attribute, order, output_file, memory_budget=DEFAULT_MEMORY_BUDGET,
+                  fan_in=DEFAULT_FAN_IN, temp_dir=None, duplicates=normalize.merge):
+    '''
+    Sorts a CSV file that may not fit in memory
+
+    @param source: file path of the unsorted CSV
+    @param attribute: book attribute (e.g. author/title/etc)
+    @param order: str value of either asc/desc
+    @param output_file: file path the sorted CSV is written to
+    @param memory_budget: int approximate bytes of book data held in memory at once
+    @param fan_in: int maximum number of runs merged at once (at least 2)
+    @param temp_dir: directory for run files, defaults to the system temp directory
+    @param duplicates: str normalize.merge/reject/allow, as for ingest.load_book_store
+    @return errors: list of (line number, message) for skipped malformed and duplicate rows
+    @raise ValueError: raises an exception if fan_in is less than 2, or for a duplicate
+    ISBN when duplicates is normalize.reject
+    '''
+    if fan_in < 2:
+        raise ValueError("The merge fan-in must be at least 2.")
+    errors = []
+    with tempfile.TemporaryDirectory(dir=temp_dir) as work_dir:
+        runs = spill_runs(source, attribute, order, memory_budget, work_dir, errors, duplicates)
+        # merges adjacent groups of runs until one final merge is enough
+        while len(runs) > fan_in:
+            merged_runs = []
+            for start in range(0, len(runs), fan_in):
+                group = runs[start:start + fan_in]
+                handle, merged_file = tempfile.mkstemp(suffix='.csv', prefix='run_', dir=work_dir)
+                os.close(handle)
+                merge_runs(group, attribute, order, merged_file)
+                for run_file in group:
+                    os.remove(run_file)
+                merged_runs.append(merged_file)
+            runs = merged_runs
+        # the final merge is renamed into place so readers never see a partial file
+        temp_file = journal.temp_filename(output_file)
+        try:
+            merge_runs(runs, attribute, order, temp_file)
+            sidecar_file = view_index.get_sidecar_filename(output_file)
+            if os.path.exists(sidecar_file):
+                os.remove(sidecar_file)
+            os.replace(temp_file, output_file)
+        finally:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+    return errors
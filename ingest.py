@@ -0,0 +1,252 @@
+'''
+Streaming CSV ingest. Rows are parsed and validated into typed records
+(isbn int, title, author, length int, date ordinal int) and yielded in
+batches, so memory is bounded by the batch size rather than the file
+size. Large files can be split on line boundaries and parsed on a
+process pool. Malformed rows are reported with their line number and
+skipped instead of failing the whole load. Rows go through the
+normalize stage, so ISBN-10s are stored as ISBN-13s, and copies of an
+ISBN already loaded are merged into the first one
+'''
+import csv
+import io
+import os
+from concurrent.futures import ProcessPoolExecutor
+from book_keys import isbn
+import instrumentation
+import normalize
+from book_store import BookStore
+
+DEFAULT_BATCH_SIZE = 10000
+# files are split into chunks of about this many bytes for parallel parsing:
+DEFAULT_CHUNK_BYTES = 64 * 1024 * 1024
+
+
+def parse_row(row, check_digits=normalize.lenient):
+    '''
+    Parses and validates one CSV row
+
+    @param row: list of str fields from csv.reader
+    @param check_digits: str normalize.strict/lenient, lenient keeps ISBNs with a wrong check digit
+    @return record: tuple (isbn int, title str, author str, length int, date ordinal int)
+    @raise ValueError: raises an exception describing what is wrong with the row
+    '''
+    return normalize.parse_book(row, check_digits)
+
+
+def parse_lines(lines, first_line_number=1, errors=None, check_digits=normalize.lenient):
+    '''
+    Parses CSV lines into typed records, skipping malformed rows
+
+    @param lines: iterable of str lines
+    @param first_line_number: int line number of the first line, used in error reports
+    @param errors: list that (line number, message) tuples are appended to, or None to ignore them
+    @param check_digits: str normalize.strict/lenient
+    @return records: generator of (line number, typed record) pairs
+    '''
+    reader = csv.reader(lines)
+    line_number = first_line_number
+    for row in reader:
+        # blank lines are skipped rather than reported
+        if row:
+            try:
+                record = parse_row(row, check_digits)
+            except ValueError as e:
+                if errors is not None:
+                    errors.append((line_number, str(e)))
+            else:
+                yield line_number, record
+        line_number = first_line_number + reader.line_num
+
+
+def iter_record_batches(filename, batch_size=DEFAULT_BATCH_SIZE, errors=None, check_digits=normalize.lenient):
+    '''
+    Streams a CSV file as lists of at most batch_size typed records
+
+    @param filename: file path of CSV file
+    @param batch_size: int maximum number of records per batch
+    @param errors: list that (line number, message) tuples are appended to, or None
+    @param check_digits: str normalize.strict/lenient
+    @return batches: generator of lists of (line number, typed record) pairs
+    '''
+    batch = []
+    with open(filename, 'r', newline='') as csvfile:
+        for item in parse_lines(csvfile, errors=errors, check_digits=check_digits):
+            batch.append(item)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+def find_chunk_boundaries(filename, chunk_bytes=DEFAULT_CHUNK_BYTES):
+    '''
+    Splits a file into byte ranges that start and end on line boundaries.
+    Assumes no field contains an embedded newline
+
+    @param filename: file path of CSV file
+    @param chunk_bytes: int approximate size of each chunk
+    @return boundaries: list of (start, end) byte offsets
+    '''
+    size = os.path.getsize(filename)
+    boundaries = []
+    with open(filename, 'rb') as file:
+        start = 0
+        while start < size:
+            file.seek(min(start + chunk_bytes, size))
+            # finish the line the seek landed in
+            file.readline()
+            end = min(file.tell(), size)
+            boundaries.append((start, end))
+            start = end
+    return boundaries
+
+
+def parse_chunk(filename, start, end, check_digits=normalize.lenient):
+    '''
+    Parses the byte range [start, end) of a CSV file. Runs in a worker process
+
+    @param filename: file path of CSV file
+    @param start: int byte offset of the first line
+    @param end: int byte offset after the last line
+    @param check_digits: str normalize.strict/lenient
+    @return records, errors, line_count: (chunk-relative line number, typed record) pairs,
+    (chunk-relative line number, message) tuples and the number of lines in the chunk
+    '''
+    with open(filename, 'rb') as file:
+        file.seek(start)
+        text = file.read(end - start).decode('utf-8')
+    errors = []
+    records = list(parse_lines(io.StringIO(text, newline=''), errors=errors, check_digits=check_digits))
+    line_count = text.count('\n') + (0 if text.endswith('\n') or not text else 1)
+    return records, errors, line_count
+
+
+def iter_parallel_batches(filename, workers=None, chunk_bytes=DEFAULT_CHUNK_BYTES, errors=None,
+                          check_digits=normalize.lenient):
+    '''
+    Parses a CSV file in line-aligned chunks on a process pool, yielding
+    each chunk's records in file order. At most two chunks per worker are
+    in flight, so memory is bounded by the chunk size
+
+    @param filename: file path of CSV file
+    @param workers: int number of worker processes, defaults to the CPU count
+    @param chunk_bytes: int approximate size of each chunk
+    @param errors: list that (line number, message) tuples are appended to, or None
+    @param check_digits: str normalize.strict/lenient
+    @return batches: generator of lists of (line number, typed record) pairs
+    '''
+    workers = workers or os.cpu_count() or 1
+    boundaries = find_chunk_boundaries(filename, chunk_bytes)
+    lines_before = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = []
+        next_chunk = 0
+        while pending or next_chunk < len(boundaries):
+            while next_chunk < len(boundaries) and len(pending) < 2 * workers:
+                start, end = boundaries[next_chunk]
+                pending.append(executor.submit(parse_chunk, filename, start, end, check_digits))
+                next_chunk += 1
+            records, chunk_errors, line_count = pending.pop(0).result()
+            if errors is not None:
+                errors.extend((lines_before + line_number, message) for line_number, message in chunk_errors)
+            yield [(lines_before + line_number, record) for line_number, record in records]
+            lines_before += line_count
+
+
+def rejected_rows(filename, check_digits=normalize.lenient, duplicates=normalize.merge):
+    '''
+    Finds the rows load_book_store skips, so a rewrite of the file can keep them
+
+    @param filename: file path of CSV file
+    @param check_digits: str normalize.strict/lenient, as for load_book_store
+    @param duplicates: str normalize.merge/reject/allow, as for load_book_store
+    @return rows: list of (fields, isbn) pairs in file order, isbn being the int ISBN
+    of a duplicate row or None for a malformed one
+    '''
+    rows = []
+    seen = set()
+    with open(filename, 'r', newline='') as csvfile:
+        for row in csv.reader(csvfile):
+            if not row:
+                continue
+            try:
+                record = parse_row(row, check_digits)
+            except ValueError:
+                rows.append((row, None))
+                continue
+            if duplicates != normalize.allow:
+                if record[isbn] in seen:
+                    rows.append((row, record[isbn]))
+                seen.add(record[isbn])
+    return rows
+
+
+def merge_duplicates(store, candidates, errors, duplicates=normalize.merge):
+    '''
+    Confirms the duplicates the Bloom filter flagged. Only the flagged
+    ISBNs are looked up, in one pass over the ISBN column, so the load
+    never holds a set of every ISBN
+
+    @param store: BookStore holding the loaded books
+    @param candidates: list of (row id, line number) of books whose ISBN may have been loaded before
+    @param errors: list that (line number, message) tuples are appended to
+    @param duplicates: str normalize.merge to drop later copies, normalize.reject to fail the load
+    @raise ValueError: raises an exception for a duplicate ISBN when duplicates is normalize.reject
+    '''
+    wanted = {store.isbns[row_id] for row_id, line_number in candidates}
+    first_rows = {}
+    for row_id, isbn_value in enumerate(store.isbns):
+        if isbn_value in wanted:
+            first_rows.setdefault(isbn_value, row_id)
+    for row_id, line_number in candidates:
+        isbn_value = store.isbns[row_id]
+        if first_rows[isbn_value] == row_id:
+            # a false positive of the Bloom filter
+            continue
+        if duplicates == normalize.reject:
+            raise ValueError(f"Line {line_number}: duplicate ISBN {isbn_value}.")
+        errors.append((line_number, f"duplicate ISBN {isbn_value}, merged into the first copy"))
+        store.delete(row_id)
+    errors.sort()
+    store.compact()
+
+
+@instrumentation.timed('load_book_store')
+def load_book_store(filename, workers=1, batch_size=DEFAULT_BATCH_SIZE, chunk_bytes=DEFAULT_CHUNK_BYTES,
+                    check_digits=normalize.lenient, duplicates=normalize.merge):
+    '''
+    Loads a CSV file into a BookStore without holding the parsed file in memory.
+    Check digits are not enforced by default, since catalogues predating the
+    normalize stage hold ISBNs with wrong ones
+
+    @param filename: file path of CSV file
+    @param workers: int number of worker processes, 1 parses in this process
+    @param batch_size: int records per batch when parsing in this process
+    @param chunk_bytes: int approximate chunk size when parsing on a process pool
+    @param check_digits: str normalize.strict to skip rows whose ISBN has a wrong check digit
+    @param duplicates: str normalize.merge keeps the first book with an ISBN and reports the
+    rest, normalize.reject fails the load and normalize.allow keeps every copy
+    @return store, errors: BookStore and a list of (line number, message) for skipped rows
+    @raise ValueError: raises an exception for a duplicate ISBN when duplicates is normalize.reject
+    '''
+    errors = []
+    size = os.path.getsize(filename)
+    if instrumentation.enabled:
+        instrumentation.count('io.bytes_read', size)
+    if workers > 1:
+        batches = iter_parallel_batches(filename, workers, chunk_bytes, errors, check_digits)
+    else:
+        batches = iter_record_batches(filename, batch_size, errors, check_digits)
+    store = BookStore()
+    seen = None if duplicates == normalize.allow else normalize.BloomFilter(size // normalize.ROW_BYTES_ESTIMATE)
+    candidates = []
+    for batch in batches:
+        for line_number, record in batch:
+            row_id = store.append_record(record)
+            if seen is not None and seen.add(record[isbn]):
+                candidates.append((row_id, line_number))
+    if candidates:
+        merge_duplicates(store, candidates, errors, duplicates)
+    return store, errors
@@ -0,0 +1,251 @@
+'''
+Opt-in metrics for the core operations: latency histograms per
+operation, comparison and move counts inside the sort engine, hit and
+miss counts per search source and bytes read and written by the CSV
+and index I/O. Everything is off by default; instrumented code checks
+the module-level enabled flag once per operation or I/O call, never
+inside a sort loop, so the disabled cost is a single attribute lookup.
+Work done in worker processes (e.g. parallel view building) is not counted
+'''
+import cProfile
+import functools
+import io
+import pstats
+import threading
+import time
+from collections import defaultdict
+
+enabled = False
+# latency histogram buckets are powers of two, starting at one microsecond:
+FIRST_BUCKET_SECONDS = 1e-6
+BUCKET_COUNT = 32
+DEFAULT_LOG_INTERVAL = 60.0
+
+counters = defaultdict(int)
+histograms = {}
+lock = threading.Lock()
+log_stop = None
+
+
+class Histogram:
+    '''
+    Latency histogram with logarithmic buckets, so it stays a fixed size
+    however many operations are recorded
+    '''
+
+    def __init__(self):
+        self.buckets = [0] * BUCKET_COUNT
+        self.count = 0
+        self.total = 0.0
+        self.smallest = None
+        self.largest = None
+
+    def record(self, seconds):
+        bucket = 0
+        bound = FIRST_BUCKET_SECONDS
+        while seconds > bound and bucket < BUCKET_COUNT - 1:
+            bound *= 2
+            bucket += 1
+        self.buckets[bucket] += 1
+        self.count += 1
+        self.total += seconds
+        self.smallest = seconds if self.smallest is None else min(self.smallest, seconds)
+        self.largest = seconds if self.largest is None else max(self.largest, seconds)
+
+    def quantile(self, fraction):
+        '''
+        @param fraction: float between 0 and 1, e.g. 0.99
+        @return seconds: float upper bound of the bucket holding that quantile
+        '''
+        target = fraction * self.count
+        seen = 0
+        for bucket, bucket_count in enumerate(self.buckets):
+            seen += bucket_count
+            if bucket_count and seen >= target:
+                return min(FIRST_BUCKET_SECONDS * 2 ** bucket, self.largest)
+        return self.largest
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'total_seconds': self.total,
+            'mean_seconds': self.total / self.count if self.count else None,
+            'min_seconds': self.smallest,
+            'max_seconds': self.largest,
+            'p50_seconds': self.quantile(0.5),
+            'p90_seconds': self.quantile(0.9),
+            'p99_seconds': self.quantile(0.99),
+        }
+
+
+def enable():
+    global enabled
+    enabled = True
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def reset():
+    with lock:
+        counters.clear()
+        histograms.clear()
+
+
+def count(name, amount=1):
+    '''
+    Adds to a counter. Callers check enabled first, so this is only
+    called when instrumentation is on
+
+    @param name: str counter name, e.g. 'search.isbn_index.hit'
+    @param amount: int to add
+    '''
+    with lock:
+        counters[name] += amount
+
+
+def record_latency(name, seconds):
+    with lock:
+        histogram = histograms.get(name)
+        if histogram is None:
+            histogram = histograms[name] = Histogram()
+        histogram.record(seconds)
+
+
+def timed(name):
+    '''
+    Decorator recording the latency of every call of a function in the
+    histogram called name, while instrumentation is enabled
+
+    @param name: str operation name, e.g. 'sort_all_books'
+    '''
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return fn(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                record_latency(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+class CountingKey:
+    '''
+    Wraps a sort key and counts every comparison made with it. The sort
+    engine only wraps its keys this way while instrumentation is enabled
+    '''
+    __slots__ = ('key', 'tally')
+
+    def __init__(self, key, tally):
+        self.key = key
+        self.tally = tally
+
+    def __lt__(self, other):
+        self.tally[0] += 1
+        return self.key < other.key
+
+    def __gt__(self, other):
+        self.tally[0] += 1
+        return self.key > other.key
+
+    def __eq__(self, other):
+        self.tally[0] += 1
+        return self.key == other.key
+
+    __hash__ = None
+
+
+class CountingList(list):
+    '''
+    List of row indexes that counts element writes, i.e. the moves a
+    sort makes (a swap is two moves)
+    '''
+
+    def __init__(self, items):
+        super().__init__(items)
+        self.moves = 0
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            self.moves += len(value)
+        else:
+            self.moves += 1
+        super().__setitem__(index, value)
+
+
+def snapshot():
+    '''
+    @return metrics: dict with the 'counters' and a summary of each 'latency' histogram
+    '''
+    with lock:
+        return {
+            'counters': dict(counters),
+            'latency': {name: histogram.snapshot() for name, histogram in histograms.items()},
+        }
+
+
+def format_snapshot(metrics=None):
+    '''
+    @param metrics: dict from snapshot, or None to take one now
+    @return line: str one-line summary for a log
+    '''
+    metrics = snapshot() if metrics is None else metrics
+    parts = [f"{name}={value}" for name, value in sorted(metrics['counters'].items())]
+    for name, latency in sorted(metrics['latency'].items()):
+        parts.append(f"{name}: n={latency['count']} mean={latency['mean_seconds'] * 1000:.2f}ms "
+                     f"p99={latency['p99_seconds'] * 1000:.2f}ms")
+    return "metrics: " + ("; ".join(parts) if parts else "nothing recorded")
+
+
+def start_periodic_log(interval=DEFAULT_LOG_INTERVAL, log=print):
+    '''
+    Logs a one-line metrics summary every interval seconds from a daemon thread
+
+    @param interval: float seconds between log lines
+    @param log: function called with each line
+    '''
+    global log_stop
+    stop_periodic_log()
+    log_stop = threading.Event()
+
+    def run(stop):
+        while not stop.wait(interval):
+            log(format_snapshot())
+
+    threading.Thread(target=run, args=(log_stop,), name="MetricsLog", daemon=True).start()
+
+
+def stop_periodic_log():
+    global log_stop
+    if log_stop is not None:
+        log_stop.set()
+        log_stop = None
+
+
+def profile(fn, *args, output_file=None, sort='cumulative', limit=25, log=print, **kwargs):
+    '''
+    Runs fn(*args, **kwargs) under cProfile, whether or not instrumentation is enabled
+
+    @param fn: function to profile
+    @param output_file: file path to dump the raw stats to (for pstats/snakeviz), or None
+    @param sort: str pstats sort order of the printed report
+    @param limit: int number of functions in the printed report
+    @param log: function called with the report, or None to skip it
+    @return result: fn's return value
+    '''
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(fn, *args, **kwargs)
+    finally:
+        if output_file is not None:
+            profiler.dump_stats(output_file)
+        if log is not None:
+            report = io.StringIO()
+            pstats.Stats(profiler, stream=report).sort_stats(sort).print_stats(limit)
+            log(report.getvalue())
@@ -0,0 +1,219 @@
+'''
+Crash safety for the files under data/. Adds and deletes are appended
+to a write-ahead log, one fsynced line each, before any sorted file is
+rewritten, and replayed over the catalogue on the next start. Sorted
+files are written to a temporary file and renamed into place, so a
+reader sees either the old file or the new one, and a small manifest
+records the log generation each sorted file reflects, so files left
+behind by an interrupted rebuild are recognised as stale
+'''
+import copy
+import csv
+import io
+import json
+import os
+import instrumentation
+
+WAL_FILENAME = 'data/journal.wal'
+MANIFEST_FILENAME = 'data/manifest.json'
+ENCODING = 'utf-8'
+# record types in the log:
+add_record = 'A'
+delete_record = 'D'
+# parsed manifests by file path, with the (size, mtime, inode) they were read at:
+manifest_cache = {}
+
+
+def temp_filename(output_file):
+    '''
+    @param output_file: file path about to be replaced
+    @return temp_file: str file path to write the new contents to first
+    '''
+    return output_file + '.tmp'
+
+
+def sync(file):
+    '''
+    Flushes an open file all the way to disk
+    '''
+    file.flush()
+    os.fsync(file.fileno())
+
+
+def write_atomically(output_file, text):
+    '''
+    Replaces output_file with text without a reader ever seeing a partial file
+
+    @param output_file: file path to write to
+    @param text: str new contents
+    '''
+    temp_file = temp_filename(output_file)
+    with open(temp_file, 'w', encoding=ENCODING, newline='') as file:
+        file.write(text)
+        sync(file)
+    os.replace(temp_file, output_file)
+
+
+def read_manifest(filename=MANIFEST_FILENAME):
+    '''
+    @param filename: file path of the manifest
+    @return manifest: dict with the latest published 'generation', the
+    'checkpoint' generation already folded into the catalogue CSV and
+    the generation of each sorted file under 'views'
+    '''
+    try:
+        stat = os.stat(filename)
+    except FileNotFoundError:
+        return {'generation': 0, 'checkpoint': 0, 'views': {}}
+    # readers check the manifest on every search, so it is only parsed again once it changes
+    signature = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+    cached = manifest_cache.get(filename)
+    if cached is None or cached[0] != signature:
+        with open(filename, 'r', encoding=ENCODING) as file:
+            manifest = json.load(file)
+        manifest.setdefault('generation', 0)
+        manifest.setdefault('checkpoint', 0)
+        manifest.setdefault('views', {})
+        cached = manifest_cache[filename] = (signature, manifest)
+    return copy.deepcopy(cached[1])
+
+
+def write_manifest(manifest, filename=MANIFEST_FILENAME):
+    write_atomically(filename, json.dumps(manifest, indent=2, sort_keys=True))
+
+
+def record_view(output_file, generation, filename=MANIFEST_FILENAME):
+    '''
+    Records that a sorted file now reflects the given log generation.
+    Called after the file has been renamed into place
+
+    @param output_file: file path of the sorted CSV
+    @param generation: int log generation the file reflects
+    @param filename: file path of the manifest
+    '''
+    manifest = read_manifest(filename)
+    manifest['views'][output_file] = generation
+    manifest['generation'] = max(manifest['generation'], generation)
+    write_manifest(manifest, filename)
+
+
+def begin_checkpoint(generation, size, filename=MANIFEST_FILENAME):
+    '''
+    Records that the catalogue CSV is about to be replaced by one of the
+    given size holding every change up to generation
+    '''
+    manifest = read_manifest(filename)
+    manifest['pending_checkpoint'] = {'generation': generation, 'size': size}
+    write_manifest(manifest, filename)
+
+
+def end_checkpoint(generation, filename=MANIFEST_FILENAME):
+    manifest = read_manifest(filename)
+    manifest['checkpoint'] = generation
+    manifest.pop('pending_checkpoint', None)
+    write_manifest(manifest, filename)
+
+
+def get_checkpoint(source, filename=MANIFEST_FILENAME):
+    '''
+    @param source: file path of the catalogue CSV
+    @param filename: file path of the manifest
+    @return generation: int generation of the last change already in the catalogue
+    '''
+    manifest = read_manifest(filename)
+    pending = manifest.get('pending_checkpoint')
+    # a checkpoint interrupted after the catalogue was replaced still counts
+    if pending is not None and os.path.exists(source) and os.path.getsize(source) == pending['size']:
+        return pending['generation']
+    return manifest['checkpoint']
+
+
+def is_current(output_file, filename=MANIFEST_FILENAME):
+    '''
+    @param output_file: file path of a sorted CSV
+    @param filename: file path of the manifest
+    @return current: bool, False if the file is older than the latest published
+    generation. Without a manifest every file is taken to be current
+    '''
+    if not os.path.exists(filename):
+        return True
+    manifest = read_manifest(filename)
+    return manifest['views'].get(output_file) == manifest['generation']
+
+
+def read_log(filename=WAL_FILENAME):
+    '''
+    Reads the complete records of the log. A torn final line, from a crash
+    in the middle of an append, is ignored
+
+    @param filename: file path of the log
+    @return records: generator of (sequence int, record type, list of str fields)
+    '''
+    if not os.path.exists(filename):
+        return
+    with open(filename, 'rb') as file:
+        content = file.read()
+    text = content[:content.rfind(b'\n') + 1].decode(ENCODING)
+    for row in csv.reader(io.StringIO(text, newline='')):
+        if row:
+            yield int(row[0]), row[1], row[2:]
+
+
+class WriteAheadLog:
+    '''
+    Append-only log of the adds and deletes made since the last checkpoint.
+    Every record carries a sequence number, the generation, which keeps
+    growing across checkpoints
+    '''
+
+    def __init__(self, filename=WAL_FILENAME, generation=0):
+        '''
+        @param filename: file path of the log, created if missing
+        @param generation: int generation of the last record folded into the catalogue
+        '''
+        self.filename = filename
+        self.generation = generation
+        valid_bytes = 0
+        if os.path.exists(filename):
+            with open(filename, 'rb') as file:
+                content = file.read()
+            valid_bytes = content.rfind(b'\n') + 1
+            for sequence, record_type, fields in read_log(filename):
+                self.generation = max(self.generation, sequence)
+        self.file = open(filename, 'ab')
+        # drops a torn final record so the next append starts on a fresh line
+        self.file.truncate(valid_bytes)
+
+    def append(self, record_type, fields):
+        '''
+        Appends one record with a single write, and waits until it is on disk
+
+        @param record_type: str add_record/delete_record
+        @param fields: list of str
+        @return generation: int sequence number of the record
+        '''
+        line_buffer = io.StringIO()
+        csv.writer(line_buffer).writerow([self.generation + 1, record_type] + list(fields))
+        line = line_buffer.getvalue().encode(ENCODING)
+        self.file.write(line)
+        sync(self.file)
+        if instrumentation.enabled:
+            instrumentation.count('io.bytes_written', len(line))
+        self.generation += 1
+        return self.generation
+
+    def log_add(self, book):
+        return self.append(add_record, book)
+
+    def log_delete(self, isbn):
+        return self.append(delete_record, [isbn])
+
+    def truncate(self):
+        '''
+        Empties the log once its records have been folded into the catalogue
+        '''
+        self.file.truncate(0)
+        sync(self.file)
+
+    def close(self):
+        self.file.close()
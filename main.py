@@ -1,17 +1,58 @@
 import csv
 import os
-import tkinter as tk
-from tkinter import ttk
-
-book_data = []
-isbn = 0
-title = 1
-author = 2
-length = 3
-date_of_publication = 4
+import sort_engine
+import book_keys
+from views import build_views, build_composite_view, SortedView
+from book_store import BookStore
+import ingest
+from ingest import load_book_store
+import external_sort
+import view_index
+import journal
+import instrumentation
+import normalize
+import numpy_backend
+import snapshot
+from tasks import TaskRunner
+from view_cache import ViewCache
+from text_index import TextIndex, DEFAULT_LIMIT as DEFAULT_TEXT_LIMIT
+from book_keys import isbn, title, author, length, date_of_publication
+
+# BookStore holding the catalogue, loaded by launch_gui:
+book_data = BookStore()
 asc = 'asc'
 desc = 'desc'
-books_sorted = False
+# readiness of the sorted files, views and indexes:
+not_sorted = 'not sorted'
+sorting = 'sorting'
+ready = 'ready'
+index_state = not_sorted
+# status of each term returned by search_for_books:
+found = 'found'
+missing = 'missing'
+# ascending SortedView per attribute, kept up to date by add_book/delete_book:
+sorted_views = {}
+# primary key index from ISBN to the row ids of books with that ISBN, kept up to date by add_book/delete_book.
+# None until build_isbn_index has been called:
+isbn_index = None
+# full-text TextIndex per title/author, built on first use by get_text_index
+# and kept up to date by add_book/delete_book:
+text_indexes = {}
+# write-ahead log of adds and deletes, opened by open_catalogue:
+wal = None
+# catalogue CSV opened by open_catalogue and its size/mtime when it was read, for the snapshot:
+catalogue_source = None
+catalogue_signature = None
+# parsed sorted files, so repeated searches and display toggles do not re-read them:
+view_cache = ViewCache()
+# engine behind sort_books, sort_all_books, bulk searches and range searches, see set_backend:
+python_backend = 'python'
+vectorized_backend = 'numpy'
+backend = python_backend
+# rows shown at once on the display screen, and the pager feeding them:
+DISPLAY_PAGE_ROWS = 25
+view_pager = None
+display_top = 0
 
 
 def view_books(data):
@@ -40,26 +81,30 @@ def read_data_from_csv(filename):
             csvreader = csv.reader(csvfile)
             for row in csvreader:
                 data.append(row)
+        if instrumentation.enabled:
+            instrumentation.count('io.bytes_read', os.path.getsize(filename))
         return data
     except Exception as e:
         raise Exception(f"An error occurred while tyring to read the csv data: {e}")
 
 
-def write_data_to_csv(data, attribute, order):
+def write_data_to_csv(data, attribute, order, output_file=None):
     '''
-    Writes data from list to a CSV file
+    Writes data from list to a CSV file, together with the binary
+    sidecar index that search_for_book uses to search it without parsing it
 
     @param data: list with data to be exported to a CSV file
     @param attribute: which book attribute (e.g. author/title/etc) will be in filename
     @param order: which order (asc/desc/) will be in filename
+    @param output_file: file path to write instead of the one set_filename gives, e.g. for a composite sort
     @raise Exception: raises an exception
     '''
-    output_file = set_filename(attribute, order)
+    if output_file is None:
+        output_file = set_filename(attribute, order)
     try:
-        with open(output_file, mode='w', newline='') as file:
-            writer = csv.writer(file)
-            for row in data:
-                writer.writerow(row)
+        view_index.write_view(data, attribute, order, output_file)
+        view_cache.invalidate(attribute, order)
+        journal.record_view(output_file, current_generation())
         print("\nSUCCESS: New sorted data is available at: "+output_file+"\n")
     except Exception as e:
         print(f"An error occurred while tyring to write the csv data: {e}")
@@ -99,52 +144,125 @@ def set_filename(attribute, order):
     return output_file
 
 
-def sort_books(attribute, order):
+def set_composite_filename(sort_spec):
+    '''
+    Utility function to generate a filename for a composite sort, naming
+    each attribute and order the way set_filename does, e.g.
+    data/sorted_by_author_asc_date_of_publication_asc_title_asc_data.csv.
+    A spec of one attribute gives the same name as set_filename
+
+    @param sort_spec: list of (attribute, order) pairs, most significant first
+    @return outputfile: str of filename that will be written to
+    '''
+    value = '_'.join(get_attribute_name(attribute)+'_'+order for attribute, order in sort_spec)
+    output_file = 'data/sorted_by_'+value+'_data.csv'
+    return output_file
+
+
+def set_backend(name):
+    '''
+    Selects the engine used for sorting, bulk searches and range searches.
+    The numpy backend falls back to the pure Python one when NumPy is not
+    installed; both write identical sorted files
+
+    @param name: str python/numpy
+    @return backend: str name of the backend now in use
+    @raise ValueError: raises an exception for an unknown backend
+    '''
+    global backend
+    if name not in (python_backend, vectorized_backend):
+        raise ValueError(f"Unknown backend: {name}")
+    if name == vectorized_backend and not numpy_backend.load():
+        print("NumPy is not installed, using the python backend.")
+        name = python_backend
+    backend = name
+    return backend
+
+
+@instrumentation.timed('sort_books')
+def sort_books(attribute, order, strategy=sort_engine.DEFAULT_STRATEGY):
     '''
-    Iterative quicksort algorithm to sort books by attribute (e.g. author/title/etc)
-    and order (asc/desc)
+    Sorts books by attribute (e.g. author/title/etc) and order (asc/desc)
+    using the sort engine. The column is converted to typed keys once and
+    a permutation of row indexes is sorted on those keys. The strategy
+    defaults to radix sort for ISBN and date of publication and timsort
+    for everything else. The numpy backend ignores the strategy and uses
+    a stable argsort
 
     @attribute: int value representing inner list index where specific attribute is found (e.g. author/title/etc)
     @order: str value of either asc/desc which will dictate what order the sort will go in
-    @return book_data: list of lists containing sorted data 
+    @strategy: str name of sort engine strategy (lomuto/introsort/timsort/radix/auto)
+    @return sorted_books: list of lists containing sorted data 
     '''
     value = get_attribute_name(attribute)
     print("Sorting books by "+value+" in "+order+"ending order "+"...")
-    if calc_length(book_data) <= 1:
-        return book_data
-    # Create a stack for storing subarray indices
-    stack = [(0, calc_length(book_data) - 1)]  #
-    while stack:
-        low, high = stack.pop()
-        if low < high:
-            # selects pivot point from right-most element
-            if attribute == 3: 
-                pivot = int(book_data[high][attribute])
-            else:
-                pivot = book_data[high][attribute]
-            # initalise pointer that's smaller than the pivot:
-            i = low - 1
-            for j in range(low, high):
-                if attribute == 3: 
-                    if (order == 'asc' and int(book_data[j][attribute]) <= pivot) or (order == 'desc' and int(book_data[j][attribute]) >= pivot):
-                        i += 1
-                        # swaps elements:
-                        book_data[i], book_data[j] = book_data[j], book_data[i]
-                else:
-                    if (order == 'asc' and book_data[j][attribute] <= pivot) or (order == 'desc' and book_data[j][attribute] >= pivot):
-                        i += 1
-                        # swaps elements:
-                        book_data[i], book_data[j] = book_data[j], book_data[i]
-            book_data[i + 1], book_data[high] = book_data[high], book_data[i + 1]
-            stack.append((low, i))
-            stack.append((i + 2, high))
-    if attribute == 3:
-        for k in book_data:
-            k[attribute] = str(k[attribute])
-    write_data_to_csv(book_data, attribute, order)
-    global books_sorted
-    books_sorted = True
-    return book_data
+    if backend == vectorized_backend and isinstance(book_data, BookStore):
+        permutation = numpy_backend.sort_permutation(book_data, attribute, reverse=(order == desc))
+    else:
+        keys = book_keys.extract_keys(book_data, attribute)
+        permutation = sort_engine.sort_permutation(keys, reverse=(order == desc), strategy=strategy,
+                                                   fixed_width=attribute in book_keys.FIXED_WIDTH_ATTRIBUTES,
+                                                   items=book_keys.row_ids(book_data))
+    sorted_books = book_keys.apply_permutation(book_data, permutation)
+    write_data_to_csv(sorted_books, attribute, order)
+    global index_state
+    if index_state == not_sorted:
+        index_state = ready
+    return sorted_books
+
+
+@instrumentation.timed('sort_books_by')
+def sort_books_by(sort_spec, strategy=sort_engine.DEFAULT_STRATEGY):
+    '''
+    Sorts books by several attributes at once, e.g. by author, then date
+    of publication, then title for each author's books in order. Each
+    later attribute only breaks ties left by the earlier ones, and books
+    equal on all of them keep their order in the catalogue, so sorting
+    the same books again writes the same file
+
+    @param sort_spec: list of (attribute, order) pairs, most significant first
+    @param strategy: str name of sort engine strategy (lomuto/introsort/timsort/radix/auto)
+    @return sorted_books: list of lists containing sorted data
+    @raise ValueError: raises an exception for an empty spec or an unknown attribute or order
+    '''
+    print("Sorting books by "+", then ".join(get_attribute_name(attribute)+" in "+order+"ending order"
+                                            for attribute, order in sort_spec)+" ...")
+    if backend == vectorized_backend and isinstance(book_data, BookStore):
+        permutation = numpy_backend.composite_permutation(book_data, sort_spec)
+    else:
+        permutation = build_composite_view(book_data, sort_spec, strategy)
+    sorted_books = book_keys.apply_permutation(book_data, permutation)
+    attribute, order = sort_spec[0]
+    write_data_to_csv(sorted_books, attribute, order, set_composite_filename(sort_spec))
+    return sorted_books
+
+
+@instrumentation.timed('sort_books_external')
+def sort_books_external(attribute, order, source='library_data.csv',
+                        memory_budget=external_sort.DEFAULT_MEMORY_BUDGET, fan_in=external_sort.DEFAULT_FAN_IN):
+    '''
+    Sorts the source CSV by attribute and order without loading it into
+    memory, using an external merge sort, and writes the same sorted
+    CSV file that sort_books would
+
+    @attribute: int value representing inner list index where specific attribute is found (e.g. author/title/etc)
+    @order: str value of either asc/desc which will dictate what order the sort will go in
+    @source: file path of the unsorted CSV
+    @memory_budget: int approximate bytes of book data held in memory at once
+    @fan_in: int maximum number of sorted runs merged at once
+    @return output_file: str of filename that was written to
+    '''
+    value = get_attribute_name(attribute)
+    print("Sorting books by "+value+" in "+order+"ending order from "+source+" ...")
+    output_file = set_filename(attribute, order)
+    errors = external_sort.external_sort(source, attribute, order, output_file, memory_budget, fan_in)
+    view_cache.invalidate(attribute, order)
+    # the source CSV does not include changes still waiting in the log
+    journal.record_view(output_file, journal.read_manifest()['checkpoint'])
+    for line_number, message in errors:
+        print(f"Skipped line {line_number} of {source}: {message}")
+    print("\nSUCCESS: New sorted data is available at: "+output_file+"\n")
+    return output_file
 
 
 def check_sorted_books(attribute):
@@ -154,62 +272,507 @@ def check_sorted_books(attribute):
     value = get_attribute_name(attribute)
     attribute_found = False
     filename = ''
-    sorted_files = os.listdir('data')
-    for file in sorted_files:
-        '''
-        Returns data that's sorted by ascending order by default
-        '''
-        if (value in file) and ('asc' in file):
-            attribute_found = True
-            order = 'asc'
-            filename = 'data/'+file
-            break
+    # returns data that's sorted by ascending order by default. The name is known,
+    # so this is a stat of that file rather than a listing of data/
+    sorted_file = 'data/sorted_by_'+value+'_asc_data.csv'
+    # files older than the last published generation are left over from an interrupted rebuild
+    if os.path.exists(sorted_file) and journal.is_current(sorted_file):
+        attribute_found = True
+        order = 'asc'
+        filename = sorted_file
     return attribute_found, order, filename
         
 
+def current_generation():
+    '''
+    @return generation: int generation of the last add/delete logged, which
+    is what sorted files written now reflect
+    '''
+    if wal is not None:
+        return wal.generation
+    return journal.read_manifest()['generation']
+
+
+@instrumentation.timed('open_catalogue')
+def open_catalogue(source='library_data.csv', use_snapshot=True):
+    '''
+    Loads the catalogue, replays the adds and deletes logged since the last
+    checkpoint and opens the log for new ones. A snapshot saved from the
+    same source is loaded instead of the CSV, sorted views included, so
+    the books are searchable at once; the ISBN index is then built on
+    first use, and views changed by the replay are left dirty for
+    flush_sorted_views. Otherwise the CSV is parsed and the ISBN index built
+
+    @param source: file path of the catalogue CSV
+    @param use_snapshot: bool, False to always parse the CSV
+    @return load_errors: list of (line number, message) for skipped malformed rows
+    '''
+    global book_data
+    global wal
+    global sorted_views
+    global isbn_index
+    global index_state
+    global catalogue_source
+    global catalogue_signature
+    catalogue_source = source
+    catalogue_signature = snapshot.source_signature(source)
+    checkpoint = journal.get_checkpoint(source)
+    loaded = snapshot.load_snapshot(source) if use_snapshot else None
+    if loaded is not None:
+        book_data, sorted_views, generation = loaded
+        load_errors = []
+        isbn_index = None
+        index_state = ready
+        checkpoint = max(checkpoint, generation)
+    else:
+        book_data, load_errors = load_book_store(source)
+        build_isbn_index(book_data)
+        sorted_views = {}
+        index_state = not_sorted
+    text_indexes.clear()
+    for sequence, record_type, fields in journal.read_log():
+        if sequence <= checkpoint:
+            continue
+        if record_type == journal.add_record:
+            row_id = book_data.append(fields)
+            if isbn_index is not None:
+                isbn_index.setdefault(str(book_data.isbns[row_id]), []).append(row_id)
+            for view in sorted_views.values():
+                view.insert(row_id)
+        elif record_type == journal.delete_record:
+            if isbn_index is None:
+                build_isbn_index(book_data)
+            if isbn_index.get(fields[0]):
+                row_id = isbn_index[fields[0]].pop(0)
+                for view in sorted_views.values():
+                    view.remove(row_id)
+                book_data.delete(row_id)
+    if wal is not None:
+        wal.close()
+    wal = journal.WriteAheadLog(generation=checkpoint)
+    return load_errors
+
+
+@instrumentation.timed('checkpoint_catalogue')
+def checkpoint_catalogue(source='library_data.csv'):
+    '''
+    Folds the logged adds and deletes into the catalogue CSV, replacing it
+    atomically, and empties the log. Rows of the catalogue that were
+    skipped at load are not lost: malformed ones are kept at the end of
+    the file, and so are duplicate copies of an ISBN that is still in
+    the catalogue, which the next load merges again. Copies of an ISBN
+    that has been deleted are dropped with it
+
+    @param source: file path of the catalogue CSV
+    '''
+    global catalogue_signature
+    rejected = []
+    if source == catalogue_source and os.path.exists(source):
+        rejected = ingest.rejected_rows(source)
+    if rejected and isbn_index is None:
+        build_isbn_index(book_data)
+    kept = [row for row, isbn_value in rejected if isbn_value is None or isbn_index.get(str(isbn_value))]
+    temp_file = journal.temp_filename(source)
+    with open(temp_file, mode='w', newline='') as file:
+        writer = csv.writer(file)
+        for row in book_data:
+            writer.writerow(row)
+        writer.writerows(kept)
+        journal.sync(file)
+    if kept:
+        print(f"Kept {len(kept)} rows of {source} that could not be loaded at the end of the file.")
+    if len(rejected) > len(kept):
+        print(f"Dropped {len(rejected) - len(kept)} duplicate rows of {source} whose ISBN has been deleted.")
+    generation = current_generation()
+    # records the checkpoint as pending first, so a crash before the manifest
+    # is final can tell from the file size whether the new catalogue is in place
+    if instrumentation.enabled:
+        instrumentation.count('io.bytes_written', os.path.getsize(temp_file))
+    journal.begin_checkpoint(generation, os.path.getsize(temp_file))
+    os.replace(temp_file, source)
+    journal.end_checkpoint(generation)
+    if wal is not None:
+        wal.truncate()
+    if source == catalogue_source:
+        # the rewritten catalogue holds the books in memory, so the snapshot can follow it
+        catalogue_signature = snapshot.source_signature(source)
+        save_snapshot()
+
+
+def save_snapshot():
+    '''
+    Saves the books and sorted views as the binary snapshot that
+    open_catalogue loads on the next start. Only the catalogue opened by
+    open_catalogue is saved, once it has been sorted
+
+    @return saved: bool, False if there was nothing to save or it could not be written
+    '''
+    if catalogue_source is None or not sorted_views:
+        return False
+    try:
+        return snapshot.write_snapshot(book_data, sorted_views, current_generation(),
+                                       catalogue_source, catalogue_signature)
+    except OSError as e:
+        print(f"Could not save the catalogue snapshot: {e}")
+        return False
+
+
+def get_view_pager(attribute, order):
+    '''
+    Opens a sorted file for the display screen. A view already in the
+    view cache is paged from memory, so toggling between views does not
+    touch disk; any other is paged through its sidecar, which only maps
+    the index, so opening a view never reads the whole file
+
+    @param attribute: book attribute (e.g. author/title/etc)
+    @param order: str value of either asc/desc
+    @return pager: view_index.ViewPager
+    '''
+    filename = 'data/sorted_by_'+get_attribute_name(attribute)+'_'+order+'_data.csv'
+    rows = view_cache.cached(attribute, order, filename)
+    if rows is not None:
+        return view_index.ViewPager(len(rows), lambda start, stop: rows[start:stop])
+    return view_index.open_view_pager(filename)
+
+
+def warm_view_cache(attribute, order):
+    '''
+    Reads a sorted file into the view cache if it fits, so the next time
+    it is displayed or searched it is served from memory. Meant to run
+    on the task runner rather than the UI thread
+
+    @param attribute: book attribute (e.g. author/title/etc)
+    @param order: str value of either asc/desc
+    '''
+    filename = 'data/sorted_by_'+get_attribute_name(attribute)+'_'+order+'_data.csv'
+    if view_cache.fits(filename):
+        view_cache.get(attribute, order, filename)
+
+
+def get_text_index(attribute):
+    '''
+    Utility function to return the full-text index of title or author,
+    building it the first time it is needed
+
+    @param attribute: title or author
+    @return index: TextIndex over book_data
+    @raise ValueError: raises an exception for attributes that are not text
+    '''
+    text_index = text_indexes.get(attribute)
+    if text_index is None or text_index.store is not book_data:
+        text_index = text_indexes[attribute] = TextIndex(book_data, attribute)
+    return text_index
+
+
+@instrumentation.timed('search_books_by_text')
+def search_books_by_text(query, attributes=(title, author), limit=DEFAULT_TEXT_LIMIT):
+    '''
+    Ranked full-text search over titles and/or authors that tolerates
+    typos and partial words, e.g. 'harry poter' or 'tolkie'
+
+    @param query: str free text
+    @param attributes: title and/or author
+    @param limit: int maximum number of books returned
+    @return results: list of (score, book) tuples, best first
+    '''
+    matches = []
+    for attribute in attributes:
+        matches += get_text_index(attribute).search(query, limit)
+    # a book found by both its title and its author keeps its better score
+    best = {}
+    for score, row_id in matches:
+        best[row_id] = max(score, best.get(row_id, 0.0))
+    ranked = sorted(best.items(), key=lambda match: (-match[1], match[0]))[:limit]
+    return [(score, book_data.row(row_id)) for row_id, score in ranked]
+
+
+def build_isbn_index(book_data):
+    '''
+    Builds the in-memory ISBN index from the book data
+
+    @param book_data: BookStore containing unsorted book data
+    @return isbn_index: dict mapping ISBN to a list of row ids of books with that ISBN
+    '''
+    global isbn_index
+    isbn_index = {}
+    for row_id in book_data.live_row_ids():
+        isbn_index.setdefault(str(book_data.isbns[row_id]), []).append(row_id)
+    return isbn_index
+
+
+def get_sorted_view(attribute):
+    '''
+    Utility function to return the maintained ascending view of an attribute
+
+    @param attribute: book attribute (e.g. author/title/etc)
+    @return view: SortedView
+    @raise Exception: raises an exception if the books have not been sorted yet
+    '''
+    if attribute not in sorted_views:
+        raise Exception("Sort books before searching.")
+    return sorted_views[attribute]
+
+
+def find_books(attribute, low=None, high=None):
+    '''
+    Range search over a secondary index, e.g. length between 300 and 500
+    or date of publication between 1999-01-01 and 2005-12-31.
+    Bounds are inclusive and either may be left open
+
+    @param attribute: book attribute that is searched for
+    @param low: str lower bound, or None
+    @param high: str upper bound, or None
+    @return books: iterator over matching books in ascending order
+    '''
+    if backend == vectorized_backend:
+        return (book_data.row(row_id) for row_id in numpy_backend.filter_rows(book_data, attribute, low, high))
+    return get_sorted_view(attribute).between(low, high)
+
+
+def find_books_by_prefix(attribute, prefix):
+    '''
+    Prefix search over the title or author secondary index,
+    e.g. every title starting with 'Harry'
+
+    @param attribute: title or author
+    @param prefix: str the attribute must start with
+    @return books: iterator over matching books in ascending order
+    '''
+    return get_sorted_view(attribute).prefix(prefix)
+
+
+def find_books_equal_to(attribute, value):
+    '''
+    Exact-match search over a secondary index, e.g. all books by an author
+
+    @param attribute: book attribute that is searched for
+    @param value: str value to test for equality
+    @return books: iterator over matching books in view order
+    '''
+    return get_sorted_view(attribute).equal(value)
+
+
+def count_search(source, hits, lookups=1):
+    '''
+    Counts search hits and misses per source while instrumentation is enabled
+
+    @param source: str where the search was answered from, e.g. 'isbn_index'
+    @param hits: int lookups that found a book
+    @param lookups: int lookups made
+    '''
+    if instrumentation.enabled:
+        instrumentation.count(f'search.{source}.hit', hits)
+        instrumentation.count(f'search.{source}.miss', lookups - hits)
+
+
+@instrumentation.timed('search_for_book')
 def search_for_book(search_term, attribute):
     '''
-    Uses a binary search algorithm to go through
-    data sorted by ascending order to turn a search result
+    Looks ISBNs up in the ISBN index and other attributes up in their
+    sorted view. Before either is built, it uses a binary search algorithm
+    to go through data sorted by ascending order to turn a search result.
+    When several books match, the first one in ascending order is returned.
+    An ISBN-10 or hyphenated ISBN is looked up as its ISBN-13
 
     @param search_term: string value to test for equality
     @param attribute: book attribute that is searched for
     '''
+    if attribute == isbn:
+        search_term = normalize.isbn_search_term(search_term)
     try:
+        if attribute == isbn and isbn_index is not None:
+            matches = isbn_index.get(search_term)
+            count_search('isbn_index', int(bool(matches)))
+            if matches:
+                return book_data.row(matches[0]), ""
+            raise Exception(
+                "Search term does not match any book data. Please check your ISBN.")
+        if attribute in sorted_views:
+            result = next(find_books_equal_to(attribute, search_term), None)
+            count_search('sorted_view', int(result is not None))
+            if result is not None:
+                return result, ""
+            raise Exception(
+                "Search term does not match any book data. Please check your ISBN.")
         attribute_found, order, filename = check_sorted_books(attribute)
-        if attribute_found:
-            sorted_data = read_data_from_csv(filename)
-        else:
+        if not attribute_found:
             raise Exception("Sorted book data not found.")
+        if view_cache.fits(filename):
+            # parsed once, then searched in memory until the file changes
+            sorted_data = view_cache.get(attribute, order, filename)
+            source = 'view_cache'
+        else:
+            try:
+                with view_index.ViewIndex(filename) as index:
+                    position, result = index.search(search_term)
+                count_search('sidecar', int(result is not None))
+                if result is not None:
+                    return result, ""
+                raise Exception(
+                    "Search term does not match any book data. Please check your ISBN.")
+            except ValueError:
+                # no usable sidecar, so fall back to parsing the CSV
+                sorted_data = read_data_from_csv(filename)
+                source = 'csv'
+        column_key = book_keys.get_key_function(attribute)
+        try:
+            search_key = column_key(search_term)
+        except ValueError:
+            search_key = None
         low = 0
         high = calc_length(sorted_data) - 1
-        while low <= high:
+        result = None
+        while low <= high and search_key is not None:
             middle = (high + low) // 2
-            # Compare the search element 'search term' with the element at the 'attribute' index
-            # searches from ascending order by default
-            if sorted_data[middle][attribute] < search_term:
+            # Compare the search element 'search term' with the element at the 'attribute' index,
+            # as the typed keys the file was sorted by. Searches from ascending order by default
+            middle_key = column_key(sorted_data[middle][attribute])
+            if middle_key < search_key:
                 low = middle + 1
-            elif sorted_data[middle][attribute] > search_term:
+            elif middle_key > search_key:
                 high = middle - 1
-            elif sorted_data[middle][attribute] == search_term:
-                return sorted_data[middle], ""
+            else:
+                # keeps searching to the left so the first of any duplicates is returned
+                result = sorted_data[middle]
+                high = middle - 1
+        count_search(source, int(result is not None))
+        if result is not None:
+            return result, ""
         raise Exception(
             "Search term does not match any book data. Please check your ISBN.")
     except Exception as e:
         return None, str(e)
 
 
-def sort_all_books():
-    sort_books(isbn, asc)
-    sort_books(isbn, desc)
-    sort_books(title, asc)
-    sort_books(title, desc)
-    sort_books(author, asc)
-    sort_books(author, desc)
-    sort_books(length, asc)
-    sort_books(length, desc)
-    sort_books(date_of_publication, asc)
-    sort_books(date_of_publication, desc)
+@instrumentation.timed('find_first_matches')
+def find_first_matches(search_terms, attribute):
+    '''
+    Resolves many search terms at once from the same sources as
+    search_for_book: the ISBN index, the sorted view, the sidecar of a
+    sorted file, or else a single pass over the sorted CSV
+
+    @param search_terms: list of str values to test for equality
+    @param attribute: book attribute that is searched for
+    @return matches: dict mapping each term found to its first book in ascending order
+    @raise Exception: raises an exception if no sorted book data is available
+    '''
+    if attribute == isbn:
+        canonical = {term: normalize.isbn_search_term(term) for term in search_terms}
+        if any(term != value for term, value in canonical.items()):
+            # ISBN-10s and hyphenated ISBNs are looked up as their ISBN-13
+            matches = find_first_matches(set(canonical.values()), attribute)
+            return {term: matches[value] for term, value in canonical.items() if value in matches}
+    wanted = set(search_terms)
+    if attribute == isbn and isbn_index is not None:
+        matches = {term: book_data.row(isbn_index[term][0]) for term in wanted if isbn_index.get(term)}
+        count_search('isbn_index', len(matches), len(wanted))
+        return matches
+    if attribute in sorted_views:
+        if backend == vectorized_backend:
+            matches = numpy_backend.find_first_matches(book_data, sorted_views[attribute].row_ids, attribute, wanted)
+        else:
+            matches = sorted_views[attribute].first_matches(wanted)
+        count_search('sorted_view', len(matches), len(wanted))
+        return matches
+    attribute_found, order, filename = check_sorted_books(attribute)
+    if not attribute_found:
+        raise Exception("Sorted book data not found.")
+    if view_cache.fits(filename):
+        sorted_data = view_cache.get(attribute, order, filename)
+        source = 'view_cache'
+    else:
+        try:
+            with view_index.ViewIndex(filename) as index:
+                matches = index.search_many(wanted)
+            count_search('sidecar', len(matches), len(wanted))
+            return matches
+        except ValueError:
+            sorted_data = read_data_from_csv(filename)
+            source = 'csv'
+    # equal values are adjacent and in ascending tie order in either
+    # sorted file, so the first row seen for each term is the one to return
+    matches = {}
+    for row in sorted_data:
+        value = row[attribute]
+        if value in wanted and value not in matches:
+            matches[value] = row
+    count_search(source, len(matches), len(wanted))
+    return matches
+
+
+def search_for_books(search_terms, attribute):
+    '''
+    Bulk version of search_for_book for checking many terms at once. The
+    terms are joined against the index or sorted view in one pass instead
+    of being searched one by one, and the results are streamed back in
+    the order the terms were given
+
+    @param search_terms: iterable of str values to test for equality
+    @param attribute: book attribute that is searched for
+    @return results: generator of (search term, found/missing, book or None) tuples
+    @raise Exception: raises an exception if no sorted book data is available
+    '''
+    search_terms = list(search_terms)
+    matches = find_first_matches(search_terms, attribute)
+    for term in search_terms:
+        book = matches.get(term)
+        yield term, found if book is not None else missing, book
+
+
+@instrumentation.timed('sort_all_books')
+def sort_all_books(workers=None, progress=None):
+    '''
+    Sorts books by every attribute in both orders and writes the ten
+    sorted CSV files. Each attribute is sorted once and its descending
+    view is derived from the ascending one, optionally with the five
+    attributes sorted in parallel worker processes. The numpy backend
+    argsorts each column instead and ignores workers
+
+    @param workers: int number of worker processes, see views.build_views
+    @param progress: function called with a str message as each step finishes, or None
+    @return views: dict mapping (attribute, order) to a list of row indexes
+    '''
+    print("Sorting books by all attributes ...")
+    global sorted_views
+    global index_state
+    index_state = sorting
+    try:
+        # a full rebuild is the point where deleted rows are dropped, which renumbers the row ids
+        if book_data.deleted_count:
+            text_indexes.clear()
+        book_data.compact()
+        build_isbn_index(book_data)
+        if backend == vectorized_backend:
+            views = numpy_backend.build_views(book_data)
+        else:
+            views = build_views(book_data, workers=workers)
+        if progress is not None:
+            progress(f"Sorted {len(book_data)} books, writing sorted files ...")
+        sorted_views = {}
+        for attribute in book_keys.attributes:
+            sorted_views[attribute] = SortedView(attribute, book_data, views[(attribute, asc)])
+            for order in (asc, desc):
+                write_data_to_csv(book_keys.apply_permutation(book_data, views[(attribute, order)]), attribute, order)
+            if progress is not None:
+                progress(f"Wrote books sorted by {get_attribute_name(attribute)}.")
+    except Exception:
+        index_state = not_sorted
+        raise
+    index_state = ready
+    save_snapshot()
+    return views
+
+
+@instrumentation.timed('flush_sorted_views')
+def flush_sorted_views():
+    '''
+    Rewrites the sorted CSV files of every view changed since the last flush
+    '''
+    for attribute, view in sorted_views.items():
+        if view.dirty:
+            for order in (asc, desc):
+                write_data_to_csv(view.rows(order), attribute, order)
+            view.dirty = False
 
 
 def calc_length(book_data):
@@ -219,56 +782,94 @@ def calc_length(book_data):
     @param book_data: list of lists containing unsorted book data
     @return count: int of book_data length
     '''
+    if hasattr(book_data, '__len__'):
+        return len(book_data)
     count = 0
     for i in book_data:
         count += 1
     return count
 
 
-def add_book(book_data, new_book): 
-    index = calc_length(book_data)
-    return book_data[:index] + [new_book] + book_data[index:]
+@instrumentation.timed('add_book')
+def add_book(book_data, new_book, flush=True): 
+    '''
+    Appends a book to the book data and the ISBN index. If the books have
+    been sorted, the book is binary-search inserted into each sorted view
+    and only the changed views are written out, instead of re-sorting everything.
+    Once open_catalogue has opened the log, the book is first appended to it.
+    The book is normalized first: an ISBN-10 or a hyphenated ISBN is stored
+    as its ISBN-13, and one with a wrong check digit or already in the
+    catalogue is rejected
+
+    @param book_data: BookStore containing unsorted book data
+    @param new_book: list containing the new book's data
+    @param flush: bool, False leaves writing the changed views to a later flush_sorted_views
+    @return book_data: the same BookStore, with the new book at the end
+    @raise ValueError: raises an exception if the new book's values are invalid or its ISBN is taken
+    '''
+    new_book = normalize.normalize_book(new_book)
+    if isbn_index is None:
+        build_isbn_index(book_data)
+    if isbn_index.get(new_book[isbn]):
+        raise ValueError(f"A book with ISBN {new_book[isbn]} is already in the catalogue.")
+    row_id = book_data.append(new_book)
+    if wal is not None:
+        wal.log_add(new_book)
+    if isbn_index is not None:
+        isbn_index.setdefault(str(book_data.isbns[row_id]), []).append(row_id)
+    for view in sorted_views.values():
+        view.insert(row_id)
+    for text_index in text_indexes.values():
+        text_index.add(row_id)
+    if flush:
+        flush_sorted_views()
+    return book_data
     
 
-def delete_book(isbn, book_data):
+@instrumentation.timed('delete_book')
+def delete_book(isbn, book_data, flush=True):
     '''
     Deletes a book based on ISBN supplied
-    It attempts to match the ISBN to one in 
-    our unsorted book data. Once the match
-    is found via a linear search, the index of 
-    that match is used to delete the item
-    using sequential replacing of elements
+    The book is found through the ISBN index, removed
+    from the book data, the index and each sorted view,
+    and only the changed views are written out. The delete
+    is logged first once open_catalogue has opened the log
 
     @param isbn: value to search for a match
-    @param book_data: list of lists containing unsorted book data
+    @param book_data: BookStore containing unsorted book data
+    @param flush: bool, False leaves writing the changed views to a later flush_sorted_views
     @raise Exception: raises an exception that the ISBN supplied doesn't any found
     '''
-    index_for_delete = -1  # init index
-    for i in range(calc_length(book_data)):
-        book = book_data[i]
-        if book[0] == isbn: # searches for a match
-            index_for_delete = i
-            print(f"Found the book with ISBN {isbn} at index {i}")
-            break  # exits once match is found
-    if index_for_delete >= 0:
-        '''
-        The function now takes the list at the point
-        of the index of the book that should be deleted
-        and replaces each inner list with the inner list
-        of the next index point
-        '''
-        for j in range(index_for_delete, calc_length(book_data) - 1):
-            book_data[j] = book_data[j + 1]
-        book_data.pop()  # remove last element (copy of previous element)
-        print(f"Deleted the book with ISBN {isbn} at index {index_for_delete}.")
-        sort_all_books()
-    else:
+    isbn = normalize.isbn_search_term(isbn)
+    if isbn_index is None:
+        build_isbn_index(book_data)
+    matches = isbn_index.get(isbn)
+    if not matches:
         raise Exception(f"Book with ISBN {isbn} is not present, and therefore cannot be deleted.")
+    if wal is not None:
+        wal.log_delete(isbn)
+    row_id_for_delete = matches.pop(0)
+    print(f"Found the book with ISBN {isbn} at row {row_id_for_delete}")
+    if not matches:
+        del isbn_index[isbn]
+    # views locate the book by its key, so it is removed from them before the store
+    for view in sorted_views.values():
+        view.remove(row_id_for_delete)
+    for text_index in text_indexes.values():
+        text_index.remove(row_id_for_delete)
+    book_data.delete(row_id_for_delete)
+    print(f"Deleted the book with ISBN {isbn} at row {row_id_for_delete}.")
+    if flush:
+        flush_sorted_views()
 
 
 def launch_gui():
-    global book_data
-    book_data = read_data_from_csv('library_data.csv')
+    # tkinter is only imported here so the headless CLI never loads it
+    import tkinter as tk
+    from tkinter import ttk
+    load_errors = open_catalogue('library_data.csv')
+    for line_number, message in load_errors:
+        print(f"Skipped line {line_number} of library_data.csv: {message}")
 
     def add_btn_clicked():
         global book_data
@@ -278,40 +879,86 @@ def launch_gui():
         length_val = length_input.get()
         date_val = date_input.get()
         new_book = [isbn_val, title_val, author_val, length_val, date_val]
-        try:
-            new_book_data = add_book(book_data, new_book)
-            book_data = new_book_data
-            sort_all_books()
-            add_result.config(text="New book added. Books have been re-sorted.")
-        except Exception as e:
+
+        def added(result):
+            add_result.config(text="New book added. Sorted books are being updated.")
+
+        def add_failed(e):
             add_result.config(text="An error has occurred, please ensure all fields are correct")
-            raise Exception(f"An error occurred while trying to add a new book: {e}")
+            print(f"An error occurred while trying to add a new book: {e}")
+
+        add_result.config(text="Adding book ...")
+        runner.submit(add_book, book_data, new_book, False, on_done=added, on_error=add_failed)
+        # a flush still waiting from an earlier add is replaced by this one, so quick adds share one write
+        runner.submit(flush_sorted_views, key='flush', on_done=views_flushed)
+
+
+    def views_flushed(result):
+        status_label.config(text="Sorted books are up to date.")
 
 
     def sort_btn_clicked():
-        sort_all_books()
+        runner.submit(sort_all_books, key='rebuild', on_done=sort_finished, on_error=sort_failed,
+                      on_progress=lambda message: status_label.config(text=message))
+        status_label.config(text="Sorting books ...")
         go_to_main_menu()
 
 
+    def sort_finished(views):
+        status_label.config(text="Books have been sorted.")
+
+
+    def sort_failed(e):
+        status_label.config(text=f"An error occurred while sorting books: {e}")
+
+
     def search_btn_clicked():
         '''
-        can only search if books are already sorted
+        Searches run on the task runner, after any sort or change
+        that is still in progress, so they always see a finished index.
+        Terms that aren't an ISBN are searched for in titles and authors
         '''
         search_term = search_input.get()
-        if books_sorted:
-            result, err_msg = search_for_book(search_term, isbn)
+
+        def show_matches(matches):
+            if matches:
+                search_result_label.config(text="Closest matches:")
+                search_result.config(text="\n".join(
+                    f"{book[title]} by {book[author]} (ISBN {book[isbn]})" for score, book in matches))
+            else:
+                search_result_label.config(text="")
+                search_result.config(text="No title or author resembles the search term.")
+
+        try:
+            # ISBN-10s and hyphenated ISBNs are looked up as their ISBN-13
+            search_term = str(normalize.canonical_isbn(search_term, normalize.lenient))
+        except ValueError:
+            # anything that isn't an ISBN is looked up as words of a title or author,
+            # which doesn't need the books to be sorted
+            runner.submit(search_books_by_text, search_term, on_done=show_matches)
+            return
+        if index_state == not_sorted and not runner.is_busy('rebuild'):
+            search_result_label.config(text="Sort books before searching.")
+            return
+        if index_state != ready:
+            search_result_label.config(text="Waiting for books to finish sorting ...")
+
+        def show_result(search):
+            result, err_msg = search
             if result is not None:
                 isbn_val, title_val, author_val, length_val, date_val = result
                 formatted_result = f"Title: {title_val}\nAuthor: {author_val}\nPage length: {length_val}\nDate published: {date_val}\nISBN: {isbn_val}"
                 search_result.config(text=formatted_result)
                 search_result_label.config(text="Search result:")
             else:
+                search_result_label.config(text="")
                 search_result.config(text=err_msg)
-        else:
-            search_result_label.config(text="Sort books before searching.")
+
+        runner.submit(search_for_book, search_term, isbn, on_done=show_result)
 
 
     def exit():
+        runner.stop()
         window.destroy()
 
 
@@ -367,8 +1014,12 @@ def launch_gui():
         attribute_frame.pack_forget()
         order_frame.pack_forget()
         show_data_btn.pack_forget()
-        scroll_x.pack_forget()
-        text_widget.pack_forget()
+        scroll_y.pack_forget()
+        tree.pack_forget()
+        global view_pager
+        if view_pager is not None:
+            view_pager.close()
+            view_pager = None
         hide_screen(display_screen)
         show_screen(main_menu)
 
@@ -383,10 +1034,17 @@ def launch_gui():
 
     
     def delete_btn_clicked():
-        global book_data
         isbn_for_deletion = delete_input.get()
-        delete_book(isbn_for_deletion, book_data)
-        delete_result.config(text="The book has been deleted. Books have been re-sorted.")
+
+        def deleted(result):
+            delete_result.config(text="The book has been deleted. Sorted books are being updated.")
+
+        def delete_failed(e):
+            delete_result.config(text=str(e))
+
+        delete_result.config(text="Deleting book ...")
+        runner.submit(delete_book, isbn_for_deletion, book_data, False, on_done=deleted, on_error=delete_failed)
+        runner.submit(flush_sorted_views, key='flush', on_done=views_flushed)
 
 
     def go_to_display():
@@ -430,38 +1088,84 @@ def launch_gui():
 
 
         def show_data():
+            '''
+            Opens the selected view for paging and shows its first page.
+            Only the rows in view are ever inserted into the tree
+            '''
             selected_attribute = attribute_variable.get()
             selected_order = order_variable.get()
-            filename = 'data/sorted_by_'+selected_attribute+'_'+selected_order+'_data.csv'
-            data = read_data_from_csv(filename)
-            text_widget.delete("1.0", tk.END)
-            for row in data:
-                text_widget.insert(tk.END, ", ".join(row) + "\n")
+            global view_pager
+            if view_pager is not None:
+                view_pager.close()
+            view_pager = get_view_pager(book_keys.attribute_names.index(selected_attribute), selected_order)
+            runner.submit(warm_view_cache, book_keys.attribute_names.index(selected_attribute), selected_order,
+                          key='warm_view_cache')
+            global display_top
+            display_top = 0
+            render_page()
             show_data_btn.pack(pady=50)
-            scroll_x.pack(side=tk.BOTTOM, fill=tk.X, ipadx=10, ipady=10)
-            text_widget.pack(fill="both", expand=True)
-            
-        
+            scroll_y.pack(side=tk.RIGHT, fill=tk.Y)
+            tree.pack(fill="both", expand=True)
+
+
+        def render_page():
+            visible = int(tree.cget('height'))
+            tree.delete(*tree.get_children())
+            for row in view_pager.rows(display_top, display_top + visible):
+                tree.insert('', tk.END, values=row)
+            total = len(view_pager)
+            if total:
+                scroll_y.set(display_top / total, min(1.0, (display_top + visible) / total))
+            else:
+                scroll_y.set(0.0, 1.0)
+            # fetches the next page while the app is idle so scrolling down doesn't wait on disk
+            window.after_idle(prefetch_page, view_pager, display_top + visible, display_top + 2 * visible)
+
+
+        def prefetch_page(pager, start, stop):
+            # the view may have been switched or left, and its pager closed, since this was scheduled
+            if pager is view_pager and not pager.closed:
+                pager.prefetch(start, stop)
+
+
+        def scroll_rows(*args):
+            '''
+            Scrollbar command: ('moveto', fraction) or ('scroll', count, 'units'/'pages')
+            '''
+            global display_top
+            if view_pager is None:
+                return
+            visible = int(tree.cget('height'))
+            if args[0] == 'moveto':
+                top = int(float(args[1]) * len(view_pager))
+            else:
+                step = visible if args[2] == 'pages' else 1
+                top = display_top + int(args[1]) * step
+            display_top = max(0, min(top, len(view_pager) - visible))
+            render_page()
+
+
+        def on_mousewheel(event):
+            if event.num == 4 or event.delta > 0:
+                scroll_rows('scroll', -1, 'units')
+            else:
+                scroll_rows('scroll', 1, 'units')
+            return "break"
+
+
         global show_data_btn
         show_data_btn = ttk.Button(display_screen, text="Show sorted data", command=show_data)
         show_data_btn.pack(pady=50)
-        global scroll_x
-        scroll_x = tk.Scrollbar(display_screen, orient=tk.HORIZONTAL)
-        # scroll_x.pack(side=tk.BOTTOM, fill=tk.X, ipadx=10, ipady=10)
-        global text_widget
-        text_widget = tk.Text(display_screen, wrap=tk.NONE, xscrollcommand=scroll_x.set)
-        # text_widget.pack(fill="both", expand=True)
-        scroll_x.config(command=text_widget.xview)
-
-
-        def show_data():
-            selected_attribute = attribute_variable.get()
-            selected_order = order_variable.get()
-            filename = 'data/sorted_by_'+selected_attribute+'_'+selected_order+'_data.csv'
-            data = read_data_from_csv(filename)
-            text_widget.delete("1.0", tk.END)
-            for row in data:
-                text_widget.insert(tk.END, ", ".join(row) + "\n")
+        global scroll_y
+        scroll_y = tk.Scrollbar(display_screen, orient=tk.VERTICAL, command=scroll_rows)
+        global tree
+        columns = ["isbn", "title", "author", "length", "date_of_publication"]
+        tree = ttk.Treeview(display_screen, columns=columns, show='headings', height=DISPLAY_PAGE_ROWS)
+        for column in columns:
+            tree.heading(column, text=column)
+        tree.bind("<MouseWheel>", on_mousewheel)
+        tree.bind("<Button-4>", on_mousewheel)
+        tree.bind("<Button-5>", on_mousewheel)
 
 
     def go_to_delete():
@@ -574,6 +1278,8 @@ def launch_gui():
     window.attributes("-fullscreen", True)
     window.configure(bg='lightgray')
     window.title("Library Data Application")
+    runner = TaskRunner(window.after)
+    runner.start()
     current_screen = []
     starting_screen = tk.Frame(window, background="lightgray")
     main_menu = tk.Frame(window, background="lightgray")
@@ -581,8 +1287,6 @@ def launch_gui():
     add_screen = tk.Frame(window, background="lightgray")
     delete_screen = tk.Frame(window, background="lightgray") 
     display_screen = tk.Frame(window, background="lightgray")
-    # shows starting screen as default:
-    show_screen(starting_screen)
     # styling:
     primary_btn_col= '#FB40AF'
     style = ttk.Style()
@@ -608,8 +1312,11 @@ def launch_gui():
     sort_btn = ttk.Button(starting_screen, text="Sort all books", command=sort_btn_clicked)
     sort_btn.grid(row=2, columnspan=5, padx=10, pady=10)
     # MAIN MENU
-    menu_explainer = ttk.Label(main_menu, text="Books have been sorted. You can now do the following:")
+    menu_explainer = ttk.Label(main_menu, text="You can now do the following:")
     menu_explainer.grid(row=1, columnspan=5, pady=(10, 3))
+    # progress of background sorting and updates:
+    status_label = ttk.Label(main_menu, text="")
+    status_label.grid(row=3, columnspan=5, pady=(10, 3))
     # trigger display:
     display_btn = ttk.Button(main_menu, text="Display sorted books", command=go_to_display)
     display_btn.grid(row=2, column=1, padx=10, pady=20)
@@ -622,6 +1329,15 @@ def launch_gui():
     # trigger remove a book:
     remove_btn = ttk.Button(main_menu, text="Remove a book", command=go_to_delete)
     remove_btn.grid(row=2, column=4, padx=10, pady=20)
+    # a snapshot brings its sorted views, so only a cold start asks for the full sort:
+    if index_state == ready and sorted_views:
+        show_screen(main_menu)
+        status_label.config(text="Books loaded from the last session.")
+    else:
+        show_screen(starting_screen)
+    # sorted files loaded from the snapshot catch up with the replayed log in the background:
+    if any(view.dirty for view in sorted_views.values()):
+        runner.submit(flush_sorted_views, key='flush', on_done=views_flushed)
     window.mainloop()
 
 
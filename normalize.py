@@ -0,0 +1,169 @@
+'''
+Validation and normalization stage in front of add_book and the CSV
+loader. ISBNs are canonicalized to 13 digit ints (ISBN-10s converted,
+hyphens and spaces dropped) and their check digits verified, lengths and
+dates are parsed once, and duplicate ISBNs are rejected or merged, with a
+Bloom filter as the pre-check of streaming loads. The store, the sorts
+and the indexes then only ever see clean typed keys
+'''
+import math
+from datetime import date
+from book_keys import isbn, title, author, length, date_of_publication
+import book_keys
+from book_store import MAX_LENGTH
+
+ISBN10_DIGITS = 10
+ISBN13_DIGITS = 13
+# ISBN-10s are carried over into the 978 prefix of ISBN-13:
+ISBN10_PREFIX = '978'
+# check digit policies:
+strict = 'strict'
+lenient = 'lenient'
+# duplicate ISBN policies:
+reject = 'reject'
+merge = 'merge'
+allow = 'allow'
+# a false positive only costs a lookup when the flagged rows are confirmed, so fewer probes pay off:
+DEFAULT_FALSE_POSITIVE_RATE = 0.05
+# rough bytes per CSV row, to size the Bloom filter of a load from the file size:
+ROW_BYTES_ESTIMATE = 60
+
+
+def isbn13_check_digit(digits):
+    '''
+    @param digits: str of the first 12 digits of an ISBN-13
+    @return check_digit: int
+    '''
+    total = sum(int(digit) * (3 if position % 2 else 1) for position, digit in enumerate(digits))
+    return (10 - total % 10) % 10
+
+
+def isbn10_check_digit(digits):
+    '''
+    @param digits: str of the first 9 digits of an ISBN-10
+    @return check_digit: str, 'X' standing for 10
+    '''
+    total = sum(int(digit) * (10 - position) for position, digit in enumerate(digits))
+    check_digit = (11 - total % 11) % 11
+    return 'X' if check_digit == 10 else str(check_digit)
+
+
+def canonical_isbn(value, check_digits=strict):
+    '''
+    Converts an ISBN-10 or ISBN-13, with or without hyphens and spaces, to
+    the 13 digit int the store keeps
+
+    @param value: str ISBN as entered or as it appears in the CSV
+    @param check_digits: str strict/lenient, lenient accepts a wrong check digit
+    @return isbn: int 13 digit ISBN
+    @raise ValueError: raises an exception for anything that is not an ISBN
+    '''
+    digits = value.replace('-', '').replace(' ', '').upper()
+    if len(digits) == ISBN10_DIGITS and digits[:-1].isdigit() and (digits[-1].isdigit() or digits[-1] == 'X'):
+        if check_digits == strict and isbn10_check_digit(digits[:-1]) != digits[-1]:
+            raise ValueError(f"ISBN {value!r} has a wrong check digit.")
+        body = ISBN10_PREFIX + digits[:-1]
+        return int(body + str(isbn13_check_digit(body)))
+    if len(digits) == ISBN13_DIGITS and digits.isdigit():
+        if check_digits == strict and isbn13_check_digit(digits[:-1]) != int(digits[-1]):
+            raise ValueError(f"ISBN {value!r} has a wrong check digit.")
+        if digits[0] == '0':
+            raise ValueError(f"ISBN {value!r} must not start with 0.")
+        return int(digits)
+    raise ValueError(f"ISBN {value!r} must have 10 or 13 digits.")
+
+
+def isbn_search_term(value):
+    '''
+    Canonical form of an ISBN search or delete term, so an ISBN-10 or a
+    hyphenated ISBN finds the book stored under its ISBN-13
+
+    @param value: str ISBN as entered
+    @return term: str 13 digit ISBN, or value unchanged if it is not an ISBN
+    '''
+    try:
+        return str(canonical_isbn(value, lenient))
+    except ValueError:
+        return value
+
+
+def parse_book(book, check_digits=strict):
+    '''
+    Validates a book and parses each value once
+
+    @param book: list of five str (isbn, title, author, length, date)
+    @param check_digits: str strict/lenient
+    @return record: tuple (isbn int, title str, author str, length int, date ordinal int)
+    @raise ValueError: raises an exception describing the first invalid value
+    '''
+    if len(book) != 5:
+        raise ValueError(f"Expected 5 values, found {len(book)}.")
+    isbn_value = canonical_isbn(book[isbn].strip(), check_digits)
+    title_value = book[title].strip()
+    author_value = book[author].strip()
+    if not title_value or not author_value:
+        raise ValueError("Title and author must not be empty.")
+    length_text = book[length].strip()
+    if not length_text.isdigit() or int(length_text) > MAX_LENGTH:
+        raise ValueError(f"Page length {book[length]!r} must be a whole number between 0 and {MAX_LENGTH}.")
+    try:
+        date_value = book_keys.date_key(book[date_of_publication].strip())
+    except ValueError:
+        raise ValueError(f"Date of publication {book[date_of_publication]!r} must be YYYY-MM-DD.")
+    return (isbn_value, title_value, author_value, int(length_text), date_value)
+
+
+def format_record(record):
+    '''
+    @param record: tuple from parse_book
+    @return book: list of five str in the canonical form written to the CSV files
+    '''
+    isbn_value, title_value, author_value, length_value, date_value = record
+    return [str(isbn_value), title_value, author_value, str(length_value), date.fromordinal(date_value).isoformat()]
+
+
+def normalize_book(book, check_digits=strict):
+    '''
+    @param book: list of five str (isbn, title, author, length, date)
+    @param check_digits: str strict/lenient
+    @return book: list of five str with the ISBN as 13 digits and surrounding whitespace removed
+    @raise ValueError: raises an exception describing the first invalid value
+    '''
+    return format_record(parse_book(book, check_digits))
+
+
+class BloomFilter:
+    '''
+    Fixed-size set of ints that can answer "definitely not seen" without
+    storing the ints. A "maybe seen" answer is wrong with about the chosen
+    false positive rate once the expected number of items has been added
+    '''
+
+    def __init__(self, expected_items, false_positive_rate=DEFAULT_FALSE_POSITIVE_RATE):
+        '''
+        @param expected_items: int number of items the filter is sized for
+        @param false_positive_rate: float wanted rate of false "maybe seen" answers
+        '''
+        expected_items = max(1, expected_items)
+        self.size = max(64, math.ceil(-expected_items * math.log(false_positive_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / expected_items * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def add(self, value):
+        '''
+        @param value: int to add
+        @return seen: bool, False if value was definitely not in the filter before
+        '''
+        # double hashing: the two halves of one multiplicative hash give every probe position
+        mixed = (value * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+        position, step = mixed & 0xFFFFFFFF, (mixed >> 32) | 1
+        bits, size = self.bits, self.size
+        seen = True
+        for probe in range(self.hash_count):
+            position %= size
+            mask = 1 << (position & 7)
+            if not bits[position >> 3] & mask:
+                bits[position >> 3] |= mask
+                seen = False
+            position += step
+        return seen
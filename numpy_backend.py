@@ -0,0 +1,290 @@
+'''
+Optional NumPy backend for sorting, bulk lookups and range filters.
+The BookStore columns are copied into typed arrays (uint64 ISBN,
+uint16 length, datetime64 date and, for titles/authors, uint32
+categorical codes numbered in string order) and sorted with a stable
+argsort, so every view comes out identical to the pure-Python engine's.
+NumPy is not a requirement, and is only imported once the backend is
+selected, so starting main.py or cli.py does not pay for it: when it is
+missing, load returns False and main.py keeps using the sort engine
+'''
+import bisect
+from datetime import date
+from book_keys import isbn, title, author, length, date_of_publication
+import book_keys
+
+# imported by load:
+numpy = None
+# day 0 of datetime64[D]:
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+# BookStore column of each fixed width attribute:
+COLUMN_NAMES = {isbn: 'isbns', length: 'lengths', date_of_publication: 'dates'}
+
+
+def load():
+    '''
+    Imports NumPy the first time the backend is selected
+
+    @return available: bool, False if NumPy is not installed
+    '''
+    global numpy
+    if numpy is None:
+        try:
+            import numpy
+        except ImportError:
+            return False
+    return True
+
+
+def copy_column(column):
+    '''
+    Copies an array.array column. NumPy must not share the buffer, since
+    an array.array cannot grow while its buffer is exported
+
+    @param column: array.array
+    @return array: numpy.ndarray of the same type
+    '''
+    return numpy.array(column, dtype=column.typecode)
+
+
+def cached(store, name, sources, build):
+    '''
+    Returns an array derived from some of the store's columns or pools,
+    building it only when they have changed since it was cached. Appends
+    grow a column or pool and compact() replaces the columns, so the
+    cached array is current while every source is the same object with
+    the same length. Callers must not modify the array
+
+    @param store: BookStore
+    @param name: hashable name of the derived array
+    @param sources: tuple of the array.array columns and pool string lists it is derived from
+    @param build: function() building the array
+    @return value: the cached or newly built array
+    '''
+    lengths = tuple(len(source) for source in sources)
+    entry = store.backend_cache.get(name)
+    if entry is not None and entry[1] == lengths and all(old is new for old, new in zip(entry[0], sources)):
+        return entry[2]
+    value = build()
+    store.backend_cache[name] = (sources, lengths, value)
+    return value
+
+
+def rank_pool(pool):
+    order = sorted(range(len(pool.strings)), key=pool.strings.__getitem__)
+    ranks = numpy.empty(len(order), dtype=numpy.uint32)
+    ranks[order] = numpy.arange(len(order), dtype=numpy.uint32)
+    return [pool.strings[string_id] for string_id in order], ranks
+
+
+def sorted_pool(store, attribute):
+    '''
+    @param store: BookStore
+    @param attribute: title or author
+    @return strings, ranks: the pool's strings in order, and the rank of each string id
+    '''
+    pool = text_pool(store, attribute)[0]
+    return cached(store, ('pool', attribute), (pool.strings,), lambda: rank_pool(pool))
+
+
+def text_pool(store, attribute):
+    if attribute == title:
+        return store.titles, store.title_ids
+    return store.authors, store.author_ids
+
+
+def column(store, attribute):
+    '''
+    @param store: BookStore
+    @param attribute: book attribute (e.g. author/title/etc)
+    @return column: numpy.ndarray with one typed value per row id, deleted rows included.
+    Titles and authors are categorical codes that sort like the strings
+    '''
+    if attribute in (title, author):
+        pool, ids = text_pool(store, attribute)
+        sources = (ids, pool.strings)
+    else:
+        sources = (getattr(store, COLUMN_NAMES[attribute]),)
+    return cached(store, ('column', attribute), sources, lambda: build_column(store, attribute))
+
+
+def build_column(store, attribute):
+    if attribute == isbn:
+        return copy_column(store.isbns).astype(numpy.uint64)
+    if attribute == length:
+        return copy_column(store.lengths).astype(numpy.uint16)
+    if attribute == date_of_publication:
+        return (copy_column(store.dates).astype(numpy.int64) - EPOCH_ORDINAL).astype('datetime64[D]')
+    if attribute in (title, author):
+        strings, ranks = sorted_pool(store, attribute)
+        return ranks[copy_column(text_pool(store, attribute)[1])]
+    raise ValueError(f"Unknown book attribute: {attribute}")
+
+
+def sort_codes(column_values):
+    '''
+    @param column_values: numpy.ndarray from column
+    @return codes: integer numpy.ndarray that orders the same way
+    '''
+    if column_values.dtype.kind == 'M':
+        return column_values.view(numpy.int64)
+    return column_values
+
+
+def live_row_ids(store):
+    '''
+    @return row_ids: numpy.ndarray of the row ids of books that have not been deleted, in order
+    '''
+    return numpy.flatnonzero(numpy.array(store.deleted, dtype=numpy.uint8) == 0)
+
+
+def argsort_rows(codes, row_ids, reverse=False):
+    '''
+    Stable argsort of some rows by their codes. Descending order sorts
+    the codes' distance from the largest code, so books with equal keys
+    stay in ascending row order, as sort_engine.reverse_stable leaves them
+
+    @param codes: integer numpy.ndarray, one code per row id
+    @param row_ids: numpy.ndarray of the row ids to sort
+    @param reverse: bool, True for descending order
+    @return row_ids: numpy.ndarray of row ids in sorted order
+    '''
+    keys = codes[row_ids]
+    if reverse and len(keys):
+        keys = keys.max() - keys
+    return row_ids[numpy.argsort(keys, kind='stable')]
+
+
+def sort_permutation(store, attribute, reverse=False):
+    '''
+    @param store: BookStore
+    @param attribute: book attribute (e.g. author/title/etc)
+    @param reverse: bool, True for descending order
+    @return permutation: list of row ids in sorted order, as sort_engine.sort_permutation returns them
+    '''
+    return argsort_rows(sort_codes(column(store, attribute)), live_row_ids(store), reverse).tolist()
+
+
+def build_views(store, attributes=book_keys.attributes):
+    '''
+    NumPy version of views.build_views
+
+    @param store: BookStore
+    @param attributes: list of book attributes to build views for
+    @return views: dict mapping (attribute, order) to a list of row ids
+    '''
+    row_ids = live_row_ids(store)
+    views = {}
+    for attribute in attributes:
+        codes = sort_codes(column(store, attribute))
+        views[(attribute, 'asc')] = argsort_rows(codes, row_ids).tolist()
+        views[(attribute, 'desc')] = argsort_rows(codes, row_ids, reverse=True).tolist()
+    return views
+
+
+def composite_permutation(store, sort_spec):
+    '''
+    NumPy version of views.build_composite_view: one stable argsort per
+    attribute, least significant first, so each pass only reorders the
+    ties left by the attributes before it
+
+    @param store: BookStore
+    @param sort_spec: list of (attribute, order) pairs, most significant first
+    @return permutation: list of row ids in sorted order
+    @raise ValueError: raises an exception for an empty spec or an unknown order
+    '''
+    if not sort_spec:
+        raise ValueError("A sort needs at least one attribute.")
+    row_ids = live_row_ids(store)
+    for attribute, order in reversed(sort_spec):
+        if order not in ('asc', 'desc'):
+            raise ValueError(f"Unknown sort order: {order}")
+        row_ids = argsort_rows(sort_codes(column(store, attribute)), row_ids, reverse=order == 'desc')
+    return row_ids.tolist()
+
+
+def value_codes(store, attribute, values):
+    '''
+    Converts attribute values as they appear in the CSV to codes
+
+    @param store: BookStore
+    @param attribute: book attribute (e.g. author/title/etc)
+    @param values: list of str
+    @return found, codes: list of the values that could be converted and a numpy.ndarray of their codes
+    '''
+    found, codes = [], []
+    if attribute in (title, author):
+        strings, ranks = sorted_pool(store, attribute)
+        for value in values:
+            position = bisect.bisect_left(strings, value)
+            if position < len(strings) and strings[position] == value:
+                found.append(value)
+                codes.append(position)
+        return found, numpy.array(codes, dtype=numpy.uint32)
+    key_function = book_keys.get_key_function(attribute)
+    for value in values:
+        try:
+            code = key_function(value)
+        except ValueError:
+            continue
+        if attribute == date_of_publication:
+            code -= EPOCH_ORDINAL
+        elif not 0 <= code < 2 ** 64:
+            continue
+        found.append(value)
+        codes.append(code)
+    return found, numpy.array(codes, dtype=numpy.int64 if attribute == date_of_publication else numpy.uint64)
+
+
+def find_first_matches(store, view_row_ids, attribute, values):
+    '''
+    Vectorised bulk lookup: searchsorted of every value at once in an ascending view
+
+    @param store: BookStore
+    @param view_row_ids: sequence of row ids sorted ascending by attribute
+    @param attribute: book attribute (e.g. author/title/etc)
+    @param values: iterable of str attribute values as they appear in the CSV
+    @return matches: dict mapping each value found to its first book in view order
+    '''
+    values = list(values)
+    view_row_ids = numpy.array(view_row_ids, dtype=numpy.int64)
+    sorted_codes = sort_codes(column(store, attribute))[view_row_ids]
+    found, codes = value_codes(store, attribute, values)
+    if not len(codes) or not len(sorted_codes):
+        return {}
+    # widen the view rather than narrow the values, so an out of range length cannot wrap onto a match
+    sorted_codes = sorted_codes.astype(codes.dtype, copy=False)
+    positions = numpy.searchsorted(sorted_codes, codes, side='left')
+    clipped = numpy.minimum(positions, len(sorted_codes) - 1)
+    hits = (positions < len(sorted_codes)) & (sorted_codes[clipped] == codes)
+    return {found[i]: store.row(int(view_row_ids[positions[i]])) for i in numpy.flatnonzero(hits)}
+
+
+def filter_rows(store, attribute, low=None, high=None):
+    '''
+    Range filter with a boolean mask over the whole column, e.g. length
+    between 300 and 500. Bounds are inclusive and either may be left open
+
+    @param store: BookStore
+    @param attribute: book attribute (e.g. author/title/etc)
+    @param low: str lower bound as it appears in the CSV, or None
+    @param high: str upper bound as it appears in the CSV, or None
+    @return row_ids: list of matching row ids in ascending order of attribute
+    '''
+    codes = sort_codes(column(store, attribute))
+    mask = numpy.array(store.deleted, dtype=numpy.uint8) == 0
+    if attribute in (title, author):
+        strings = sorted_pool(store, attribute)[0]
+        if low is not None:
+            mask &= codes >= bisect.bisect_left(strings, low)
+        if high is not None:
+            mask &= codes < bisect.bisect_right(strings, high)
+    else:
+        codes = codes.astype(numpy.int64) if attribute != isbn else codes
+        key_function = book_keys.get_key_function(attribute)
+        offset = EPOCH_ORDINAL if attribute == date_of_publication else 0
+        if low is not None:
+            mask &= codes >= key_function(low) - offset
+        if high is not None:
+            mask &= codes <= key_function(high) - offset
+    return argsort_rows(codes, numpy.flatnonzero(mask)).tolist()
@@ -0,0 +1,197 @@
+'''
+Report queries that answer from the book columns without a full sort or
+a rewritten file: the k first books of a sorted order with a bounded heap
+(O(n log k)), quantiles and medians with introselect (expected O(n)) and
+group-by aggregates such as count and median page count per author in
+one streaming pass over the books
+'''
+import heapq
+import math
+from datetime import date
+import book_keys
+import sort_engine
+from book_keys import length
+from views import asc, desc
+
+count = 'count'
+minimum = 'min'
+maximum = 'max'
+total = 'sum'
+mean = 'mean'
+median = 'median'
+aggregates = [count, minimum, maximum, total, mean, median]
+# aggregates that add values up, so only make sense for page length:
+NUMERIC_AGGREGATES = (total, mean)
+
+
+def top_k(data, attribute, k, order=desc):
+    '''
+    Returns the first k books of the sorted file for attribute and order,
+    e.g. the 20 longest books, keeping only the best k seen in a heap.
+    Books with equal keys come in the same order as in the sorted files
+
+    @param data: list of lists containing book data, or a BookStore
+    @param attribute: book attribute (e.g. author/title/etc)
+    @param k: int number of books wanted
+    @param order: str value of either asc/desc
+    @return books: list of at most k books
+    @raise ValueError: raises an exception for an unknown order or a value that cannot be converted
+    '''
+    if order not in (asc, desc):
+        raise ValueError(f"Unknown sort order: {order}")
+    if k <= 0:
+        return []
+    keys = book_keys.extract_keys(data, attribute)
+    pick = heapq.nlargest if order == desc else heapq.nsmallest
+    return book_keys.apply_permutation(data, pick(k, book_keys.row_ids(data), key=keys.__getitem__))
+
+
+def quantiles(data, attribute, fractions):
+    '''
+    Returns the values found the given fractions of the way through the
+    books sorted by attribute, e.g. 0.5 for the median and 0.9 for the
+    90th percentile. Each is the value of an actual book, the lower one
+    when a fraction falls between two books
+
+    @param data: list of lists containing book data, or a BookStore
+    @param attribute: book attribute (e.g. author/title/etc)
+    @param fractions: iterable of floats between 0 and 1
+    @return values: list of str values as they appear in the CSV, None for each if there are no books
+    @raise ValueError: raises an exception for a fraction outside 0..1
+    '''
+    keys = book_keys.extract_keys(data, attribute)
+    items = list(book_keys.row_ids(data))
+    values = []
+    for fraction in fractions:
+        if not 0 <= fraction <= 1:
+            raise ValueError(f"Quantile fraction must be between 0 and 1, not {fraction}.")
+        if not items:
+            values.append(None)
+            continue
+        # later selections reuse the partitioning the earlier ones left behind
+        row_id = sort_engine.intro_select(items, math.floor(fraction * (len(items) - 1)), keys)
+        values.append(data[row_id][attribute])
+    return values
+
+
+def quantile(data, attribute, fraction):
+    '''
+    Single value version of quantiles
+
+    @return value: str value as it appears in the CSV, or None if there are no books
+    '''
+    return quantiles(data, attribute, [fraction])[0]
+
+
+def median_of(values):
+    '''
+    @param values: list of numbers, reordered in place
+    @return median: the middle value, or the mean of the two middle values, or None if empty
+    '''
+    if not values:
+        return None
+    items = list(range(len(values)))
+    middle = (len(values) - 1) // 2
+    lower = values[sort_engine.intro_select(items, middle, values)]
+    if len(values) % 2:
+        return lower
+    # the upper middle value is the smallest of those the selection left after the lower one
+    upper = min(values[item] for item in items[middle + 1:])
+    return (lower + upper) / 2
+
+
+class GroupAggregate:
+    '''
+    Running aggregates of one group. Only the median needs the values kept
+    '''
+    __slots__ = ('count', 'total', 'smallest', 'largest', 'values')
+
+    def __init__(self, keep_values):
+        self.count = 0
+        self.total = 0
+        # (key, value as in the CSV) pairs of the smallest and largest book so far
+        self.smallest = None
+        self.largest = None
+        self.values = [] if keep_values else None
+
+    def add(self, key, value):
+        self.count += 1
+        if isinstance(key, int):
+            self.total += key
+        if self.smallest is None or key < self.smallest[0]:
+            self.smallest = (key, value)
+        if self.largest is None or self.largest[0] < key:
+            self.largest = (key, value)
+        if self.values is not None:
+            self.values.append(key)
+
+    def result(self, attribute, wanted):
+        results = {}
+        for aggregate in wanted:
+            if aggregate == count:
+                results[count] = self.count
+            elif aggregate == minimum:
+                results[minimum] = self.smallest[1]
+            elif aggregate == maximum:
+                results[maximum] = self.largest[1]
+            elif aggregate == total:
+                results[total] = self.total
+            elif aggregate == mean:
+                results[mean] = self.total / self.count
+            elif attribute == length:
+                results[median] = median_of(self.values)
+            else:
+                # the lower median is an actual value, so it is returned as it appears in the CSV
+                middle = (len(self.values) - 1) // 2
+                key = self.values[sort_engine.intro_select(list(range(len(self.values))), middle, self.values)]
+                results[median] = format_key(attribute, key)
+        return results
+
+
+def format_key(attribute, key):
+    '''
+    @param attribute: book attribute (e.g. author/title/etc)
+    @param key: typed key from book_keys
+    @return value: str value as it appears in the CSV
+    '''
+    if attribute == book_keys.date_of_publication:
+        return date.fromordinal(key).isoformat()
+    return str(key)
+
+
+def group_by(books, group_attribute, value_attribute=length, wanted=(count, minimum, maximum, mean, median)):
+    '''
+    Aggregates one attribute per distinct value of another in a single pass
+    over the books, e.g. the number of books and the median page count of
+    every author. books may be any iterable of rows, such as the list from
+    read_data_from_csv or a BookStore, and is only read once
+
+    @param books: iterable of lists of str
+    @param group_attribute: book attribute to group by
+    @param value_attribute: book attribute to aggregate, page length by default
+    @param wanted: iterable of aggregate names from aggregates
+    @return groups: dict mapping each group value to a dict of aggregate name to result,
+    in the order the groups were first seen
+    @raise ValueError: raises an exception for an unknown aggregate, sum or mean of
+    an attribute other than length, or a value that cannot be converted
+    '''
+    wanted = list(wanted)
+    for aggregate in wanted:
+        if aggregate not in aggregates:
+            raise ValueError(f"Unknown aggregate: {aggregate}")
+        if aggregate in NUMERIC_AGGREGATES and value_attribute != length:
+            raise ValueError(f"{aggregate} is only available for length.")
+    key = book_keys.get_key_function(value_attribute)
+    keep_values = median in wanted
+    groups = {}
+    for row_number, book in enumerate(books):
+        value = book[value_attribute]
+        try:
+            book_key = key(value)
+        except ValueError:
+            raise ValueError(f"Invalid value {value!r} in row {row_number + 1} of the book data.")
+        group = groups.get(book[group_attribute])
+        if group is None:
+            group = groups[book[group_attribute]] = GroupAggregate(keep_values)
+        group.add(book_key, value)
+    return {name: group.result(value_attribute, wanted) for name, group in groups.items()}
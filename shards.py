@@ -0,0 +1,275 @@
+'''
+Hash-partitioned catalogue. Books are split into shards by a hash of
+their ISBN, so every copy of an ISBN lives in one shard and ISBN searches
+and deletes go to exactly one of them. Each shard is a BookStore with its
+own ISBN index and sorted views; a rebuild sorts every shard in its own
+worker process and the global sorted files are a k-way merge of the
+shard views. Each book keeps its position in the catalogue, which breaks
+ties in the merge, so the files are the same as the unsharded ones
+'''
+import bisect
+import heapq
+import os
+import zlib
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+import book_keys
+import normalize
+from book_keys import isbn
+from book_store import BookStore
+from views import build_views, SortedView, asc, desc, orders
+
+DEFAULT_SHARD_COUNT = os.cpu_count() or 1
+
+
+def shard_of(isbn_value, shard_count):
+    '''
+    @param isbn_value: str ISBN as it appears in the CSV
+    @param shard_count: int number of shards
+    @return shard: int index of the shard holding books with that ISBN
+    '''
+    return zlib.crc32(isbn_value.encode('ascii')) % shard_count
+
+
+def build_shard(shard):
+    '''
+    Compacts, sorts and indexes one shard. Runs in a worker process, which
+    sends the built shard back, so the coordinator does no per-book work
+
+    @param shard: Shard
+    @return shard: the same Shard, with its sorted views and ISBN index built
+    '''
+    shard.compact()
+    views = build_views(shard.store, workers=1)
+    shard.sorted_views = {attribute: SortedView(attribute, shard.store, views[(attribute, asc)])
+                          for attribute in book_keys.attributes}
+    shard.build_isbn_index()
+    return shard
+
+
+class Shard:
+    '''
+    One partition of the catalogue: a BookStore, the catalogue position of
+    each of its rows, its ISBN index and its ascending sorted views
+    '''
+
+    def __init__(self):
+        self.store = BookStore()
+        # catalogue position of each row id, increasing since books are appended in catalogue order
+        self.sequence = array('q')
+        self.isbn_index = {}
+        self.sorted_views = {}
+
+    def compact(self):
+        if self.store.deleted_count:
+            self.sequence = array('q', [self.sequence[row_id] for row_id in self.store.live_row_ids()])
+            self.store.compact()
+
+    def build_isbn_index(self):
+        self.isbn_index = {}
+        for row_id in self.store.live_row_ids():
+            self.isbn_index.setdefault(str(self.store.isbns[row_id]), []).append(row_id)
+
+    def first_match(self, search_term, attribute):
+        '''
+        @param search_term: str value to test for equality
+        @param attribute: book attribute that is searched for
+        @return row_id: int row id of the first match in ascending order, or None
+        '''
+        if attribute == isbn:
+            matches = self.isbn_index.get(search_term)
+            return matches[0] if matches else None
+        view = self.sorted_views[attribute]
+        try:
+            search_key = view.key(search_term)
+        except ValueError:
+            return None
+        index = bisect.bisect_left(view.keys, search_key)
+        if index < len(view.keys) and view.keys[index] == search_key:
+            return view.row_ids[index]
+        return None
+
+    def ordered(self, attribute, order):
+        '''
+        @param attribute: book attribute the view is sorted by
+        @param order: str value of either asc/desc
+        @return items: iterator of (key, catalogue position, shard, row id) in view order
+        '''
+        view = self.sorted_views[attribute]
+        row_ids = view.ordered_row_ids(order)
+        return ((self.store.key(row_id, attribute), self.sequence[row_id], self, row_id) for row_id in row_ids)
+
+
+class ShardedCatalogue:
+    '''
+    Coordinator over the shards: routes mutations and ISBN lookups to the
+    shard owning the ISBN, gathers other searches from every shard and
+    merges the shard views into the global sorted files
+    '''
+
+    def __init__(self, shard_count=DEFAULT_SHARD_COUNT, wal=None):
+        '''
+        @param shard_count: int number of shards
+        @param wal: journal.WriteAheadLog to log adds and deletes to before applying them, or None
+        '''
+        if shard_count < 1:
+            raise ValueError("A catalogue needs at least one shard.")
+        self.shards = [Shard() for _ in range(shard_count)]
+        self.wal = wal
+        self.next_sequence = 0
+        self.dirty = False
+
+    @classmethod
+    def from_store(cls, store, shard_count=DEFAULT_SHARD_COUNT, wal=None):
+        '''
+        Partitions the live books of a BookStore, in catalogue order
+
+        @param store: BookStore, e.g. main.book_data after open_catalogue
+        @return catalogue: ShardedCatalogue
+        '''
+        catalogue = cls(shard_count, wal)
+        for row_id in store.live_row_ids():
+            record = (store.isbns[row_id], store.titles.strings[store.title_ids[row_id]],
+                      store.authors.strings[store.author_ids[row_id]], store.lengths[row_id], store.dates[row_id])
+            catalogue.append_record(record)
+        return catalogue
+
+    def __len__(self):
+        return sum(len(shard.store) for shard in self.shards)
+
+    def shard_for(self, isbn_value):
+        return self.shards[shard_of(isbn_value, len(self.shards))]
+
+    def append_record(self, record):
+        '''
+        Appends a parsed book to the shard owning its ISBN and to that shard's ISBN index
+
+        @param record: tuple (isbn int, title str, author str, length int, date ordinal int)
+        @return shard, row_id: the Shard and the book's row id in its store
+        '''
+        shard = self.shard_for(str(record[isbn]))
+        row_id = shard.store.append_record(record)
+        shard.sequence.append(self.next_sequence)
+        self.next_sequence += 1
+        shard.isbn_index.setdefault(str(record[isbn]), []).append(row_id)
+        return shard, row_id
+
+    def rebuild(self, workers=None):
+        '''
+        Drops deleted rows, then sorts and indexes every shard, one worker
+        process per shard
+
+        @param workers: int number of worker processes, defaults to one per shard up
+        to the number of cores; 1 builds the shards in this process
+        '''
+        if workers is None:
+            workers = min(len(self.shards), os.cpu_count() or 1)
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                self.shards = list(executor.map(build_shard, self.shards))
+        else:
+            self.shards = [build_shard(shard) for shard in self.shards]
+        self.dirty = True
+
+    def merged(self, attribute, order):
+        '''
+        k-way merges the shard views into the global order. Books with
+        equal keys come in catalogue order, as in an unsharded sort
+
+        @param attribute: book attribute (e.g. author/title/etc)
+        @param order: str value of either asc/desc
+        @return books: iterator over every book, as lists, in that order
+        '''
+        streams = [shard.ordered(attribute, order) for shard in self.shards]
+        if order == desc:
+            # descending by key, ascending by position among equal keys
+            merged = heapq.merge(*streams, key=lambda item: (item[0], -item[1]), reverse=True)
+        else:
+            merged = heapq.merge(*streams, key=lambda item: (item[0], item[1]))
+        return (shard.store.row(row_id) for key, sequence, shard, row_id in merged)
+
+    def write_views(self, write):
+        '''
+        Writes the ten global sorted files from the merged shard views
+
+        @param write: function(books, attribute, order), e.g. main.write_data_to_csv
+        '''
+        for attribute in book_keys.attributes:
+            for order in orders:
+                write(self.merged(attribute, order), attribute, order)
+        self.dirty = False
+
+    def flush(self, write):
+        '''
+        Rewrites the global sorted files if a book was added or deleted since they were written
+
+        @param write: function(books, attribute, order), e.g. main.write_data_to_csv
+        '''
+        if self.dirty:
+            self.write_views(write)
+
+    def search_for_book(self, search_term, attribute):
+        '''
+        search_for_book over the shards, with the return values and messages
+        of main.search_for_book: an ISBN is looked up in the one shard that
+        can hold it, any other attribute in every shard, and the match
+        earliest in the catalogue wins, the one the sorted files list first
+
+        @param search_term: str value to test for equality
+        @param attribute: book attribute that is searched for
+        @return book, err_msg: list of the book's values and "", or None and str message
+        '''
+        if not self.shards[0].sorted_views:
+            return None, "Sorted book data not found."
+        if attribute == isbn:
+            search_term = normalize.isbn_search_term(search_term)
+        shards = [self.shard_for(search_term)] if attribute == isbn else self.shards
+        best = None
+        for shard in shards:
+            row_id = shard.first_match(search_term, attribute)
+            if row_id is not None and (best is None or shard.sequence[row_id] < best[0].sequence[best[1]]):
+                best = (shard, row_id)
+        if best is None:
+            return None, "Search term does not match any book data. Please check your ISBN."
+        return best[0].store.row(best[1]), ""
+
+    def add_book(self, new_book):
+        '''
+        Adds a book to the shard owning its ISBN, updating only that shard's index and views.
+        The book is normalized first, as by main.add_book, and logged before it is applied
+
+        @param new_book: list containing the new book's data
+        @raise ValueError: raises an exception if the new book's values are invalid or its ISBN is taken
+        '''
+        record = normalize.parse_book(new_book)
+        new_book = normalize.format_record(record)
+        if self.shard_for(new_book[isbn]).isbn_index.get(new_book[isbn]):
+            raise ValueError(f"A book with ISBN {new_book[isbn]} is already in the catalogue.")
+        if self.wal is not None:
+            self.wal.log_add(new_book)
+        shard, row_id = self.append_record(record)
+        for view in shard.sorted_views.values():
+            view.insert(row_id)
+        self.dirty = True
+
+    def delete_book(self, isbn_value):
+        '''
+        Deletes the first book with an ISBN from the shard owning it
+
+        @param isbn_value: str ISBN of the book
+        @raise Exception: raises an exception if no book has that ISBN
+        '''
+        isbn_value = normalize.isbn_search_term(isbn_value)
+        shard = self.shard_for(isbn_value)
+        matches = shard.isbn_index.get(isbn_value)
+        if not matches:
+            raise Exception(f"Book with ISBN {isbn_value} is not present, and therefore cannot be deleted.")
+        if self.wal is not None:
+            self.wal.log_delete(isbn_value)
+        row_id = matches.pop(0)
+        if not matches:
+            del shard.isbn_index[isbn_value]
+        for view in shard.sorted_views.values():
+            view.remove(row_id)
+        shard.store.delete(row_id)
+        self.dirty = True
@@ -0,0 +1,204 @@
+'''
+Versioned binary snapshot of the loaded catalogue: the BookStore columns
+and string pools, the ascending sorted views with their numeric keys and
+the log generation they include. It is written after a full rebuild and
+read back at startup with one bulk read, so a large catalogue is
+searchable without re-parsing the CSV or re-sorting it. The snapshot
+records the size, mtime and SHA-256 of the source CSV it was built from
+and is ignored once the source no longer matches
+
+    header:   MAGIC, version and header length (struct HEADER), then the header as JSON
+    sections: raw array bytes, each starting on an 8 byte boundary
+'''
+import hashlib
+import json
+import os
+import struct
+import sys
+from array import array
+import book_keys
+import instrumentation
+import journal
+from book_store import BookStore
+from views import SortedView
+
+SNAPSHOT_FILENAME = 'data/catalogue.snapshot'
+MAGIC = b'BOOKSNAP'
+VERSION = 1
+HEADER = struct.Struct('<8sII')
+ALIGNMENT = 8
+HASH_CHUNK_BYTES = 1024 * 1024
+COLUMNS = ['isbns', 'lengths', 'dates', 'title_ids', 'author_ids']
+
+
+def file_hash(filename):
+    '''
+    @param filename: file path
+    @return digest: str hex SHA-256 of the file's contents
+    '''
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as file:
+        for chunk in iter(lambda: file.read(HASH_CHUNK_BYTES), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def source_signature(source):
+    '''
+    @param source: file path of the catalogue CSV
+    @return signature: dict with the source's 'size' and 'mtime_ns', or None if it is missing
+    '''
+    try:
+        stat = os.stat(source)
+    except FileNotFoundError:
+        return None
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def pool_sections(pool):
+    '''
+    @param pool: StringPool
+    @return text, offsets: array of the pool's strings joined as UTF-8 and array of their character offsets
+    '''
+    offsets = array('Q', [0])
+    for value in pool.strings:
+        offsets.append(offsets[-1] + len(value))
+    return array('B', ''.join(pool.strings).encode(journal.ENCODING)), offsets
+
+
+def write_snapshot(store, sorted_views, generation, source, signature, filename=SNAPSHOT_FILENAME):
+    '''
+    Writes a snapshot atomically. Deleted rows are kept, so the row ids of
+    the views stay valid
+
+    @param store: BookStore
+    @param sorted_views: dict mapping attribute to its ascending SortedView
+    @param generation: int log generation the store includes
+    @param source: file path of the catalogue CSV the store was loaded from
+    @param signature: dict from source_signature, taken when the source was loaded
+    @param filename: file path of the snapshot
+    @return written: bool, False if the source changed since it was loaded
+    '''
+    if signature is None or source_signature(source) != signature:
+        return False
+    sections = [(name, getattr(store, name)) for name in COLUMNS]
+    sections.append(('deleted', array('B', store.deleted)))
+    for name, pool in (('titles', store.titles), ('authors', store.authors)):
+        text, offsets = pool_sections(pool)
+        sections += [(name, text), (name + '_offsets', offsets)]
+    for attribute, view in sorted_views.items():
+        sections.append((f'view_{attribute}', view.row_ids))
+        if attribute not in (book_keys.title, book_keys.author):
+            sections.append((f'keys_{attribute}', view.keys))
+    header = {
+        'source': dict(signature, sha256=file_hash(source)),
+        'generation': generation,
+        'rows': len(store.deleted),
+        'deleted_count': store.deleted_count,
+        'byteorder': sys.byteorder,
+        'views': sorted(sorted_views),
+        'sections': [],
+    }
+    offset = 0
+    for name, values in sections:
+        offset += -offset % ALIGNMENT
+        header['sections'].append([name, values.typecode, values.itemsize, offset, len(values)])
+        offset += len(values) * values.itemsize
+    header_bytes = json.dumps(header).encode(journal.ENCODING)
+    # sections are laid out from the first aligned offset after the header
+    start = HEADER.size + len(header_bytes)
+    start += -start % ALIGNMENT
+    temp_file = journal.temp_filename(filename)
+    with open(temp_file, 'wb') as file:
+        file.write(HEADER.pack(MAGIC, VERSION, len(header_bytes)))
+        file.write(header_bytes)
+        for (name, values), layout in zip(sections, header['sections']):
+            file.seek(start + layout[3])
+            values.tofile(file)
+        journal.sync(file)
+        if instrumentation.enabled:
+            instrumentation.count('io.bytes_written', file.tell())
+    os.replace(temp_file, filename)
+    return True
+
+
+def read_header(content):
+    '''
+    @param content: bytes of the snapshot file
+    @return header, start: dict header and int offset of the first section, or (None, 0) if unreadable
+    '''
+    if len(content) < HEADER.size:
+        return None, 0
+    magic, version, header_length = HEADER.unpack_from(content)
+    if magic != MAGIC or version != VERSION:
+        return None, 0
+    try:
+        header = json.loads(bytes(content[HEADER.size:HEADER.size + header_length]).decode(journal.ENCODING))
+    except ValueError:
+        return None, 0
+    start = HEADER.size + header_length
+    return header, start + -start % ALIGNMENT
+
+
+def is_valid(header, source):
+    '''
+    A source with the recorded size and mtime is taken as unchanged. One
+    with the same size but another mtime, e.g. after a copy or touch, is
+    hashed, so the snapshot survives anything that keeps the contents
+
+    @param header: dict snapshot header
+    @param source: file path of the catalogue CSV
+    @return valid: bool
+    '''
+    recorded = header['source']
+    signature = source_signature(source)
+    if signature is None or signature['size'] != recorded['size'] or header['byteorder'] != sys.byteorder:
+        return False
+    return signature['mtime_ns'] == recorded['mtime_ns'] or file_hash(source) == recorded['sha256']
+
+
+def read_pool(pool, text, offsets):
+    text = text.tobytes().decode(journal.ENCODING)
+    pool.strings = [text[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
+    pool.ids = dict(zip(pool.strings, range(len(pool.strings))))
+
+
+def load_snapshot(source, filename=SNAPSHOT_FILENAME):
+    '''
+    Reads a snapshot back if it was built from the current source
+
+    @param source: file path of the catalogue CSV
+    @param filename: file path of the snapshot
+    @return store, sorted_views, generation: BookStore, dict mapping attribute to
+    its ascending SortedView and int log generation, or None if there is no valid snapshot
+    '''
+    try:
+        with open(filename, 'rb') as file:
+            content = memoryview(file.read())
+    except FileNotFoundError:
+        return None
+    if instrumentation.enabled:
+        instrumentation.count('io.bytes_read', len(content))
+    header, start = read_header(content)
+    if header is None or not is_valid(header, source):
+        return None
+    sections = {}
+    for name, typecode, itemsize, offset, count in header['sections']:
+        values = array(typecode)
+        end = start + offset + count * itemsize
+        # another platform's item sizes, or a file cut short
+        if values.itemsize != itemsize or end > len(content):
+            return None
+        values.frombytes(content[start + offset:end])
+        sections[name] = values
+    store = BookStore()
+    for name in COLUMNS:
+        setattr(store, name, sections[name])
+    store.deleted = bytearray(sections['deleted'])
+    store.deleted_count = header['deleted_count']
+    read_pool(store.titles, sections['titles'], sections['titles_offsets'])
+    read_pool(store.authors, sections['authors'], sections['authors_offsets'])
+    sorted_views = {attribute: SortedView(attribute, store, sections[f'view_{attribute}'],
+                                          keys=sections.get(f'keys_{attribute}'))
+                    for attribute in header['views']}
+    return store, sorted_views, header['generation']
@@ -0,0 +1,381 @@
+'''
+Every strategy sorts a list of row indexes (a permutation) against a
+precomputed list of typed keys, so a comparison is a plain `<` between
+two keys rather than a column lookup plus type conversion. Sorting is
+always ascending; descending order is produced afterwards by
+reverse_stable instead of being re-checked on every comparison.
+'''
+import operator
+import instrumentation
+
+# strategy names accepted by sort_permutation:
+lomuto = 'lomuto'
+introsort = 'introsort'
+timsort = 'timsort'
+radix = 'radix'
+auto = 'auto'
+DEFAULT_STRATEGY = auto
+# ranges at or below this size are finished with insertion sort:
+INSERTION_SORT_CUTOFF = 16
+# ranges above this size use Tukey's ninther rather than median-of-three:
+NINTHER_THRESHOLD = 40
+# smallest run length the Timsort-style strategy builds before merging:
+MIN_RUN = 32
+
+
+def insertion_sort(items, low, high, keys):
+    '''
+    Sorts items[low..high] in place with a straight insertion sort.
+    Used by the other strategies to finish off small ranges
+
+    @param items: list of indexes into keys being sorted
+    @param low: int index of first element of the range
+    @param high: int index of last element of the range
+    @param keys: list of sort keys
+    '''
+    for i in range(low + 1, high + 1):
+        item = items[i]
+        item_key = keys[item]
+        j = i - 1
+        while j >= low and item_key < keys[items[j]]:
+            items[j + 1] = items[j]
+            j -= 1
+        items[j + 1] = item
+
+
+def lomuto_sort(items, keys, less=operator.lt):
+    '''
+    Iterative quicksort using Lomuto partitioning around the right-most element.
+    This is the original sort_books algorithm and is kept so its output
+    can still be reproduced exactly. Quadratic on sorted input
+
+    @param items: list of indexes into keys being sorted in place
+    @param keys: list of sort keys
+    @param less: comparison, operator.gt reproduces the original descending sort
+    '''
+    stack = [(0, len(items) - 1)]
+    while stack:
+        low, high = stack.pop()
+        if low < high:
+            pivot = keys[items[high]]
+            i = low - 1
+            for j in range(low, high):
+                # element belongs on the left unless the pivot sorts before it
+                if not less(pivot, keys[items[j]]):
+                    i += 1
+                    items[i], items[j] = items[j], items[i]
+            items[i + 1], items[high] = items[high], items[i + 1]
+            stack.append((low, i))
+            stack.append((i + 2, high))
+
+
+def median_of_three(items, a, b, c, keys):
+    '''
+    Returns whichever of the positions a, b and c holds the median key
+
+    @return index: int position of the median element
+    '''
+    key_a, key_b, key_c = keys[items[a]], keys[items[b]], keys[items[c]]
+    if key_a < key_b:
+        if key_b < key_c:
+            return b
+        return c if key_a < key_c else a
+    if key_a < key_c:
+        return a
+    return c if key_b < key_c else b
+
+
+def choose_pivot(items, low, high, keys):
+    '''
+    Picks a pivot position for items[low..high] using median-of-three,
+    or Tukey's ninther (median of three medians) for larger ranges
+
+    @return index: int position of the chosen pivot
+    '''
+    middle = (low + high) // 2
+    if high - low + 1 > NINTHER_THRESHOLD:
+        step = (high - low + 1) // 8
+        first = median_of_three(items, low, low + step, low + 2 * step, keys)
+        second = median_of_three(items, middle - step, middle, middle + step, keys)
+        third = median_of_three(items, high - 2 * step, high - step, high, keys)
+        return median_of_three(items, first, second, third, keys)
+    return median_of_three(items, low, middle, high, keys)
+
+
+def heap_sort(items, low, high, keys):
+    '''
+    Sorts items[low..high] in place with heapsort. Used by introsort
+    as a fallback when a range has been partitioned too many times
+
+    @param items: list of indexes into keys being sorted
+    @param low: int index of first element of the range
+    @param high: int index of last element of the range
+    @param keys: list of sort keys
+    '''
+    count = high - low + 1
+
+    def sift_down(root, end):
+        while True:
+            child = 2 * root + 1
+            if child >= end:
+                return
+            if child + 1 < end and keys[items[low + child]] < keys[items[low + child + 1]]:
+                child += 1
+            if not keys[items[low + root]] < keys[items[low + child]]:
+                return
+            items[low + root], items[low + child] = items[low + child], items[low + root]
+            root = child
+
+    for start in range(count // 2 - 1, -1, -1):
+        sift_down(start, count)
+    for end in range(count - 1, 0, -1):
+        items[low], items[low + end] = items[low + end], items[low]
+        sift_down(0, end)
+
+
+def intro_sort(items, keys):
+    '''
+    Iterative introsort: ninther/median-of-three pivots, three-way
+    partitioning so runs of equal keys (e.g. repeated authors) are
+    removed in one pass, an insertion sort cutoff for small ranges
+    and a heapsort fallback once the depth limit is reached
+
+    @param items: list of indexes into keys being sorted in place
+    @param keys: list of sort keys
+    '''
+    if len(items) <= 1:
+        return
+    depth_limit = 2 * (len(items).bit_length())
+    stack = [(0, len(items) - 1, depth_limit)]
+    while stack:
+        low, high, depth = stack.pop()
+        if high - low + 1 <= INSERTION_SORT_CUTOFF:
+            insertion_sort(items, low, high, keys)
+            continue
+        if depth == 0:
+            heap_sort(items, low, high, keys)
+            continue
+        lt, gt = partition_three_way(items, low, high, keys)
+        stack.append((low, lt - 1, depth - 1))
+        stack.append((gt + 1, high, depth - 1))
+
+
+def partition_three_way(items, low, high, keys):
+    '''
+    Dijkstra three-way partition of items[low..high] around a pivot
+    chosen by choose_pivot, into < pivot, == pivot and > pivot
+
+    @return lt, gt: int positions of the first and last element equal to the pivot
+    '''
+    pivot = keys[items[choose_pivot(items, low, high, keys)]]
+    lt, i, gt = low, low, high
+    while i <= gt:
+        item_key = keys[items[i]]
+        if item_key < pivot:
+            items[lt], items[i] = items[i], items[lt]
+            lt += 1
+            i += 1
+        elif pivot < item_key:
+            items[i], items[gt] = items[gt], items[i]
+            gt -= 1
+        else:
+            i += 1
+    return lt, gt
+
+
+def intro_select(items, rank, keys):
+    '''
+    Introselect: quickselect with the introsort pivots and three-way
+    partition, following only the side that holds the wanted rank. A
+    range still undecided at the depth limit is heapsorted, so the
+    expected O(n) cost never degrades past O(n log n)
+
+    @param items: list of indexes into keys, partially reordered in place
+    @param rank: int 0-based position the item would have in sorted order
+    @param keys: list of sort keys
+    @return item: the index of rank rank; items[rank] holds it afterwards
+    @raise IndexError: raises an exception if rank is outside items
+    '''
+    if not 0 <= rank < len(items):
+        raise IndexError("Selection rank out of range.")
+    low, high = 0, len(items) - 1
+    depth = 2 * (len(items).bit_length())
+    while True:
+        if high - low + 1 <= INSERTION_SORT_CUTOFF:
+            insertion_sort(items, low, high, keys)
+            return items[rank]
+        if depth == 0:
+            heap_sort(items, low, high, keys)
+            return items[rank]
+        depth -= 1
+        lt, gt = partition_three_way(items, low, high, keys)
+        if rank < lt:
+            high = lt - 1
+        elif rank > gt:
+            low = gt + 1
+        else:
+            return items[rank]
+
+
+def merge_runs(items, low, middle, high, keys):
+    '''
+    Stable merge of the adjacent sorted runs items[low:middle] and items[middle:high]
+    '''
+    left = items[low:middle]
+    i, j, k = 0, middle, low
+    while i < len(left) and j < high:
+        # take from the right run only when it strictly sorts first, keeping ties stable
+        if keys[items[j]] < keys[left[i]]:
+            items[k] = items[j]
+            j += 1
+        else:
+            items[k] = left[i]
+            i += 1
+        k += 1
+    while i < len(left):
+        items[k] = left[i]
+        i += 1
+        k += 1
+
+
+def tim_sort(items, keys):
+    '''
+    Stable Timsort-style sort. Finds natural runs (reversing strictly
+    descending ones), extends short runs to MIN_RUN with insertion sort
+    and merges runs off a stack that keeps run lengths balanced.
+    Already sorted or reversed input is handled in a single linear pass
+
+    @param items: list of indexes into keys being sorted in place
+    @param keys: list of sort keys
+    '''
+    count = len(items)
+    runs = []
+    start = 0
+    while start < count:
+        end = start + 1
+        if end < count:
+            if keys[items[end]] < keys[items[start]]:
+                while end < count and keys[items[end]] < keys[items[end - 1]]:
+                    end += 1
+                items[start:end] = items[start:end][::-1]
+            else:
+                while end < count and not keys[items[end]] < keys[items[end - 1]]:
+                    end += 1
+        if end - start < MIN_RUN:
+            end = min(start + MIN_RUN, count)
+            insertion_sort(items, start, end - 1, keys)
+        runs.append((start, end))
+        # merge while the top three runs break the Timsort length invariants
+        while len(runs) > 1:
+            if len(runs) > 2 and runs[-3][1] - runs[-3][0] <= (runs[-2][1] - runs[-2][0]) + (runs[-1][1] - runs[-1][0]):
+                if runs[-3][1] - runs[-3][0] < runs[-1][1] - runs[-1][0]:
+                    merge_at = -3
+                else:
+                    merge_at = -2
+            elif runs[-2][1] - runs[-2][0] <= runs[-1][1] - runs[-1][0]:
+                merge_at = -2
+            else:
+                break
+            first, second = runs[merge_at], runs[merge_at + 1]
+            merge_runs(items, first[0], first[1], second[1], keys)
+            runs[merge_at] = (first[0], second[1])
+            del runs[merge_at + 1]
+        start = end
+    while len(runs) > 1:
+        first, second = runs[-2], runs[-1]
+        merge_runs(items, first[0], first[1], second[1], keys)
+        runs[-2:] = [(first[0], second[1])]
+
+
+def radix_sort(items, keys):
+    '''
+    Stable LSD radix sort, one byte per pass, for integer keys of
+    bounded width such as ISBNs and date ordinals. Keys are offset by
+    the smallest key so only the bytes that actually vary are passed over
+
+    @param items: list of indexes into keys being sorted in place
+    @param keys: list of int sort keys
+    @raise ValueError: raises an exception if the keys are not ints
+    '''
+    if not items:
+        return
+    smallest = min(keys[item] for item in items)
+    largest = max(keys[item] for item in items)
+    if not isinstance(smallest, int) or not isinstance(largest, int):
+        raise ValueError("Radix sort is only available for integer keys.")
+    span = largest - smallest
+    shift = 0
+    order = items[:]
+    while (span >> shift) > 0:
+        buckets = [[] for _ in range(256)]
+        for item in order:
+            buckets[((keys[item] - smallest) >> shift) & 0xFF].append(item)
+        order = [item for bucket in buckets for item in bucket]
+        shift += 8
+    items[:] = order
+
+
+def reverse_stable(permutation, keys):
+    '''
+    Turns an ascending permutation into a descending one by reversing it
+    group by group, so books with equal keys keep their ascending order
+
+    @param permutation: list of indexes sorted ascending by keys
+    @param keys: list of sort keys
+    @return reversed_permutation: list of indexes sorted descending by keys
+    '''
+    reversed_permutation = []
+    end = len(permutation)
+    while end > 0:
+        start = end - 1
+        group_key = keys[permutation[start]]
+        while start > 0 and keys[permutation[start - 1]] == group_key:
+            start -= 1
+        reversed_permutation.extend(permutation[start:end])
+        end = start
+    return reversed_permutation
+
+
+def sort_permutation(keys, reverse=False, strategy=DEFAULT_STRATEGY, fixed_width=False, items=None):
+    '''
+    Sorts the indexes of keys with the selected strategy
+
+    @param keys: list of typed sort keys, one per book
+    @param reverse: bool, True for descending order
+    @param strategy: one of lomuto/introsort/timsort/radix/auto. auto uses
+    radix for fixed-width integer columns, otherwise timsort. Both are
+    stable, so books with equal keys keep their order in the input
+    @param fixed_width: bool, True when keys are bounded-width ints (ISBN/date)
+    @param items: iterable of the indexes to sort, defaults to every index of keys
+    @return permutation: list of indexes into keys in sorted order
+    @raise ValueError: raises an exception for an unknown or unusable strategy
+    '''
+    permutation = list(range(len(keys)) if items is None else items)
+    if strategy == auto:
+        strategy = radix if fixed_width else timsort
+    tally = None
+    if instrumentation.enabled:
+        # counts through wrappers so the sort loops themselves carry no instrumentation
+        tally = [0]
+        permutation = instrumentation.CountingList(permutation)
+        if strategy != radix:
+            keys = [instrumentation.CountingKey(key, tally) for key in keys]
+    if strategy == lomuto:
+        # the legacy sort is unstable, so it keeps its own descending comparison
+        lomuto_sort(permutation, keys, operator.gt if reverse else operator.lt)
+    elif strategy == introsort:
+        intro_sort(permutation, keys)
+    elif strategy == timsort:
+        tim_sort(permutation, keys)
+    elif strategy == radix:
+        radix_sort(permutation, keys)
+    else:
+        raise ValueError(f"Unknown sort strategy: {strategy}")
+    if reverse and strategy != lomuto:
+        permutation = reverse_stable(permutation, keys)
+    if tally is not None:
+        if strategy != radix:
+            instrumentation.count(f'sort.{strategy}.comparisons', tally[0])
+        instrumentation.count(f'sort.{strategy}.moves', getattr(permutation, 'moves', 0))
+        permutation = list(permutation)
+    return permutation
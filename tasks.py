@@ -0,0 +1,151 @@
+'''
+Background task runner for the GUI. Sorting, indexing and file writes
+run one at a time on a worker thread so the Tk mainloop never blocks.
+Results, errors and progress messages are handed back to the UI thread
+by polling with window.after, since Tk widgets may only be touched from
+the thread running the mainloop
+'''
+import queue
+import threading
+from collections import deque
+
+# how often, in milliseconds, the UI thread collects finished work:
+POLL_INTERVAL_MS = 50
+
+
+class Task:
+    '''
+    A unit of work waiting for, or running on, the worker thread
+    '''
+
+    def __init__(self, fn, args, key, on_done, on_error, on_progress):
+        self.fn = fn
+        self.args = args
+        self.key = key
+        self.on_done = on_done
+        self.on_error = on_error
+        self.on_progress = on_progress
+        self.cancelled = False
+
+
+class TaskRunner:
+    '''
+    Runs submitted tasks in order on a single worker thread. Running them
+    serially means tasks that mutate the book data never overlap. A task
+    submitted with a key replaces any task with the same key that has not
+    started yet, so e.g. five quick adds lead to one flush of the views
+    '''
+
+    def __init__(self, schedule):
+        '''
+        @param schedule: function taking (milliseconds, callback), normally window.after
+        '''
+        self.schedule = schedule
+        self.pending = deque()
+        self.condition = threading.Condition()
+        self.results = queue.Queue()
+        self.running = None
+        self.stopped = False
+        self.worker = threading.Thread(target=self.work, name="TaskRunner", daemon=True)
+
+    def start(self):
+        self.worker.start()
+        self.schedule(POLL_INTERVAL_MS, self.poll)
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+    def submit(self, fn, *args, key=None, on_done=None, on_error=None, on_progress=None):
+        '''
+        Queues fn(*args) to run on the worker thread. If on_progress is given,
+        fn is also passed a progress keyword argument: a function it can
+        call with a message to have on_progress called on the UI thread
+
+        @param fn: function to run
+        @param key: hashable; a pending task with the same key is superseded by this one
+        @param on_done: function called on the UI thread with fn's return value
+        @param on_error: function called on the UI thread with the exception fn raised
+        @param on_progress: function called on the UI thread with each progress message
+        @return task: Task, which can be passed to cancel
+        '''
+        task = Task(fn, args, key, on_done, on_error, on_progress)
+        with self.condition:
+            if key is not None:
+                self.cancel_pending(key)
+            self.pending.append(task)
+            self.condition.notify()
+        return task
+
+    def cancel_pending(self, key):
+        '''
+        Drops queued tasks with the given key. Must be called holding the condition
+        '''
+        for task in self.pending:
+            if task.key == key:
+                task.cancelled = True
+        self.pending = deque(task for task in self.pending if not task.cancelled)
+
+    def cancel(self, task):
+        '''
+        Cancels a task that has not started yet
+
+        @param task: Task returned by submit
+        @return cancelled: bool, False if the task already started
+        '''
+        with self.condition:
+            if task in self.pending:
+                self.pending.remove(task)
+                task.cancelled = True
+                return True
+        return False
+
+    def is_busy(self, key=None):
+        '''
+        @param key: only consider tasks with this key, or None for any task
+        @return busy: bool, True if a matching task is queued or running
+        '''
+        with self.condition:
+            tasks = list(self.pending) + ([self.running] if self.running else [])
+        return any(key is None or task.key == key for task in tasks)
+
+    def work(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                task = self.pending.popleft()
+                self.running = task
+            try:
+                if task.on_progress is not None:
+                    progress = lambda message, task=task: self.results.put((task.on_progress, message))
+                    result = task.fn(*task.args, progress=progress)
+                else:
+                    result = task.fn(*task.args)
+            except Exception as e:
+                if task.on_error is not None:
+                    self.results.put((task.on_error, e))
+                else:
+                    print(f"An error occurred in a background task: {e}")
+            else:
+                if task.on_done is not None:
+                    self.results.put((task.on_done, result))
+            finally:
+                with self.condition:
+                    self.running = None
+
+    def poll(self):
+        '''
+        Runs on the UI thread: calls the callbacks of finished work, then reschedules itself
+        '''
+        while True:
+            try:
+                callback, value = self.results.get_nowait()
+            except queue.Empty:
+                break
+            callback(value)
+        if not self.stopped:
+            self.schedule(POLL_INTERVAL_MS, self.poll)
@@ -0,0 +1,201 @@
+'''
+Full-text and typo-tolerant search over titles and authors. Each
+distinct title (or author) in the BookStore string pool is split into
+words, and an inverted index maps every word to the posting list of
+strings containing it. A second index maps character trigrams to the
+words of the vocabulary, so a misspelt or partial query word is
+expanded to the known words it most resembles before the posting
+lists are read. Matches are ranked by IDF-weighted word similarity and
+only the top k are returned
+'''
+import heapq
+import math
+import re
+from collections import defaultdict
+from book_keys import title, author
+
+WORD = re.compile(r'\w+')
+DEFAULT_LIMIT = 10
+# how alike (Dice coefficient over trigrams) a word must be to count as a typo of a query word:
+MIN_SIMILARITY = 0.5
+# a query word is expanded to at most this many similar words:
+MAX_EXPANSIONS = 8
+# weight of a word that the query word is only a prefix of, relative to an exact match:
+PREFIX_WEIGHT = 0.9
+# strings scored per query; posting lists of very common words are cut off here:
+MAX_CANDIDATES = 5000
+
+
+def tokenize(text):
+    '''
+    @param text: str title, author or query
+    @return words: list of casefolded words
+    '''
+    return WORD.findall(text.casefold())
+
+
+def trigrams(word):
+    '''
+    @param word: str
+    @return trigrams: set of str, padded so short words and word starts count
+    '''
+    padded = f'  {word} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class TextIndex:
+    '''
+    Inverted and trigram index over one text column of a BookStore. Strings
+    are indexed once however many books share them, and books are
+    attached to their string as they are added and deleted
+    '''
+
+    def __init__(self, store, attribute):
+        '''
+        @param store: BookStore to index
+        @param attribute: title or author
+        @raise ValueError: raises an exception for columns that are not text
+        '''
+        if attribute == title:
+            self.pool, self.string_ids = store.titles, store.title_ids
+        elif attribute == author:
+            self.pool, self.string_ids = store.authors, store.author_ids
+        else:
+            raise ValueError("Text search is only available for title and author.")
+        self.store = store
+        self.attribute = attribute
+        # word -> list of string ids, in the order the strings were first indexed
+        self.postings = defaultdict(list)
+        # trigram -> set of words of the vocabulary containing it
+        self.word_trigrams = defaultdict(set)
+        # string id -> list of live row ids, and the words of the string
+        self.rows_by_string = {}
+        self.words_by_string = {}
+        for row_id in store.live_row_ids():
+            self.add(row_id)
+
+    def __len__(self):
+        '''
+        @return count: int number of distinct strings with at least one live book
+        '''
+        return sum(1 for row_ids in self.rows_by_string.values() if row_ids)
+
+    def index_string(self, string_id):
+        words = tokenize(self.pool.strings[string_id])
+        self.words_by_string[string_id] = tuple(words)
+        for word in set(words):
+            if word not in self.postings:
+                for trigram in trigrams(word):
+                    self.word_trigrams[trigram].add(word)
+            self.postings[word].append(string_id)
+
+    def add(self, row_id):
+        '''
+        Indexes a book added to the store
+
+        @param row_id: int row id of the book
+        '''
+        string_id = self.string_ids[row_id]
+        row_ids = self.rows_by_string.get(string_id)
+        if row_ids is None:
+            row_ids = self.rows_by_string[string_id] = []
+            self.index_string(string_id)
+        row_ids.append(row_id)
+
+    def remove(self, row_id):
+        '''
+        Detaches a deleted book. Its string stays in the posting lists
+        and is skipped while no live book refers to it
+
+        @param row_id: int row id of the book
+        '''
+        row_ids = self.rows_by_string.get(self.string_ids[row_id])
+        if row_ids and row_id in row_ids:
+            row_ids.remove(row_id)
+
+    def expand(self, query_word, partial=False):
+        '''
+        Finds the indexed words a query word may stand for. A known word
+        stands for itself; an unknown one for the words within
+        MIN_SIMILARITY of it. Either may also stand for the words it is a
+        prefix of, when it is the word still being typed
+
+        @param query_word: str casefolded word
+        @param partial: bool, True to include the words query_word is a prefix of
+        @return expansions: list of (word, weight) with weight in (0, 1], best first
+        '''
+        expansions = {}
+        known = query_word in self.postings
+        if known:
+            expansions[query_word] = 1.0
+            if not partial:
+                return list(expansions.items())
+        query_trigrams = trigrams(query_word)
+        shared = defaultdict(int)
+        for trigram in query_trigrams:
+            for word in self.word_trigrams.get(trigram, ()):
+                shared[word] += 1
+        for word, count in shared.items():
+            if word == query_word:
+                continue
+            if partial and word.startswith(query_word):
+                expansions[word] = PREFIX_WEIGHT
+            elif not known:
+                # a padded word of n characters has n + 1 trigrams
+                similarity = 2 * count / (len(query_trigrams) + len(word) + 1)
+                if similarity >= MIN_SIMILARITY:
+                    expansions[word] = similarity
+        return heapq.nlargest(MAX_EXPANSIONS, expansions.items(), key=lambda expansion: expansion[1])
+
+    def search(self, query, limit=DEFAULT_LIMIT):
+        '''
+        Ranks the indexed strings against a free-text query
+
+        @param query: str words to look for, possibly misspelt or partial
+        @param limit: int maximum number of books returned
+        @return results: list of (score, row id) tuples, best first
+        '''
+        query_words = tokenize(query)
+        if not query_words or limit <= 0:
+            return []
+        total = max(1, len(self.rows_by_string))
+        weighted = []
+        for position, query_word in enumerate(query_words):
+            # the last word may still be being typed, so it also matches as a prefix
+            expansions = self.expand(query_word, partial=position == len(query_words) - 1)
+            terms = [(word, weight * math.log(1 + total / len(self.postings[word])))
+                     for word, weight in expansions]
+            if query_word in self.postings:
+                # a longer word the query word starts with never outranks the word itself,
+                # however much rarer it is
+                exact_score = terms[0][1]
+                terms = [terms[0]] + [(word, min(score, exact_score * PREFIX_WEIGHT)) for word, score in terms[1:]]
+            if terms:
+                weighted.append(terms)
+        if not weighted:
+            return []
+        # candidates come from the posting lists of the rarest query word; the other
+        # words are then checked against each candidate's own words
+        weighted.sort(key=lambda terms: sum(len(self.postings[word]) for word, score in terms))
+        candidates = {}
+        for word, score in weighted[0]:
+            for string_id in self.postings[word]:
+                if string_id not in candidates:
+                    if len(candidates) >= MAX_CANDIDATES:
+                        break
+                    if self.rows_by_string.get(string_id):
+                        candidates[string_id] = score
+        ranked = []
+        for string_id, score in candidates.items():
+            words = self.words_by_string[string_id]
+            for terms in weighted[1:]:
+                score += max((term_score for word, term_score in terms if word in words), default=0.0)
+            # shorter strings rank above longer ones with the same matching words
+            ranked.append((score / (1 + 0.05 * len(words)), string_id))
+        results = []
+        for score, string_id in heapq.nlargest(limit, ranked, key=lambda match: (match[0], -match[1])):
+            for row_id in self.rows_by_string[string_id]:
+                results.append((score, row_id))
+                if len(results) == limit:
+                    return results
+        return results
@@ -0,0 +1,190 @@
+'''
+Bounded LRU cache of parsed sorted CSV views, keyed by (attribute,
+order), so repeated searches and display toggles do not re-read and
+re-parse the same file. An entry is dropped when the file's size,
+mtime or inode changes (os.replace gives a rewritten view a new inode)
+or when the write path invalidates it, and the least recently used
+entries are evicted once the cached views exceed a byte budget
+'''
+import csv
+import os
+import threading
+from collections import OrderedDict
+import instrumentation
+import view_index
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+# rough per-row cost of a parsed row beyond its text (list and five str objects):
+ROW_OVERHEAD_BYTES = 300
+
+
+class CachedView:
+    '''
+    Parsed rows of one view with the file signature they were read at
+    '''
+
+    def __init__(self, filename, signature, rows, nbytes):
+        self.filename = filename
+        self.signature = signature
+        self.rows = rows
+        self.nbytes = nbytes
+
+
+def file_signature(filename):
+    '''
+    @param filename: file path
+    @return signature: tuple (size, mtime in ns, inode), or None if the file is missing
+    '''
+    try:
+        stat = os.stat(filename)
+    except FileNotFoundError:
+        return None
+    return stat.st_size, stat.st_mtime_ns, stat.st_ino
+
+
+def estimate_bytes(row_count, file_size):
+    return file_size + row_count * ROW_OVERHEAD_BYTES
+
+
+class ViewCache:
+    '''
+    LRU cache of parsed views bounded by their estimated size in memory
+    '''
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        '''
+        @param max_bytes: int budget for all cached views together
+        '''
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        # signature of each file that was read but did not fit, so it is not read again for nothing
+        self.rejected = {}
+        # the display screen and the background task runner share the cache
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def fits(self, filename):
+        '''
+        Applies the same estimate as load, with the row count from the
+        view's sidecar, or else from having read the file before
+
+        @param filename: file path of a sorted CSV view
+        @return fits: bool, False if the view could not be cached within the budget
+        '''
+        signature = file_signature(filename)
+        if signature is None or signature[0] > self.max_bytes:
+            return False
+        with self.lock:
+            if self.rejected.get(filename) == signature:
+                return False
+        row_count = view_index.sidecar_count(filename)
+        return row_count is None or estimate_bytes(row_count, signature[0]) <= self.max_bytes
+
+    def cached(self, attribute, order, filename):
+        '''
+        Returns the parsed rows of a view only if they are cached and current, never reading the file
+
+        @return rows: list of lists of str, or None
+        '''
+        with self.lock:
+            entry = self.entries.get((attribute, order))
+            if entry is None or entry.filename != filename or entry.signature != file_signature(filename):
+                return None
+            self.hits += 1
+            if instrumentation.enabled:
+                instrumentation.count('view_cache.hit')
+            self.entries.move_to_end((attribute, order))
+            return entry.rows
+
+    def get(self, attribute, order, filename):
+        '''
+        Returns the parsed rows of a view, reading the file only if the
+        cached copy is missing or the file has changed since it was read
+
+        @param attribute: book attribute the view is sorted by
+        @param order: str value of either asc/desc
+        @param filename: file path of the sorted CSV
+        @return rows: list of lists of str. Do not modify them, they are shared
+        @raise FileNotFoundError: raises an exception if the file is missing
+        '''
+        with self.lock:
+            return self.load(attribute, order, filename)
+
+    def load(self, attribute, order, filename):
+        '''
+        get without taking the lock
+        '''
+        key = (attribute, order)
+        signature = file_signature(filename)
+        entry = self.entries.get(key)
+        if entry is not None:
+            if entry.filename == filename and entry.signature == signature:
+                self.hits += 1
+                if instrumentation.enabled:
+                    instrumentation.count('view_cache.hit')
+                self.entries.move_to_end(key)
+                return entry.rows
+            self.discard(key)
+            self.invalidations += 1
+        self.misses += 1
+        if instrumentation.enabled:
+            instrumentation.count('view_cache.miss')
+            instrumentation.count('io.bytes_read', signature[0] if signature else 0)
+        with open(filename, 'r', newline='') as csvfile:
+            rows = list(csv.reader(csvfile))
+        if signature is not None:
+            nbytes = estimate_bytes(len(rows), signature[0])
+            if nbytes <= self.max_bytes:
+                self.entries[key] = CachedView(filename, signature, rows, nbytes)
+                self.nbytes += nbytes
+                self.evict()
+            else:
+                self.rejected[filename] = signature
+        return rows
+
+    def discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.nbytes -= entry.nbytes
+
+    def evict(self):
+        while self.nbytes > self.max_bytes and self.entries:
+            key = next(iter(self.entries))
+            self.discard(key)
+            self.evictions += 1
+
+    def invalidate(self, attribute=None, order=None):
+        '''
+        Drops cached views, called by the write path when a view is rewritten
+
+        @param attribute: book attribute, or None for every attribute
+        @param order: str value of either asc/desc, or None for both
+        '''
+        with self.lock:
+            for key in list(self.entries):
+                if (attribute is None or key[0] == attribute) and (order is None or key[1] == order):
+                    self.discard(key)
+                    self.invalidations += 1
+
+    def stats(self):
+        '''
+        @return stats: dict of hit/miss/eviction/invalidation counts and memory use
+        '''
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else None,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+            'views': len(self.entries),
+            'bytes': self.nbytes,
+            'max_bytes': self.max_bytes,
+        }
@@ -0,0 +1,376 @@
+'''
+Binary sidecar files for the sorted CSV views. Next to each
+data/sorted_by_<attribute>_<order>_data.csv a .idx file holds one
+fixed-width record per row: an order-preserving key followed by the
+byte offset of that row in the CSV. Readers mmap the sidecar and
+binary-search it, reading only the CSV rows they actually need, so a
+search or a page of rows touches a handful of pages instead of the
+whole file
+'''
+import csv
+import io
+import mmap
+import os
+import struct
+from collections import OrderedDict
+import book_keys
+import journal
+import instrumentation
+from book_keys import title, author
+
+MAGIC = b'BKVIDX01'
+# magic, attribute, descending flag, key width, record count, size of the CSV it indexes
+HEADER = struct.Struct('>8sBBHQQ')
+OFFSET = struct.Struct('>Q')
+INT_KEY_WIDTH = 8
+# titles/authors are indexed by the first bytes of their UTF-8 text, so
+# equal prefixes are resolved by reading the rows themselves
+TEXT_KEY_WIDTH = 32
+ENCODING = 'utf-8'
+# rows the display screen fetches at a time, and how many of those blocks it keeps:
+DEFAULT_BLOCK_SIZE = 200
+DEFAULT_MAX_BLOCKS = 8
+
+
+def get_sidecar_filename(csv_filename):
+    '''
+    @param csv_filename: file path of a sorted CSV view
+    @return sidecar_filename: str file path of its binary index
+    '''
+    return os.path.splitext(csv_filename)[0] + '.idx'
+
+
+def get_key_width(attribute):
+    return TEXT_KEY_WIDTH if attribute in (title, author) else INT_KEY_WIDTH
+
+
+def encode_key(attribute, key):
+    '''
+    Encodes a typed key as fixed-width bytes whose byte order matches the key order.
+    UTF-8 byte order is code point order, which is how str keys compare
+
+    @param attribute: book attribute (e.g. author/title/etc)
+    @param key: typed key from book_keys
+    @return encoded: bytes of get_key_width(attribute) length
+    '''
+    if attribute in (title, author):
+        return key.encode(ENCODING)[:TEXT_KEY_WIDTH].ljust(TEXT_KEY_WIDTH, b'\0')
+    return key.to_bytes(INT_KEY_WIDTH, 'big')
+
+
+def write_view(rows, attribute, order, output_file):
+    '''
+    Writes a sorted view as CSV, in the same format as csv.writer produces,
+    together with its binary sidecar. Both are written to temporary files
+    and renamed into place, so readers never see a half-written view.
+    If a row's key cannot be derived the CSV is still written but the
+    sidecar is removed
+
+    @param rows: iterable of lists of str, already sorted
+    @param attribute: book attribute the rows are sorted by
+    @param order: str value of either asc/desc
+    @param output_file: file path of the CSV to write
+    '''
+    sidecar_file = get_sidecar_filename(output_file)
+    csv_temp = journal.temp_filename(output_file)
+    sidecar_temp = journal.temp_filename(sidecar_file)
+    column_key = book_keys.get_key_function(attribute)
+    key_width = get_key_width(attribute)
+    line_buffer = io.StringIO()
+    writer = csv.writer(line_buffer)
+    count = 0
+    indexable = True
+    try:
+        with open(csv_temp, 'wb') as csvfile, open(sidecar_temp, 'wb') as sidecar:
+            sidecar.write(HEADER.pack(MAGIC, attribute, order == 'desc', key_width, 0, 0))
+            for row in rows:
+                writer.writerow(row)
+                line = line_buffer.getvalue().encode(ENCODING)
+                line_buffer.seek(0)
+                line_buffer.truncate(0)
+                if indexable:
+                    try:
+                        sidecar.write(encode_key(attribute, column_key(row[attribute])) + OFFSET.pack(csvfile.tell()))
+                    except (ValueError, OverflowError, IndexError):
+                        indexable = False
+                csvfile.write(line)
+                count += 1
+            sidecar.seek(0)
+            sidecar.write(HEADER.pack(MAGIC, attribute, order == 'desc', key_width, count, csvfile.tell()))
+            if instrumentation.enabled:
+                instrumentation.count('io.bytes_written', csvfile.tell() + sidecar.seek(0, os.SEEK_END))
+            journal.sync(csvfile)
+            journal.sync(sidecar)
+        # the old sidecar goes first so it is never paired with the new CSV
+        if os.path.exists(sidecar_file):
+            os.remove(sidecar_file)
+        os.replace(csv_temp, output_file)
+        if indexable:
+            os.replace(sidecar_temp, sidecar_file)
+    finally:
+        for temp_file in (csv_temp, sidecar_temp):
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+
+
+def sidecar_count(csv_filename):
+    '''
+    Reads only the header of a view's sidecar, e.g. to size the view before parsing it
+
+    @param csv_filename: file path of a sorted CSV view
+    @return count: int number of rows in the view, or None if there is no valid, current sidecar
+    '''
+    try:
+        with open(get_sidecar_filename(csv_filename), 'rb') as sidecar:
+            header = sidecar.read(HEADER.size)
+        if len(header) < HEADER.size:
+            return None
+        magic, attribute, descending, key_width, count, csv_size = HEADER.unpack(header)
+        if magic != MAGIC or os.path.getsize(csv_filename) != csv_size:
+            return None
+    except FileNotFoundError:
+        return None
+    return count
+
+
+class ViewIndex:
+    '''
+    Read-only access to a sorted CSV view through its mmapped sidecar
+    '''
+
+    def __init__(self, csv_filename):
+        '''
+        @param csv_filename: file path of a sorted CSV view
+        @raise ValueError: raises an exception if the sidecar is missing, corrupt or out of date
+        '''
+        sidecar_file = get_sidecar_filename(csv_filename)
+        if not os.path.exists(sidecar_file):
+            raise ValueError(f"No index found for {csv_filename}.")
+        with open(sidecar_file, 'rb') as sidecar:
+            header = sidecar.read(HEADER.size)
+            if len(header) < HEADER.size:
+                raise ValueError(f"Index for {csv_filename} is corrupt.")
+            magic, self.attribute, descending, self.key_width, self.count, csv_size = HEADER.unpack(header)
+            if magic != MAGIC:
+                raise ValueError(f"Index for {csv_filename} is corrupt.")
+            if os.path.getsize(csv_filename) != csv_size:
+                raise ValueError(f"Index for {csv_filename} is out of date.")
+            self.descending = bool(descending)
+            self.record_size = self.key_width + OFFSET.size
+            self.csv_size = csv_size
+            self.index = mmap.mmap(sidecar.fileno(), 0, access=mmap.ACCESS_READ) if self.count else b''
+        self.csv_filename = csv_filename
+        self.csvfile = open(csv_filename, 'rb')
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        if isinstance(self.index, mmap.mmap):
+            self.index.close()
+        self.csvfile.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def key_at(self, position):
+        start = HEADER.size + position * self.record_size
+        return self.index[start:start + self.key_width]
+
+    def offset_at(self, position):
+        '''
+        @param position: int row position, count gives the end of the CSV
+        @return offset: int byte offset of the row in the CSV
+        '''
+        if position >= self.count:
+            return self.csv_size
+        start = HEADER.size + position * self.record_size + self.key_width
+        return OFFSET.unpack(self.index[start:start + OFFSET.size])[0]
+
+    def rows(self, start, stop):
+        '''
+        Reads the rows at positions start..stop-1 with a single CSV read
+
+        @param start: int first position
+        @param stop: int position after the last one
+        @return rows: list of lists of str
+        '''
+        start = max(0, start)
+        stop = min(self.count, stop)
+        if start >= stop:
+            return []
+        begin = self.offset_at(start)
+        self.csvfile.seek(begin)
+        size = self.offset_at(stop) - begin
+        if instrumentation.enabled:
+            instrumentation.count('io.bytes_read', size)
+        text = self.csvfile.read(size).decode(ENCODING)
+        return list(csv.reader(io.StringIO(text, newline='')))
+
+    def row(self, position):
+        return self.rows(position, position + 1)[0]
+
+    def lower_bound(self, encoded, low=0):
+        '''
+        @param encoded: bytes key from encode_key
+        @param low: int position to start searching from
+        @return position: int first position whose key does not sort before encoded
+        '''
+        high = self.count
+        while low < high:
+            middle = (low + high) // 2
+            key = self.key_at(middle)
+            if (key > encoded) if self.descending else (key < encoded):
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def search(self, value):
+        '''
+        Binary-searches the view for the first row whose attribute equals value
+
+        @param value: str attribute value as it appears in the CSV
+        @return position, row: int position and list of str, or (-1, None) if not found
+        '''
+        try:
+            encoded = encode_key(self.attribute, book_keys.get_key_function(self.attribute)(value))
+        except (ValueError, OverflowError):
+            return -1, None
+        return self.match_at(self.lower_bound(encoded), encoded, value)
+
+    def match_at(self, position, encoded, value):
+        '''
+        @param position: int lower bound of encoded
+        @param encoded: bytes key of value
+        @param value: str attribute value as it appears in the CSV
+        @return position, row: int position and list of str of the first match, or (-1, None)
+        '''
+        # truncated text keys can be shared by different values, so compare the rows themselves
+        while position < self.count and self.key_at(position) == encoded:
+            row = self.row(position)
+            if self.attribute not in (title, author) or row[self.attribute] == value:
+                return position, row
+            position += 1
+        return -1, None
+
+    def search_many(self, values):
+        '''
+        Resolves many searches with one merge pass over the view: the
+        distinct values are sorted into the view's order and each binary
+        search starts where the previous one stopped
+
+        @param values: iterable of str attribute values as they appear in the CSV
+        @return matches: dict mapping each value found to its first row
+        '''
+        column_key = book_keys.get_key_function(self.attribute)
+        probes = []
+        for value in set(values):
+            try:
+                probes.append((encode_key(self.attribute, column_key(value)), value))
+            except (ValueError, OverflowError):
+                continue
+        probes.sort(key=lambda probe: probe[0], reverse=self.descending)
+        matches = {}
+        position = 0
+        for encoded, value in probes:
+            position = self.lower_bound(encoded, position)
+            row = self.match_at(position, encoded, value)[1]
+            if row is not None:
+                matches[value] = row
+        return matches
+
+
+class ViewPager:
+    '''
+    Serves pages of rows from a sorted view in fixed-size blocks, keeping
+    only the most recently used blocks in memory. Used by the display
+    screen so it never holds more than a few blocks of a view at once
+    '''
+
+    def __init__(self, count, fetch_rows, block_size=DEFAULT_BLOCK_SIZE, max_blocks=DEFAULT_MAX_BLOCKS, close=None):
+        '''
+        @param count: int number of rows in the view
+        @param fetch_rows: function taking (start, stop) and returning that list of rows
+        @param block_size: int rows fetched at a time
+        @param max_blocks: int blocks kept in memory
+        @param close: function releasing whatever fetch_rows reads from, or None
+        '''
+        self.count = count
+        self.fetch_rows = fetch_rows
+        self.block_size = block_size
+        self.max_blocks = max_blocks
+        self.close_source = close
+        self.blocks = OrderedDict()
+        self.closed = False
+
+    def __len__(self):
+        return self.count
+
+    def block(self, number):
+        rows = self.blocks.get(number)
+        if rows is None:
+            rows = self.fetch_rows(number * self.block_size, (number + 1) * self.block_size)
+            self.blocks[number] = rows
+            if len(self.blocks) > self.max_blocks:
+                self.blocks.popitem(last=False)
+        else:
+            self.blocks.move_to_end(number)
+        return rows
+
+    def rows(self, start, stop):
+        '''
+        @param start: int first position
+        @param stop: int position after the last one
+        @return rows: list of lists of str
+        '''
+        start = max(0, start)
+        stop = min(self.count, stop)
+        rows = []
+        position = start
+        while position < stop:
+            number, offset = divmod(position, self.block_size)
+            block = self.block(number)
+            rows.extend(block[offset:offset + stop - position])
+            position = (number + 1) * self.block_size
+        return rows
+
+    def prefetch(self, start, stop):
+        '''
+        Loads the blocks covering start..stop-1 ahead of them being shown.
+        Does nothing once the pager is closed, since a prefetch may have
+        been scheduled before the view was switched
+        '''
+        if self.closed:
+            return
+        start = max(0, start)
+        stop = min(self.count, stop)
+        for number in range(start // self.block_size, (stop - 1) // self.block_size + 1 if stop > start else 0):
+            if number not in self.blocks:
+                self.block(number)
+
+    def close(self):
+        self.closed = True
+        self.blocks.clear()
+        if self.close_source is not None:
+            self.close_source()
+
+
+def open_view_pager(csv_filename):
+    '''
+    Opens a sorted CSV view for paging. With a valid sidecar this only maps
+    the index, whatever the size of the view; without one the CSV is parsed
+
+    @param csv_filename: file path of a sorted CSV view
+    @return pager: ViewPager
+    '''
+    try:
+        index = ViewIndex(csv_filename)
+    except ValueError:
+        with open(csv_filename, 'r', newline='') as csvfile:
+            rows = list(csv.reader(csvfile))
+        return ViewPager(len(rows), lambda start, stop: rows[start:stop])
+    return ViewPager(len(index), index.rows, close=index.close)
@@ -0,0 +1,281 @@
+'''
+Builds the sorted views of the book data (one per attribute and order)
+as permutations of row indexes. Each attribute is sorted once; the
+descending view is derived from the ascending one without sorting again.
+SortedView keeps a built view up to date as books are added and deleted
+'''
+from array import array
+import bisect
+import os
+from concurrent.futures import ProcessPoolExecutor
+import sort_engine
+import book_keys
+
+asc = 'asc'
+desc = 'desc'
+orders = [asc, desc]
+# catalogues smaller than this are not worth the cost of starting worker processes:
+PARALLEL_THRESHOLD = 100000
+
+
+def build_attribute_views(keys, attribute, strategy=sort_engine.DEFAULT_STRATEGY, row_ids=None):
+    '''
+    Sorts a single column once and returns both of its views.
+    Takes just the typed keys of the column so it is cheap to send to a worker process
+
+    @param keys: list of typed keys of one attribute, keys[i] belonging to book i
+    @param attribute: book attribute (e.g. author/title/etc)
+    @param strategy: str name of sort engine strategy
+    @param row_ids: iterable of the indexes to sort, defaults to every index of keys
+    @return asc_permutation, desc_permutation: lists of row indexes
+    '''
+    asc_permutation = sort_engine.sort_permutation(
+        keys, strategy=strategy, fixed_width=attribute in book_keys.FIXED_WIDTH_ATTRIBUTES, items=row_ids)
+    desc_permutation = sort_engine.reverse_stable(asc_permutation, keys)
+    return asc_permutation, desc_permutation
+
+
+def build_views(data, attributes=book_keys.attributes, strategy=sort_engine.DEFAULT_STRATEGY, workers=None):
+    '''
+    Builds the ascending and descending view of every attribute.
+    Ties keep the order of the rows in data, so rebuilding unchanged data
+    always gives the same views
+
+    @param data: list of lists containing book data, or a BookStore
+    @param attributes: list of book attributes to build views for
+    @param strategy: str name of sort engine strategy
+    @param workers: int number of worker processes. None uses a process pool
+    only for catalogues of PARALLEL_THRESHOLD rows or more; 1 disables it
+    @return views: dict mapping (attribute, order) to a list of row indexes
+    '''
+    row_ids = book_keys.row_ids(data)
+    if workers is None:
+        workers = min(len(attributes), os.cpu_count() or 1) if len(row_ids) >= PARALLEL_THRESHOLD else 1
+    views = {}
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                attribute: executor.submit(build_attribute_views, book_keys.extract_keys(data, attribute),
+                                           attribute, strategy, row_ids)
+                for attribute in attributes
+            }
+            for attribute, future in futures.items():
+                views[(attribute, asc)], views[(attribute, desc)] = future.result()
+    else:
+        for attribute in attributes:
+            views[(attribute, asc)], views[(attribute, desc)] = build_attribute_views(
+                book_keys.extract_keys(data, attribute), attribute, strategy, row_ids)
+    return views
+
+
+def rank_keys(keys):
+    '''
+    Replaces every key by its rank among the distinct keys, so a column of
+    any type becomes small non-negative ints in the same order
+
+    @param keys: list of typed keys of one attribute
+    @return ranks, count: list of int ranks parallel to keys and int number of distinct keys
+    '''
+    distinct = sorted(set(keys))
+    rank_of = {key: rank for rank, key in enumerate(distinct)}
+    return [rank_of[key] for key in keys], len(distinct)
+
+
+def composite_keys(data, sort_spec):
+    '''
+    Packs several attributes into one int key per book, e.g. author then
+    date of publication then title. Each attribute is ranked, descending
+    ranks are flipped, and the ranks are combined in mixed radix, so one
+    comparison of packed keys orders books as the whole spec would
+
+    @param data: list of lists containing book data, or a BookStore
+    @param sort_spec: list of (attribute, order) pairs, most significant first
+    @return keys, span: list of packed int keys, keys[i] belonging to book i, and int bound on the keys
+    @raise ValueError: raises an exception for an empty spec or an unknown order
+    '''
+    if not sort_spec:
+        raise ValueError("A sort needs at least one attribute.")
+    packed = None
+    span = 1
+    for attribute, order in sort_spec:
+        if order not in orders:
+            raise ValueError(f"Unknown sort order: {order}")
+        ranks, count = rank_keys(book_keys.extract_keys(data, attribute))
+        if order == desc:
+            ranks = [count - 1 - rank for rank in ranks]
+        packed = ranks if packed is None else [key * count + rank for key, rank in zip(packed, ranks)]
+        span *= max(count, 1)
+    return packed, span
+
+
+def build_composite_view(data, sort_spec, strategy=sort_engine.DEFAULT_STRATEGY):
+    '''
+    Sorts the books by a composite spec in one stable pass over packed keys.
+    Books equal on every attribute keep their order in data, so sorting
+    unchanged data always gives the same order
+
+    @param data: list of lists containing book data, or a BookStore
+    @param sort_spec: list of (attribute, order) pairs, most significant first
+    @param strategy: str name of sort engine strategy
+    @return permutation: list of row indexes in sorted order
+    @raise ValueError: raises an exception for an invalid spec
+    '''
+    keys, span = composite_keys(data, sort_spec)
+    if strategy in (sort_engine.lomuto, sort_engine.introsort):
+        # the unstable strategies get the row index as a last key, so they break ties as a stable sort would
+        keys = [key * len(keys) + row_id for row_id, key in enumerate(keys)]
+        span *= max(len(keys), 1)
+    # packed keys of up to 64 bits radix sort in at most eight passes
+    return sort_engine.sort_permutation(keys, strategy=strategy, fixed_width=span <= 1 << 64,
+                                        items=book_keys.row_ids(data))
+
+
+class SortedView:
+    '''
+    Ascending view of one attribute of a BookStore, held as row ids with
+    a parallel array of keys and kept sorted as books are added and
+    deleted, so a single change never needs a full re-sort. The
+    descending view is derived from it when the view is written out
+    '''
+
+    def __init__(self, attribute, store, row_ids, keys=None):
+        '''
+        @param attribute: book attribute (e.g. author/title/etc)
+        @param store: BookStore the row ids refer to
+        @param row_ids: iterable of int row ids already sorted ascending by attribute
+        @param keys: iterable of the keys of those rows in the same order, or None to read them from the store
+        '''
+        self.attribute = attribute
+        self.key = book_keys.get_key_function(attribute)
+        self.store = store
+        self.row_ids = array('q', row_ids)
+        if keys is None:
+            keys = [store.key(row_id, attribute) for row_id in self.row_ids]
+        if attribute in (book_keys.title, book_keys.author):
+            self.keys = keys
+        else:
+            self.keys = array('q', keys)
+        self.dirty = False
+
+    def __len__(self):
+        return len(self.row_ids)
+
+    def insert(self, row_id):
+        '''
+        Inserts a book after any books with an equal key, which is where
+        a full stable rebuild would put a newly appended book
+
+        @param row_id: int row id of the new book in the store
+        @return index: int position the book was inserted at
+        '''
+        book_key = self.store.key(row_id, self.attribute)
+        index = bisect.bisect_right(self.keys, book_key)
+        self.keys.insert(index, book_key)
+        self.row_ids.insert(index, row_id)
+        self.dirty = True
+        return index
+
+    def remove(self, row_id):
+        '''
+        Removes a book, located by binary search on its key and then by
+        row id among any books sharing that key
+
+        @param row_id: int row id of the book in the store
+        @return removed: bool, False if the book is not in the view
+        '''
+        book_key = self.store.key(row_id, self.attribute)
+        index = bisect.bisect_left(self.keys, book_key)
+        while index < len(self.keys) and self.keys[index] == book_key:
+            if self.row_ids[index] == row_id:
+                del self.keys[index]
+                del self.row_ids[index]
+                self.dirty = True
+                return True
+            index += 1
+        return False
+
+    def ordered_row_ids(self, order):
+        '''
+        @param order: str value of either asc/desc
+        @return row_ids: sequence of int row ids in that order
+        '''
+        if order == desc:
+            positions = sort_engine.reverse_stable(range(len(self.row_ids)), self.keys)
+            return [self.row_ids[position] for position in positions]
+        return self.row_ids
+
+    def rows(self, order):
+        '''
+        @param order: str value of either asc/desc
+        @return books: iterator over the view's books, as lists, in that order
+        '''
+        return (self.store.row(row_id) for row_id in self.ordered_row_ids(order))
+
+    def scan(self, start, end):
+        '''
+        Lazily yields the books at positions start..end-1 of the ascending view
+
+        @param start: int first position
+        @param end: int position after the last one
+        '''
+        for position in range(start, end):
+            yield self.store.row(self.row_ids[position])
+
+    def equal(self, value):
+        '''
+        Lazily yields every book whose attribute equals value, in view order
+
+        @param value: str attribute value as it appears in the CSV
+        '''
+        value_key = self.key(value)
+        return self.scan(bisect.bisect_left(self.keys, value_key), bisect.bisect_right(self.keys, value_key))
+
+    def first_matches(self, values):
+        '''
+        Resolves many exact-match lookups in one pass: the distinct values
+        are sorted by key and joined against the view, each binary search
+        starting where the previous one stopped
+
+        @param values: iterable of str attribute values as they appear in the CSV
+        @return matches: dict mapping each value found to its first book in view order
+        '''
+        probes = []
+        for value in set(values):
+            try:
+                probes.append((self.key(value), value))
+            except ValueError:
+                continue
+        probes.sort(key=lambda probe: probe[0])
+        matches = {}
+        position = 0
+        for value_key, value in probes:
+            position = bisect.bisect_left(self.keys, value_key, position)
+            if position < len(self.keys) and self.keys[position] == value_key:
+                matches[value] = self.store.row(self.row_ids[position])
+        return matches
+
+    def between(self, low=None, high=None):
+        '''
+        Lazily yields every book whose attribute lies between low and high
+        inclusive, in ascending order. Either bound may be left open
+
+        @param low: str lower bound as it appears in the CSV, or None
+        @param high: str upper bound as it appears in the CSV, or None
+        '''
+        start = 0 if low is None else bisect.bisect_left(self.keys, self.key(low))
+        end = len(self.keys) if high is None else bisect.bisect_right(self.keys, self.key(high))
+        return self.scan(start, end)
+
+    def prefix(self, text):
+        '''
+        Lazily yields every book whose title/author starts with text, in ascending order
+
+        @param text: str prefix to match
+        @raise ValueError: raises an exception for columns that are not text
+        '''
+        if self.attribute not in (book_keys.title, book_keys.author):
+            raise ValueError("Prefix search is only available for title and author.")
+        position = bisect.bisect_left(self.keys, text)
+        while position < len(self.keys) and self.keys[position].startswith(text):
+            yield self.store.row(self.row_ids[position])
+            position += 1